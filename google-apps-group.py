@@ -37,7 +37,6 @@ import os
 import sys
 import json
 import base64
-import copy
 from stat import S_IRUSR, S_IWUSR
 
 # oauth2client lib expects sys.argv to exist
@@ -46,8 +45,10 @@ if not hasattr(sys, 'argv'):
 
 import listener
 from univention.googleapps.auth import GappsAuth
+from univention.googleapps.eventqueue import EventQueue, EVENT_ATTRIBUTES, EVENT_QUEUE_DB
 from univention.googleapps.listener import GoogleAppsListener
 from univention.googleapps.logging2udebug import get_logger
+from univention.googleapps.sync import GROUP_LISTENER_ATTRIBUTES, sync_group, sync_or_defer
 
 listener.configRegistry.load()
 logger = get_logger("google-apps", "gafw")
@@ -60,13 +61,18 @@ if GappsAuth.is_initialized() and listener.configRegistry.is_true("google-apps/g
 else:
 	filter = '(objectClass=deactivatedGoogleAppsGroupListener)'
 	logger.warn("google apps group listener deactivated")
-attributes = ["cn", "description", "uniqueMember", "mailPrimaryAddress"]
+attributes = list(GROUP_LISTENER_ATTRIBUTES)
 modrdn = "1"
 
 GOOGLEAPPS_GROUP_OLD_JSON = os.path.join("/var/lib/univention-google-apps", "google-apps-group_old_dn")
 
 ldap_cred = dict()
-attributes_copy = copy.deepcopy(attributes)  # when handler() runs, all kinds of stuff is suddenly in attributes
+attributes_copy = list(GROUP_LISTENER_ATTRIBUTES)  # when handler() runs, all kinds of stuff is suddenly in attributes
+# append events to the EventQueue instead of processing them (google-apps/queue)
+use_queue = listener.configRegistry.is_true("google-apps/queue", False)
+# store failed changes in the dead letter store instead of stopping the listener (google-apps/queue/defer-failed)
+defer_failed = listener.configRegistry.is_true("google-apps/queue/defer-failed", True)
+event_queue = None
 
 
 def load_old(old):
@@ -87,6 +93,15 @@ def save_old(old):
 		json.dump(old, fp)
 
 
+def get_event_queue(create=True):
+	global event_queue
+	if event_queue is None:
+		if not create and not os.path.exists(EVENT_QUEUE_DB):
+			return None
+		event_queue = EventQueue()
+	return event_queue
+
+
 def setdata(key, value):
 	global ldap_cred
 	ldap_cred[key] = value
@@ -106,6 +121,8 @@ def clean():
 	user objects.
 	"""
 	logger.info("Removing Google Apps for Work ObjectID and Data from all groups.")
+	if use_queue:
+		get_event_queue().clear(name)
 	GoogleAppsListener.clean_udm_objects("groups/group", listener.configRegistry["ldap/base"], ldap_cred)
 
 
@@ -125,46 +142,10 @@ def handler(dn, new, old, command):
 	elif command == 'a':
 		old = load_old(old)
 
-	ol = GoogleAppsListener(listener, dict(listener=attributes_copy), ldap_cred)
-
-	#
-	# NEW group
-	#
-	if new and not old:
-		logger.debug("new and not old -> NEW (%s)", dn)
-		if ol.udm_group_has_google_users(dn):
-			new_google_group = ol.create_google_group_from_ldap(dn)
-			logger.info("Created group %r with ID %r.", new_google_group["name"], new_google_group["id"])
-		logger.debug("done (%s)", dn)
+	if use_queue:
+		get_event_queue().append(name, dn, command, old, new, EVENT_ATTRIBUTES + attributes_copy)
 		return
 
-	#
-	# DELETE group
-	#
-	if old and not new:
-		logger.debug("old and not new -> DELETE (%s)", dn)
-		if "univentionGoogleAppsObjectID" in old:
-			ol.delete_google_group(old["univentionGoogleAppsObjectID"][0])
-			logger.info("Deleted group %r with ID %r.", old["cn"][0], old["univentionGoogleAppsObjectID"][0])
-		logger.debug("done (%s)", dn)
-		return
-
-	#
-	# MODIFY group
-	#
-	if old and new:
-		logger.debug("old and new -> MODIFY (%s)", dn)
-		if "univentionGoogleAppsObjectID" in old or ol.udm_group_has_google_users(dn):
-			ol.modify_google_group(old, new)
-			# save objectId in UDM object
-			group_id = ol.get_udm_group(new["entryDN"][0]).get("UniventionGoogleAppsObjectID")
-			if not group_id:
-				# not (properly) synced, will be next time
-				# missing / unsynced groups are not a problem for users
-				logger.warn("Modified a group, but cannot find UniventionGoogleAppsObjectID (was probably deleted).")
-				group_id = None
-			else:
-				ol.udm_group_set_group_id(new["entryDN"][0], group_id)
-			logger.info("Modified group %r (%r).", old["cn"][0], group_id)
-		logger.debug("done (%s)", dn)
-		return
+	sync_or_defer(
+		get_event_queue if defer_failed else None, name, dn, command, old, new, EVENT_ATTRIBUTES + attributes_copy,
+		sync_group, lambda: GoogleAppsListener(listener, dict(listener=attributes_copy), ldap_cred), dn, new, old)
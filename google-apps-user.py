@@ -34,14 +34,10 @@
 __package__ = ''  # workaround for PEP 366
 
 import os
-import re
 import sys
 import json
 import base64
-import zlib
-import copy
 from stat import S_IRUSR, S_IWUSR
-import datetime
 
 # oauth2client lib expects sys.argv to exist
 if not hasattr(sys, 'argv'):
@@ -49,130 +45,15 @@ if not hasattr(sys, 'argv'):
 
 import listener
 from univention.googleapps.auth import GappsAuth
+from univention.googleapps.eventqueue import EventQueue, EVENT_ATTRIBUTES, EVENT_QUEUE_DB
 from univention.googleapps.listener import GoogleAppsListener
 from univention.googleapps.logging2udebug import get_logger
-
-# attributes that should be anonymized (google-apps/attributes/anonymize):
-attributes_anonymize = list()
-# template of user resource, constructed from UCRVs:
-g_user_resource_template = dict(primaryEmail="%mailPrimaryAddress")
-# attributes that should not be synced (google-apps/attributes/never):
-attributes_never = list()
-# mapping from UCS LDAP attributes to properties in the template:
-ldap2google = dict(mailPrimaryAddress=["primaryEmail"])
-# user is not allowed to set these:
-google_attributes_blacklisted = ["univentionGoogleAppsObjectID", "univentionGoogleAppsData", "kind", "id", "etag",
-	"isAdmin", "isDelegatedAdmin", "lastLoginTime", "creationTime", "deletionTime", "agreedToTerms", "password",
-	"hashFunction", "changePasswordAtNextLogin", "ipWhitelisted", "nonEditableAliases",
-	"customerId", "isMailboxSetup", "thumbnailPhotoEtag", "primaryEmail"]
-# used to create a correct user resource:
-# * check user supplied properties
-# * set the correct object type for each property
-google_user_property_types = dict(addresses=list, agreedToTerms=bool, aliases=list, changePasswordAtNextLogin=bool,
-	creationTime=datetime.datetime, customSchemas=dict, customerId=unicode, deletionTime=datetime.datetime,
-	emails=list, etag=unicode, externalIds=list, hashFunction=unicode, id=unicode, ims=list,
-	includeInGlobalAddressList=bool, ipWhitelisted=bool, isAdmin=bool, isDelegatedAdmin=bool,
-	isMailboxSetup=bool, kind=unicode, lastLoginTime=datetime.datetime, name=dict, nonEditableAliases=list,
-	notes=dict, orgUnitPath=unicode, organizations=list, password=unicode, phones=list, primaryEmail=unicode,
-	relations=list, suspended=bool, suspensionReason=unicode, thumbnailPhotoEtag=unicode, thumbnailPhotoUrl=unicode,
-	websites=list)
-# TODO: make a dict besides/instead of google_user_property_types that defines the types inside the dicts too
-# this will also fix the clash for 'name': it is a dict on the top level and exists as property of type str in organizations
-
-# required properties in nested structures in user resource:
-required_properties = dict(
-	emails=["address"],
-	externalIds=["value"],
-	ims=["im"],
-	name=["familyName", "givenName"],
-	notes=["value"],
-	organizations=["name"],
-	phones=["value"],
-	relations=["value"],
-	websites=["value"]
-)
-# Requirement for "name" in "organizations" isn't by google.
-# It simply doesn't make any sense without it and it would create strange
-# empty entries with the default UCRVs.
+from univention.googleapps.sync import get_user_listener_config, sync_or_defer, sync_user
 
 logger = get_logger("google-apps", "gafw")
 
 listener.configRegistry.load()
 
-
-def get_listener_attributes():
-	global attributes_anonymize, g_user_resource_template, attributes_never, ldap2google
-
-	# blacklisted > never > anonymize > static > sync
-	ucr_never = listener.configRegistry.get("google-apps/attributes/never", "")
-	attributes_never.extend([x.strip() for x in ucr_never.split(",") if x.strip()])
-
-	ucr_anon = listener.configRegistry.get("google-apps/attributes/anonymize", "")
-	attributes_anonymize = [x.strip() for x in ucr_anon.split(",")
-		if x.strip() and x not in google_attributes_blacklisted and x not in attributes_never]
-
-	for k, v in listener.configRegistry.items():
-		if k.startswith("google-apps/attributes/mapping/"):
-			m = re.match(r"^google-apps/attributes/mapping/(.*?)/.*$", k)
-			if not m:
-				m = re.match(r"^google-apps/attributes/mapping/(.*?)$", k)
-			google_attrib = m.groups()[0]
-
-			if google_attrib in google_attributes_blacklisted:
-				logger.warn("Ignoring blacklisted google directory user property %r.", google_attrib)
-				continue
-			if google_attrib not in google_user_property_types:
-				logger.warn("Ignoring unknown google directory user property %r.", google_attrib)
-				continue
-
-			v = v.strip()
-			if not v:
-				continue
-
-			vals = v.split(",")
-			if len(vals) > 1:
-				gprop = dict()
-				for prop in vals:
-					gk, _, action = prop.partition("=")
-					gprop[gk] = action
-			else:
-				gprop = v
-
-			if google_user_property_types[google_attrib] == list:
-				try:
-					g_user_resource_template[google_attrib].append(gprop)
-				except KeyError:
-					g_user_resource_template[google_attrib] = [gprop]
-			else:
-				g_user_resource_template[google_attrib] = gprop
-
-			for prop in v.split(","):
-				gk, _, action = prop.partition("=")
-				if not action:
-					# single value
-					action = gk
-				if action.startswith("%"):
-					ldap_attr = action[1:]
-					if ldap_attr not in attributes_never:
-						try:
-							ldap2google[ldap_attr].append(google_attrib)
-						except KeyError:
-							ldap2google[ldap_attr] = [google_attrib]
-				else:
-					# static -> ignore: will be set just once, when creating the user
-					pass
-		else:
-			pass
-
-	# just for log readability
-	attributes_anonymize.sort()
-	attributes_never.sort()
-
-	attrs = {"univentionGoogleAppsEnabled", "mailPrimaryAddress"}
-	attrs.update(ldap2google.keys())
-	return sorted(list(attrs))
-
-
 name = 'google-apps-user'
 description = 'sync users to Google Directory'
 if GappsAuth.is_initialized():
@@ -181,30 +62,25 @@ if GappsAuth.is_initialized():
 else:
 	filter = '(objectClass=deactivatedGoogleAppsUserListener)'
 	logger.warn("google apps user listener deactivated")
-attributes = get_listener_attributes()
+# the listener adds attributes to 'attributes' at runtime, use the copy in _attrs["listener"]
+attributes, _attrs = get_user_listener_config(listener.configRegistry)
 modrdn = "1"
 
 GOOGLEAPPS_USER_OLD_JSON = os.path.join("/var/lib/univention-google-apps", "google-apps-user_old_dn")
 
-_attrs = dict(
-	anonymize=attributes_anonymize,
-	listener=copy.deepcopy(attributes),  # when handler() runs, all kinds of stuff is suddenly in attributes
-	template=g_user_resource_template,
-	never=attributes_never,
-	google_attribs=ldap2google,
-	blacklisted=google_attributes_blacklisted,
-	google_types=google_user_property_types,
-	required_properties=required_properties
-)
-
 ldap_cred = dict()
 group_sync_enabled = listener.configRegistry.is_true("google-apps/groups/sync", False)
+# append events to the EventQueue instead of processing them (google-apps/queue)
+use_queue = listener.configRegistry.is_true("google-apps/queue", False)
+# store failed changes in the dead letter store instead of stopping the listener (google-apps/queue/defer-failed)
+defer_failed = listener.configRegistry.is_true("google-apps/queue/defer-failed", True)
+event_queue = None
 
 logger.info("listener observing attributes: %r", attributes)
-logger.info("user ressource template: %r", g_user_resource_template)
-logger.info("attributes to sync anonymized: %r", attributes_anonymize)
-logger.info("attributes to never sync: %r", attributes_never)
-logger.info("ldap2google attribute triggers: %r", ldap2google)
+logger.info("user ressource template: %r", _attrs["template"])
+logger.info("attributes to sync anonymized: %r", _attrs["anonymize"])
+logger.info("attributes to never sync: %r", _attrs["never"])
+logger.info("ldap2google attribute triggers: %r", _attrs["google_attribs"])
 
 
 def load_old(old):
@@ -225,6 +101,15 @@ def save_old(old):
 		json.dump(old, fp)
 
 
+def get_event_queue(create=True):
+	global event_queue
+	if event_queue is None:
+		if not create and not os.path.exists(EVENT_QUEUE_DB):
+			return None
+		event_queue = EventQueue()
+	return event_queue
+
+
 def setdata(key, value):
 	global ldap_cred
 	ldap_cred[key] = value
@@ -241,6 +126,8 @@ def clean():
 	user objects.
 	"""
 	logger.info("clean() removing Google Apps for Work ObjectID and Data from all users.")
+	if use_queue:
+		get_event_queue().clear(name)
 	GoogleAppsListener.clean_udm_objects("users/user", listener.configRegistry["ldap/base"], ldap_cred)
 
 
@@ -258,96 +145,10 @@ def handler(dn, new, old, command):
 	elif command == 'a':
 		old = load_old(old)
 
-	ol = GoogleAppsListener(listener, _attrs, ldap_cred)
-
-	old_enabled = bool(int(old.get("univentionGoogleAppsEnabled", ["0"])[0]))  # "" when disabled, "1" when enabled
-	new_enabled = bool(int(new.get("univentionGoogleAppsEnabled", ["0"])[0]))
-
-	#
-	# NEW or REACTIVATED account
-	#
-	if new_enabled and not old_enabled:
-		logger.debug("new_enabled and not old_enabled -> NEW or REACTIVATED (%r)", dn)
-		new_user = ol.create_google_user(new)
-		# save/update google objectId and object data in UDM object
-		udm_user = ol.get_udm_user(dn)
-		udm_user["UniventionGoogleAppsObjectID"] = new_user["id"]
-		udm_user["UniventionGoogleAppsData"] = base64.encodestring(zlib.compress(json.dumps(new_user)))
-		udm_user.modify()
-		logger.info("Added google account of user %r. primaryEmail: %r id: %r", new["uid"][0],
-			new_user["primaryEmail"], new_user["id"])
-
-		if group_sync_enabled and old:
-			# Not a new UCS user, just a new Google user. The group listener
-			# will not be triggered, as no group changes have happend.
-			logger.info("Creating/Modifying users groups...")
-			for dn in udm_user.get('groups', []):
-				if ol.udm_group_has_google_users(dn):
-					google_group = ol.create_google_group_from_ldap(dn)
-					logger.info("Created/Modified group %r with ID %r.", google_group["name"], google_group["id"])
-		logger.debug("done (%s)", dn)
+	if use_queue:
+		get_event_queue().append(name, dn, command, old, new, EVENT_ATTRIBUTES + _attrs["listener"])
 		return
 
-	#
-	# DELETE account
-	#
-	if old and not new:
-		logger.debug("old and not new -> DELETE (%r)", dn)
-		try:
-			object_id = old["univentionGoogleAppsObjectID"][0]
-		except KeyError:
-			logger.warn('Trying to delete user without Google ObjectID, ignoring: %r', new['uid'][0])
-			return
-		ol.delete_google_user(object_id)
-		logger.info("Deleted google account of user %r.", old["uid"][0])
-		logger.debug("done (%s)", dn)
-		return
-
-	#
-	# DEACTIVATE account
-	#
-	if new and not new_enabled:
-		logger.debug("new and not new_enabled -> DEACTIVATE (%r)", dn)
-		try:
-			object_id = old["univentionGoogleAppsObjectID"][0]
-		except KeyError:
-			logger.warn('Trying to deactivate user without Google ObjectID, ignoring: %r', new['uid'][0])
-			return
-		ol.delete_google_user(object_id)
-		# update google objectId and object data in UDM object
-		udm_user = ol.get_udm_user(dn)
-		# Cannot delete UniventionGoogleAppsData, because it would result in:
-		# ldapError: Inappropriate matching: modify/delete: univentionGoogleAppsData: no equality matching rule
-		# Explanation: http://gcolpart.evolix.net/blog21/delete-facsimiletelephonenumber-attribute/
-		udm_user["UniventionGoogleAppsData"] = base64.encodestring(zlib.compress(json.dumps(None)))
-		udm_user["UniventionGoogleAppsObjectID"] = None
-		udm_user.modify()
-		username = old["uid"][0]
-		logger.info("Deleted google account of user %r.", username)
-
-		if group_sync_enabled:
-			logger.info("Looking for empty groups to delete...")
-			udm_groups = [ol.get_udm_group(dn) for dn in udm_user.get('groups', [])]
-			google_group_ids = [
-				(ug.dn, ug['UniventionGoogleAppsObjectID']) for ug in udm_groups if ug.get('UniventionGoogleAppsObjectID')
-			]
-			for group_dn, group_id in google_group_ids:
-				ol.wait_for_group_member_to_disappear(group_id, object_id)
-				ol.delete_google_group_if_empty(group_dn, group_id)
-			logger.debug("done (%s)", dn)
-		return
-
-	#
-	# MODIFY account
-	#
-	if old_enabled and new_enabled:
-		logger.debug("old_enabled and new_enabled -> MODIFY (%r)", dn)
-		ol.modify_google_user(old, new)
-		# update google object data in UDM object
-		udm_user = ol.get_udm_user(dn)
-		google_user = ol.get_google_user(new)
-		udm_user["UniventionGoogleAppsObjectID"] = google_user["id"]
-		udm_user["UniventionGoogleAppsData"] = base64.encodestring(zlib.compress(json.dumps(google_user)))
-		udm_user.modify()
-		logger.info("Modified google account of user %r.", old["uid"][0])
-		return
+	sync_or_defer(
+		get_event_queue if defer_failed else None, name, dn, command, old, new, EVENT_ATTRIBUTES + _attrs["listener"],
+		sync_user, lambda: GoogleAppsListener(listener, _attrs, ldap_cred), dn, new, old, group_sync_enabled)
@@ -31,19 +31,26 @@
 # <http://www.gnu.org/licenses/>.
 
 
+import glob
 import httplib2
 import json
+import re
 import sys
+import time
+import tempfile
+import threading
 from urllib import quote
 import os.path
 
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build, build_from_document, DISCOVERY_URI
 from httplib2 import SSLHandshakeError
 from oauth2client.file import Storage
 from oauth2client.client import AccessTokenRefreshError, Error as Oauth2ClientError
 from oauth2client.service_account import ServiceAccountCredentials
 
+from univention.googleapps.localdb import set_file_owner
 from univention.googleapps.logging2udebug import get_logger
+from univention.googleapps.tokencache import SharedTokenStorage, load_stored_token, start_background_refresh
 from univention.lib.i18n import Translation
 from univention.config_registry import ConfigRegistry
 from univention.config_registry.frontend import ucr_update
@@ -61,6 +68,15 @@ ucr.load()
 
 CONFDIR = "/etc/univention-google-apps"
 CREDENTIALS_FILE = os.path.join(CONFDIR, "credentials.json")
+# additional service accounts to spread API calls over, see get_service_pool()
+ADDITIONAL_CREDENTIALS_DIR = os.path.join(CONFDIR, "credentials.d")
+PRIMARY_CREDENTIALS_NAME = "default"
+VARDIR = "/var/lib/univention-google-apps"
+DISCOVERY_DOCUMENT_FILE = os.path.join(VARDIR, "discovery_{api}_{apiVersion}.json")
+DISCOVERY_DOCUMENT_MAX_AGE = 7 * 24 * 3600
+TOKEN_FILE = os.path.join(VARDIR, "token.json")
+ADDITIONAL_TOKEN_FILE = os.path.join(VARDIR, "token-{name}.json")
+TOKEN_LOCK_FILE = os.path.join(VARDIR, "token.lock")
 SCOPE = [
 	"https://www.googleapis.com/auth/admin.directory.user",
 	"https://www.googleapis.com/auth/admin.directory.group",
@@ -71,6 +87,19 @@ GOOGLE_APPS_SERVICEPROVIDER_DN = "SAMLServiceProviderIdentifier=google.com,cn=sa
 
 logger = get_logger("google-apps", "gafw")
 
+# Service objects (and with them the access token) are shared by all GappsAuth
+# instances of a process:
+# {"admin.directory_v1:default": (credentials file signature, service object, credentials)}
+_service_objects = dict()
+# httplib2.Http is not thread safe, each thread has its own authorized HTTP
+# connection: _thread_https.https = {"admin.directory_v1:default": (credentials file signature, authorized httplib2.Http)}
+_thread_https = threading.local()
+# Additional credentials files that could not be used: {path: credentials file signature}
+_broken_credentials = dict()
+
+# Result of the last is_initialized() check: {"signature": credentials file signature, "result": bool}
+_initialization_state = dict()
+
 
 class GoogleAppError(Exception):
 	pass
@@ -106,7 +135,6 @@ class GappsAuth(object):
 	def __init__(self, listener):
 		self.listener = listener
 		self.credentials = None
-		self.service_objects = dict()
 		self.ucr = ucr
 		if self.ucr.is_true("google-apps/debug/api-calls"):
 			httplib2.debuglevel = 4
@@ -115,18 +143,27 @@ class GappsAuth(object):
 	def is_initialized(cls):
 		"""
 		Checks if the credentials to use the google directory are available.
+		The credentials file is parsed only if it changed since the last check.
 		:return: bool
 		"""
+		signature = cls.get_credentials_file_signature()
+		if signature is not None and _initialization_state.get("signature") == signature:
+			return _initialization_state["result"]
 		try:
 			sjac = cls._get_credentials()
-			return not sjac.invalid
+			result = not sjac.invalid
 		except NoCredentials:
-			return False
+			result = False
+		_initialization_state.update(signature=signature, result=result)
+		return result
 
 	@staticmethod
 	def uninitialize():
+		_initialization_state.clear()
 		with open(CREDENTIALS_FILE, "w") as fp:
 			json.dump({}, fp)
+		for path in glob.glob(os.path.join(ADDITIONAL_CREDENTIALS_DIR, "*.json")):
+			os.remove(path)
 
 	def get_credentials(self):
 		"""
@@ -138,20 +175,32 @@ class GappsAuth(object):
 		return self.credentials
 
 	@classmethod
-	def _get_credentials(cls):
+	def _get_credentials(cls, path=CREDENTIALS_FILE):
 		"""
 		Static version without caching the storage object.
+		:param path: str: credentials file
 		:return: oauth2client.file.Storage object or NoIDsStored
 		"""
 		try:
-			credentials = cls._load_credentials()
+			credentials = cls._load_credentials(path)
 
 			if credentials and not credentials.invalid and credentials._kwargs["domain"]:
 				return credentials
 			else:
-				raise NoCredentials("No valid credentials found in '{}'.".format(CREDENTIALS_FILE))
+				raise NoCredentials("No valid credentials found in '{}'.".format(path))
 		except (AttributeError, IOError, KeyError):
-			raise NoCredentials("No valid credentials found in '{}'.".format(CREDENTIALS_FILE))
+			raise NoCredentials("No valid credentials found in '{}'.".format(path))
+
+	@staticmethod
+	def list_credentials_files():
+		"""
+		Get the credentials files of all service accounts.
+		:return: list of tuples (name, path), the primary credentials first
+		"""
+		res = [(PRIMARY_CREDENTIALS_NAME, CREDENTIALS_FILE)]
+		for path in sorted(glob.glob(os.path.join(ADDITIONAL_CREDENTIALS_DIR, "*.json"))):
+			res.append((os.path.basename(path)[:-len(".json")], path))
+		return res
 
 	@classmethod
 	def update_saml_configuration(cls, gsuite_domain):
@@ -187,12 +236,15 @@ class GappsAuth(object):
 			raise CredentialsStorageError(_("IOError when modifying SAML service provider."))
 
 	@classmethod
-	def store_credentials(cls, client_credentials, impersonate_user, **kwargs):
+	def store_credentials(cls, client_credentials, impersonate_user, additional=False, **kwargs):
 		"""
 		Store credentials from a JSON file supplied by Googles Developers Console.
 		:param client_credentials: dict: service account credentials, must have
 			keys client_email, client_id and private_key
 		:param impersonate_user: str: email address of admin user
+		:param additional: bool: store the credentials of an additional service
+			account (or admin user) of the already configured domain, to spread
+			API calls over more quota
 		:param kwargs: additional parameters to pass to SignedJwtAssertionCredentials()
 			must contain "domain=<domain validated by google>"
 		:return: None
@@ -203,16 +255,30 @@ class GappsAuth(object):
 		except (KeyError, TypeError):
 			logger.exception("GappsAuth.store_credentials() Missing name of validated domain.")
 			raise MissingClientCredentials(_("Please supply the name of a validated domain."))
+		if additional and (not cls.is_initialized() or cls.get_domain() != kwargs["domain"]):
+			raise MissingClientCredentials(_("Additional credentials can only be added for the configured domain."))
 
 		credentials = ServiceAccountCredentials.from_json_keyfile_dict(client_credentials, SCOPE)
 		credentials = credentials.create_scoped(SCOPE).create_delegated(impersonate_user).create_with_claims(kwargs)
 
-		storage = Storage(CREDENTIALS_FILE)
+		if additional:
+			name = re.sub(r"[^a-zA-Z0-9_.-]", "_", "{}_{}".format(client_credentials["client_id"], impersonate_user))
+			path = os.path.join(ADDITIONAL_CREDENTIALS_DIR, "{}.json".format(name))
+			if not os.path.isdir(ADDITIONAL_CREDENTIALS_DIR):
+				os.mkdir(ADDITIONAL_CREDENTIALS_DIR, 0o700)
+				set_file_owner(ADDITIONAL_CREDENTIALS_DIR, 0o700)
+		else:
+			path = CREDENTIALS_FILE
+		storage = Storage(path)
+		_initialization_state.clear()
 		try:
 			storage.put(credentials)
 		except IOError:
-			logger.exception("GappsAuth.store_credentials() IOError when writing %r.", CREDENTIALS_FILE)
+			logger.exception("GappsAuth.store_credentials() IOError when writing %r.", path)
 			raise CredentialsStorageError(_("Error when writing credentials to disk."))
+		if additional:
+			set_file_owner(path)
+			return
 
 		cls.update_saml_configuration(kwargs['domain'])
 
@@ -241,48 +307,238 @@ class GappsAuth(object):
 		return credentials._kwargs["domain"]
 
 	@staticmethod
-	def _load_credentials():
+	def get_credentials_file_signature(path=CREDENTIALS_FILE):
+		"""
+		Get data that changes whenever the credentials file is modified.
+		:param path: str: credentials file
+		:return: tuple (inode, mtime, size) or None if the file does not exist
+		"""
+		try:
+			st = os.stat(path)
+		except OSError:
+			return None
+		return st.st_ino, st.st_mtime, st.st_size
+
+	@staticmethod
+	def _read_discovery_document(service_name, version):
+		"""
+		Load the cached discovery document of an API from disk.
+		:param service_name: str: api to use
+		:param version: str: version of api to use
+		:return: tuple (dict: discovery document, float: age in seconds) or (None, None)
+		if there is no usable document
+		"""
+		path = DISCOVERY_DOCUMENT_FILE.format(api=service_name, apiVersion=version)
+		try:
+			with open(path, "rb") as fp:
+				document = json.load(fp)
+			age = time.time() - os.stat(path).st_mtime
+		except (IOError, OSError, ValueError):
+			return None, None
+		if not isinstance(document, dict) or document.get("name") != service_name or document.get("version") != version:
+			logger.warn("GappsAuth._read_discovery_document() ignoring %r: not for %s %s.", path, service_name, version)
+			return None, None
+		return document, age
+
+	@staticmethod
+	def _write_discovery_document(service_name, version, content):
+		"""
+		Atomically store the discovery document of an API on disk.
+		:param service_name: str: api to use
+		:param version: str: version of api to use
+		:param content: str: discovery document (JSON)
+		:return: None
+		"""
+		path = DISCOVERY_DOCUMENT_FILE.format(api=service_name, apiVersion=version)
+		try:
+			fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".discovery")
+			with os.fdopen(fd, "wb") as fp:
+				fp.write(content)
+			os.chmod(tmp_path, 0o644)
+			os.rename(tmp_path, path)
+		except (IOError, OSError) as exc:
+			logger.warn("GappsAuth._write_discovery_document() could not write %r: %s", path, exc)
+
+	def get_discovery_document(self, service_name, version, http):
+		"""
+		Get the discovery document of an API. It is downloaded only if the
+		copy on disk is missing, for another version or older than
+		google-apps/discovery/max-age seconds. A stale copy is used if the
+		download fails.
+		:param service_name: str: api to use
+		:param version: str: version of api to use
+		:param http: httplib2.Http object to download the document with
+		:return: dict: discovery document or None if none could be retrieved
+		"""
+		max_age = int(self.ucr.get("google-apps/discovery/max-age", DISCOVERY_DOCUMENT_MAX_AGE))
+		document, age = self._read_discovery_document(service_name, version)
+		if document and age < max_age:
+			return document
+
+		uri = DISCOVERY_URI.format(api=service_name, apiVersion=version)
+		logger.info("GappsAuth.get_discovery_document() downloading %r.", uri)
+		try:
+			resp, content = http.request(uri)
+			if resp.status >= 400:
+				raise ValueError("HTTP status {}".format(resp.status))
+			new_document = json.loads(content)
+			if new_document.get("name") != service_name or new_document.get("version") != version:
+				raise ValueError("unexpected API name or version")
+		except (httplib2.HttpLib2Error, EnvironmentError, ValueError) as exc:
+			logger.warn("GappsAuth.get_discovery_document() downloading %r failed: %s", uri, exc)
+			if document:
+				logger.warn("GappsAuth.get_discovery_document() using discovery document of age %ds.", age)
+			return document
+		self._write_discovery_document(service_name, version, content)
+		return new_document
+
+	@staticmethod
+	def _load_credentials(path=CREDENTIALS_FILE):
 		"""
 		Fetch credentials from disk for usage by oauth2client library.
+		:param path: str: credentials file
 		:return: oauth2client.file.Storage object
 		"""
-		storage = Storage(CREDENTIALS_FILE)
+		storage = Storage(path)
 		try:
 			return storage.get()
 		except IOError:
-			logger.exception("GappsAuth.get_credentials() IOError when reading %r.", CREDENTIALS_FILE)
+			logger.exception("GappsAuth.get_credentials() IOError when reading %r.", path)
 			raise
 
 	def get_service_object(self, service_name="admin", version="directory_v1"):
 		"""
 		Create the proxy object to use the google api.
+
+		The service object is created only once per process and reused by
+		all GappsAuth instances, until the credentials file changes. It keeps
+		its HTTP connection open.
+		The access token is shared by all processes through TOKEN_FILE and
+		refreshed by a background thread before it expires, see tokencache.
+		The API description is read from a copy on disk, see
+		get_discovery_document().
+
 		:param service_name: str: api to use
 		:param version: str: version of api to use
 		:return: service object
 		"""
-		key = "{}.{}".format(service_name, version)
-		service = self.service_objects.get(key)
-		if not service:
-			credentials = self.get_credentials()
+		return self._get_service_object(service_name, version, PRIMARY_CREDENTIALS_NAME, CREDENTIALS_FILE)[0]
+
+	def get_service_pool(self, service_name="admin", version="directory_v1"):
+		"""
+		Create proxy objects for the primary and all additional service
+		accounts (see store_credentials()). Requests of a service object can
+		be executed with the HTTP object of any other, to use its quota.
+		Additional credentials that don't work or are for another domain are
+		skipped until their file changes.
+
+		:param service_name: str: api to use
+		:param version: str: version of api to use
+		:return: list of tuples (name, service object, authorized httplib2.Http),
+		the primary credentials first
+		"""
+		res = list()
+		for name, path in self.list_credentials_files():
+			if name == PRIMARY_CREDENTIALS_NAME:
+				res.append((name,) + self._get_service_object(service_name, version, name, path))
+				continue
+			signature = self.get_credentials_file_signature(path)
+			if _broken_credentials.get(path) == signature:
+				continue
 			try:
-				service = build(service_name, version, credentials=credentials)
-			except AccessTokenRefreshError as exc:
-				if str(exc) != "unauthorized_client":
-					raise
-				# Happens when the user has just authorized a service account
-				# for API access, but Googles servers have not realized yet it.
-				# The oauthlib will set the credentials to "invalid", which
-				# will make further connection attempts fail.
-				with open(CREDENTIALS_FILE, "rb") as fp:
-					creds = json.load(fp)
-				creds["invalid"] = False
-				with open(CREDENTIALS_FILE, "wb") as fp:
-					json.dump(creds, fp)
-				raise AuthenticationErrorRetry, AuthenticationErrorRetry(_("Token could not be refreshed, "
-					"you may try to connect again later."), chained_exc=exc), sys.exc_info()[2]
-			except SSLHandshakeError as exc:
-				raise SSLError, SSLError(_('SSL error. Please check your firewall/proxy settings and the servers system time. Error: {}').format(exc), chained_exc=exc), sys.exc_info()[2]
-			except Oauth2ClientError as exc:
-				raise AuthenticationError, AuthenticationError(str(exc), chained_exc=exc), sys.exc_info()[2]
-			self.service_objects[key] = service
-		return service
+				res.append((name,) + self._get_service_object(service_name, version, name, path))
+			except (GoogleAppError, Oauth2ClientError, httplib2.HttpLib2Error, EnvironmentError) as exc:
+				logger.error("GappsAuth.get_service_pool() ignoring %r until it changes: %s", path, exc)
+				_broken_credentials[path] = signature
+		return res
+
+	def _get_service_object(self, service_name, version, name, path):
+		"""
+		Create (or get from the process wide cache) the proxy object to use
+		the google api with the credentials in a file.
+		:param service_name: str: api to use
+		:param version: str: version of api to use
+		:param name: str: name of credentials, see list_credentials_files()
+		:param path: str: credentials file
+		:return: tuple (service object, authorized httplib2.Http of the current thread)
+		"""
+		key = "{}.{}:{}".format(service_name, version, name)
+		try:
+			cached_signature, service, credentials = _service_objects[key]
+			if cached_signature == self.get_credentials_file_signature(path):
+				return service, self._get_thread_http(key, cached_signature, credentials)
+			logger.info("GappsAuth.get_service_object() %r changed, recreating service object.", path)
+		except KeyError:
+			pass
+		# credentials file changed or first use: don't use the cached credentials
+		if name == PRIMARY_CREDENTIALS_NAME:
+			self.credentials = None
+			credentials = self.get_credentials()
+			token_file = TOKEN_FILE
+		else:
+			credentials = self._get_credentials(path)
+			if credentials._kwargs["domain"] != self.get_domain():
+				raise NoCredentials("Credentials in '{}' are not for the configured domain.".format(path))
+			token_file = ADDITIONAL_TOKEN_FILE.format(name=name)
+		credentials.set_store(SharedTokenStorage(credentials, token_file, TOKEN_LOCK_FILE, path))
+		try:
+			http = credentials.authorize(httplib2.Http())
+			document = self.get_discovery_document(service_name, version, httplib2.Http())
+			# Usually another process has stored a token in TOKEN_FILE already,
+			# the background refresh keeps it fresh. Only without one a token
+			# is requested here (build() would have done it when downloading
+			# the document, do it here, so errors are handled the same way).
+			if not load_stored_token(credentials):
+				credentials.get_access_token(httplib2.Http())
+			if document:
+				service = build_from_document(document, http=http)
+			else:
+				service = build(service_name, version, http=http)
+		except AccessTokenRefreshError as exc:
+			if str(exc) != "unauthorized_client":
+				raise
+			# Happens when the user has just authorized a service account
+			# for API access, but Googles servers have not realized yet it.
+			# The oauthlib will set the credentials to "invalid", which
+			# will make further connection attempts fail.
+			with open(path, "rb") as fp:
+				creds = json.load(fp)
+			creds["invalid"] = False
+			with open(path, "wb") as fp:
+				json.dump(creds, fp)
+			raise AuthenticationErrorRetry, AuthenticationErrorRetry(_("Token could not be refreshed, "
+				"you may try to connect again later."), chained_exc=exc), sys.exc_info()[2]
+		except SSLHandshakeError as exc:
+			raise SSLError, SSLError(_('SSL error. Please check your firewall/proxy settings and the servers system time. Error: {}').format(exc), chained_exc=exc), sys.exc_info()[2]
+		except Oauth2ClientError as exc:
+			raise AuthenticationError, AuthenticationError(str(exc), chained_exc=exc), sys.exc_info()[2]
+		# the token refresh may have written the credentials file (marking them invalid)
+		signature = self.get_credentials_file_signature(path)
+		_service_objects[key] = (signature, service, credentials)
+		if not hasattr(_thread_https, "https"):
+			_thread_https.https = dict()
+		_thread_https.https[key] = (signature, http)
+		start_background_refresh(credentials, name)
+		return service, http
+
+	@staticmethod
+	def _get_thread_http(key, signature, credentials):
+		"""
+		Get the authorized HTTP object of the current thread for a service
+		object. All threads use the same credentials (and access token).
+		:param key: str: key of service object in _service_objects
+		:param signature: credentials file signature of service object
+		:param credentials: credentials of service object
+		:return: authorized httplib2.Http
+		"""
+		if not hasattr(_thread_https, "https"):
+			_thread_https.https = dict()
+		try:
+			cached_signature, http = _thread_https.https[key]
+			if cached_signature == signature:
+				return http
+		except KeyError:
+			pass
+		http = credentials.authorize(httplib2.Http())
+		_thread_https.https[key] = (signature, http)
+		return http
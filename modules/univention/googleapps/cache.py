@@ -0,0 +1,140 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+#
+# Univention Google Apps for Work - cache for rarely changing account data
+#
+# Copyright 2016-2019 Univention GmbH
+#
+# http://www.univention.de/
+#
+# All rights reserved.
+#
+# The source code of this program is made available
+# under the terms of the GNU Affero General Public License version 3
+# (GNU AGPL V3) as published by the Free Software Foundation.
+#
+# Binary versions of this program provided by Univention to you as
+# well as other copyrighted, protected or trademarked materials like
+# Logos, graphics, fonts, specific documentations and configurations,
+# cryptographic keys etc. are subject to a license agreement between
+# you and Univention and not subject to the GNU AGPL V3.
+#
+# In the case you use this program under the terms of the GNU AGPL V3,
+# the program is provided in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License with the Debian GNU/Linux or Univention distribution in file
+# /usr/share/common-licenses/AGPL-3; if not, see
+# <http://www.gnu.org/licenses/>.
+
+
+import json
+import os
+import tempfile
+import threading
+import time
+
+from univention.googleapps.auth import GappsAuth, VARDIR
+from univention.googleapps.logging2udebug import get_logger
+
+
+CACHE_FILE = os.path.join(VARDIR, "cache.json")
+CACHE_TTL = 3600  # seconds, see google-apps/cache/ttl
+
+# key -> (credentials file signature, timestamp, value)
+_entries = dict()
+_lock = threading.Lock()
+
+logger = get_logger("google-apps", "gafw")
+
+
+def get_cached(key, func, ttl=CACHE_TTL):
+	"""
+	Get a value that depends on the Google account (domain, customer ID, ...).
+
+	Values are cached in the process and in a file shared by all processes.
+	A value is valid for ttl seconds and as long as the credentials file is
+	not changed (initialization with other credentials). Only if there is no
+	valid value, func is called.
+
+	:param key: str: name of value
+	:param func: callable without arguments that retrieves the value, must
+	return a JSON serializable object
+	:param ttl: int: seconds a value is valid
+	:return: value as returned by func (possibly from a previous call)
+	"""
+	signature = GappsAuth.get_credentials_file_signature()
+	if signature is None:
+		return func()
+	signature = list(signature)
+	now = time.time()
+	with _lock:
+		entry = _entries.get(key)
+	if _is_valid(entry, signature, now, ttl):
+		return entry[2]
+	entry = _read_cache_file().get(key)
+	if _is_valid(entry, signature, now, ttl):
+		with _lock:
+			_entries[key] = entry
+		return entry[2]
+	value = func()
+	entry = (signature, now, value)
+	with _lock:
+		_entries[key] = entry
+	_write_cache_file(key, entry)
+	return value
+
+
+def invalidate():
+	"""
+	Remove all values from the cache of this process and from the shared cache.
+	:return: None
+	"""
+	with _lock:
+		_entries.clear()
+	try:
+		os.remove(CACHE_FILE)
+	except OSError:
+		pass
+
+
+def _is_valid(entry, signature, now, ttl):
+	"""
+	:param entry: tuple (signature, timestamp, value) or None
+	:return: bool: if entry exists, is for the current credentials file and not expired
+	"""
+	return entry is not None and list(entry[0]) == signature and 0 <= now - entry[1] < ttl
+
+
+def _read_cache_file():
+	"""
+	:return: dict: key -> tuple (signature, timestamp, value)
+	"""
+	try:
+		with open(CACHE_FILE, "rb") as fp:
+			return dict((key, tuple(entry)) for key, entry in json.load(fp).items())
+	except (IOError, OSError, ValueError, AttributeError, TypeError):
+		return dict()
+
+
+def _write_cache_file(key, entry):
+	"""
+	Atomically store a value in the shared cache file. Concurrent writers
+	may overwrite each others values, which only leads to a cache miss.
+	:param key: str: name of value
+	:param entry: tuple (signature, timestamp, value)
+	:return: None
+	"""
+	entries = _read_cache_file()
+	entries[key] = entry
+	try:
+		fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(CACHE_FILE), prefix=".cache")
+		with os.fdopen(fd, "wb") as fp:
+			json.dump(entries, fp)
+		os.chmod(tmp_path, 0o644)
+		os.rename(tmp_path, CACHE_FILE)
+	except (IOError, OSError) as exc:
+		logger.warn("Could not write cache file %r: %s", CACHE_FILE, exc)
@@ -0,0 +1,147 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+#
+# Univention Google Apps for Work - circuit breaker for API calls
+#
+# Copyright 2016-2019 Univention GmbH
+#
+# http://www.univention.de/
+#
+# All rights reserved.
+#
+# The source code of this program is made available
+# under the terms of the GNU Affero General Public License version 3
+# (GNU AGPL V3) as published by the Free Software Foundation.
+#
+# Binary versions of this program provided by Univention to you as
+# well as other copyrighted, protected or trademarked materials like
+# Logos, graphics, fonts, specific documentations and configurations,
+# cryptographic keys etc. are subject to a license agreement between
+# you and Univention and not subject to the GNU AGPL V3.
+#
+# In the case you use this program under the terms of the GNU AGPL V3,
+# the program is provided in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License with the Debian GNU/Linux or Univention distribution in file
+# /usr/share/common-licenses/AGPL-3; if not, see
+# <http://www.gnu.org/licenses/>.
+
+
+import time
+import threading
+
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+# {name: CircuitBreaker}, shared by all users of this module in a process
+_breakers = dict()
+_breakers_lock = threading.Lock()
+
+
+class CircuitBreaker(object):
+	"""
+	Circuit breaker for calls to a remote service. Thread safe.
+
+	After threshold consecutive failures the circuit opens: calls fail fast
+	without contacting the service. Every reset_timeout seconds one caller
+	is allowed to probe the service (half open). If the probe succeeds, the
+	circuit closes, otherwise it stays open for another reset_timeout
+	seconds.
+	"""
+	def __init__(self, threshold, reset_timeout):
+		"""
+		:param threshold: int: number of consecutive failures that open the
+		circuit, 0 to disable the circuit breaker
+		:param reset_timeout: float: seconds between probes while the circuit is open
+		"""
+		self.threshold = int(threshold)
+		self.reset_timeout = float(reset_timeout)
+		self.failures = 0
+		self.opened = 0.0  # time the circuit was opened or last probed
+		self._lock = threading.Lock()
+
+	@property
+	def state(self):
+		"""
+		:return: str: CLOSED, OPEN or HALF_OPEN (a probe is due)
+		"""
+		with self._lock:
+			return self._get_state()
+
+	def allow_request(self):
+		"""
+		Check if a call may be made. If a probe is due, the caller must make
+		it and report the result with record_success() or record_failure().
+		Other callers get OPEN until the next probe is due.
+		:return: str: CLOSED: make the call, HALF_OPEN: probe the service,
+		OPEN: don't make the call
+		"""
+		with self._lock:
+			state = self._get_state()
+			if state == HALF_OPEN:
+				self.opened = time.time()
+			return state
+
+	def record_success(self):
+		"""
+		Reset the failure count and close the circuit.
+		:return: bool: whether the circuit was open before
+		"""
+		with self._lock:
+			was_open = self._is_open()
+			self.failures = 0
+			return was_open
+
+	def record_failure(self):
+		"""
+		Count a failure, open the circuit at the threshold.
+		:return: bool: whether the circuit was opened by this failure
+		"""
+		with self._lock:
+			was_open = self._is_open()
+			self.failures += 1
+			if self._is_open():
+				self.opened = time.time()
+			return self._is_open() and not was_open
+
+	def retry_at(self):
+		"""
+		:return: float: time of the next probe if the circuit is open, else 0
+		"""
+		with self._lock:
+			return self.opened + self.reset_timeout if self._is_open() else 0.0
+
+	def _is_open(self):
+		return 0 < self.threshold <= self.failures
+
+	def _get_state(self):
+		if not self._is_open():
+			return CLOSED
+		if time.time() >= self.opened + self.reset_timeout:
+			return HALF_OPEN
+		return OPEN
+
+
+def get_circuit_breaker(name, threshold, reset_timeout):
+	"""
+	Get the process wide circuit breaker with the given name, create it if it
+	doesn't exist yet.
+	:param name: str: name of the circuit breaker
+	:param threshold: int: number of consecutive failures that open the
+	circuit, used only when creating the circuit breaker
+	:param reset_timeout: float: seconds between probes, used only when
+	creating the circuit breaker
+	:return: CircuitBreaker
+	"""
+	with _breakers_lock:
+		try:
+			return _breakers[name]
+		except KeyError:
+			breaker = _breakers[name] = CircuitBreaker(threshold, reset_timeout)
+			return breaker
@@ -0,0 +1,324 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+#
+# Univention Google Apps for Work - durable queue of listener events
+#
+# Copyright 2016-2019 Univention GmbH
+#
+# http://www.univention.de/
+#
+# All rights reserved.
+#
+# The source code of this program is made available
+# under the terms of the GNU Affero General Public License version 3
+# (GNU AGPL V3) as published by the Free Software Foundation.
+#
+# Binary versions of this program provided by Univention to you as
+# well as other copyrighted, protected or trademarked materials like
+# Logos, graphics, fonts, specific documentations and configurations,
+# cryptographic keys etc. are subject to a license agreement between
+# you and Univention and not subject to the GNU AGPL V3.
+#
+# In the case you use this program under the terms of the GNU AGPL V3,
+# the program is provided in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License with the Debian GNU/Linux or Univention distribution in file
+# /usr/share/common-licenses/AGPL-3; if not, see
+# <http://www.gnu.org/licenses/>.
+
+
+
+import os
+import json
+import time
+from collections import namedtuple
+
+from univention.googleapps.auth import VARDIR
+from univention.googleapps.localdb import open_database
+from univention.googleapps.logging2udebug import get_logger
+
+
+EVENT_QUEUE_DB = os.path.join(VARDIR, "events.sqlite")
+# attributes stored with every event in addition to the ones the listener module listens on
+EVENT_ATTRIBUTES = [
+	"cn", "displayName", "entryDN", "entryUUID", "givenName", "sn", "uid",
+	"univentionGoogleAppsEnabled", "univentionGoogleAppsObjectID",
+]
+SCHEMA = """
+PRAGMA journal_mode=WAL;
+CREATE TABLE IF NOT EXISTS events (
+	id INTEGER PRIMARY KEY AUTOINCREMENT,
+	module TEXT NOT NULL,
+	dn TEXT NOT NULL,
+	command TEXT NOT NULL,
+	entry_uuid TEXT,
+	old TEXT NOT NULL,
+	new TEXT NOT NULL,
+	created REAL NOT NULL,
+	attempts INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS events_module ON events (module);
+CREATE TABLE IF NOT EXISTS dead_letters (
+	id INTEGER PRIMARY KEY,
+	object_key TEXT NOT NULL,
+	module TEXT NOT NULL,
+	dn TEXT NOT NULL,
+	command TEXT NOT NULL,
+	entry_uuid TEXT,
+	old TEXT NOT NULL,
+	new TEXT NOT NULL,
+	created REAL NOT NULL,
+	attempts INTEGER NOT NULL DEFAULT 0,
+	error TEXT,
+	next_retry REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS dead_letters_object_key ON dead_letters (object_key);
+"""
+DEAD_LETTER_BASE_DELAY = 60  # seconds until the first retry of a failed event, doubled with each attempt
+DEAD_LETTER_MAX_DELAY = 6 * 3600  # seconds
+WAITING_ERROR = "Waiting for an earlier failed event of this object."
+
+Event = namedtuple("Event", ["id", "module", "dn", "command", "entry_uuid", "old", "new", "created", "attempts"])
+DeadLetter = namedtuple("DeadLetter", ["event", "error", "next_retry"])
+
+logger = get_logger("google-apps", "gafw")
+
+
+class EventQueue(object):
+	"""
+	Durable FIFO queue of listener events (SQLite in WAL mode). The listener
+	modules append events, the sync worker removes them only after they were
+	processed successfully (at-least-once delivery).
+	"""
+	def __init__(self, path=EVENT_QUEUE_DB):
+		self.db = open_database(path, SCHEMA)
+		self.db.create_function("object_key", 3, get_object_key)
+
+	def append(self, module, dn, command, old, new, attributes):
+		"""
+		Store a listener event. Only the given attributes of the old and new
+		object are stored.
+		:param module: str: name of listener module
+		:param dn: str: DN of object
+		:param command: str: listener command
+		:param old: dict: listener old object
+		:param new: dict: listener new object
+		:param attributes: list: attributes to store
+		:return: int: ID of event
+		"""
+		entry_uuid = (new or old).get("entryUUID", [None])[0]
+		with self.db:
+			cursor = self.db.execute(
+				"INSERT INTO events (module, dn, command, entry_uuid, old, new, created) VALUES (?, ?, ?, ?, ?, ?, ?)",
+				(module, dn, command, entry_uuid, self._dump(old, attributes), self._dump(new, attributes), time.time()))
+		return cursor.lastrowid
+
+	def get_events(self, limit=100):
+		"""
+		Get the oldest events.
+		:param limit: int: maximum number of events to return
+		:return: list of Event
+		"""
+		rows = self.db.execute("SELECT * FROM events ORDER BY id LIMIT ?", (limit,)).fetchall()
+		return [self._load(row) for row in rows]
+
+	def set_attempted(self, *event_ids):
+		"""
+		Count a (possibly failing) attempt to process events.
+		:param event_ids: int: IDs of events
+		:return: None
+		"""
+		with self.db:
+			self.db.executemany("UPDATE events SET attempts=attempts+1 WHERE id=?", [(i,) for i in event_ids])
+
+	def unset_attempted(self, *event_ids):
+		"""
+		Revert set_attempted() for events that were not processed after all.
+		:param event_ids: int: IDs of events
+		:return: None
+		"""
+		with self.db:
+			self.db.executemany(
+				"UPDATE events SET attempts=attempts-1 WHERE id=? AND attempts>0", [(i,) for i in event_ids])
+
+	def remove(self, *event_ids):
+		"""
+		Remove processed events.
+		:param event_ids: int: IDs of events
+		:return: None
+		"""
+		with self.db:
+			self.db.executemany("DELETE FROM events WHERE id=?", [(i,) for i in event_ids])
+
+	def clear(self, module):
+		"""
+		Remove all events of a listener module (it is resynchronized).
+		:param module: str: name of listener module
+		:return: int: number of removed events
+		"""
+		with self.db:
+			return self.db.execute("DELETE FROM events WHERE module=?", (module,)).rowcount
+
+	def count(self):
+		"""
+		:return: int: number of events in the queue
+		"""
+		return self.db.execute("SELECT COUNT(*) FROM events").fetchone()[0]
+
+	def move_to_dead_letters(self, event_ids, error, next_retry=None):
+		"""
+		Move failed events to the dead letter store. They are retried at
+		next_retry. Later events of the same objects must be moved there as
+		well (see is_blocked()), to keep the order of changes.
+		:param event_ids: list: IDs of events
+		:param error: str: error message
+		:param next_retry: float: timestamp of next retry or None to retry
+		after DEAD_LETTER_BASE_DELAY seconds
+		:return: None
+		"""
+		if next_retry is None:
+			next_retry = time.time() + DEAD_LETTER_BASE_DELAY
+		with self.db:
+			self.db.executemany(
+				"INSERT INTO dead_letters "
+				"(id, object_key, module, dn, command, entry_uuid, old, new, created, attempts, error, next_retry) "
+				"SELECT id, object_key(module, entry_uuid, dn), module, dn, command, entry_uuid, old, new, created, "
+				"attempts, ?, ? FROM events WHERE id=?", [(error, next_retry, i) for i in event_ids])
+			self.db.executemany("DELETE FROM events WHERE id=?", [(i,) for i in event_ids])
+
+	def get_blocked_keys(self):
+		"""
+		:return: dict: object key (see get_object_key()) -> timestamp of next
+		retry of objects that have events in the dead letter store
+		"""
+		return dict(self.db.execute("SELECT object_key, MIN(next_retry) FROM dead_letters GROUP BY object_key"))
+
+	def is_blocked(self, module, entry_uuid, dn):
+		"""
+		Check if an object has events in the dead letter store.
+		:return: float: timestamp of next retry or None if the object is not blocked
+		"""
+		return self.db.execute(
+			"SELECT MIN(next_retry) FROM dead_letters WHERE object_key=?",
+			(get_object_key(module, entry_uuid, dn),)).fetchone()[0]
+
+	def get_dead_letters(self, due=None, ids=None):
+		"""
+		Get events from the dead letter store, ordered.
+		:param due: float: timestamp: only events of objects whose next retry
+		is due at that time or None for all
+		:param ids: list: IDs of events to get or None for all
+		:return: list of DeadLetter
+		"""
+		sql = "SELECT id, module, dn, command, entry_uuid, old, new, created, attempts, error, next_retry FROM dead_letters"
+		args = []
+		if due is not None:
+			sql += " WHERE object_key IN (SELECT object_key FROM dead_letters GROUP BY object_key HAVING MIN(next_retry)<=?)"
+			args.append(due)
+		rows = self.db.execute(sql + " ORDER BY id", args).fetchall()
+		if ids is not None:
+			ids = set(ids)
+			rows = [row for row in rows if row[0] in ids]
+		return [DeadLetter(self._load(row[:9]), row[9], row[10]) for row in rows]
+
+	def next_dead_letter_retry(self):
+		"""
+		:return: float: timestamp of the next retry of the dead letter store
+		or None if it is empty
+		"""
+		return self.db.execute("SELECT MIN(next_retry) FROM dead_letters").fetchone()[0]
+
+	def set_dead_letters_failed(self, event_ids, error):
+		"""
+		Record another failed attempt of events in the dead letter store and
+		schedule the next retry with exponential backoff.
+		:param event_ids: list: IDs of events (of one object)
+		:param error: str: error message
+		:return: float: timestamp of next retry
+		"""
+		attempts = max(
+			self.db.execute("SELECT attempts FROM dead_letters WHERE id=?", (i,)).fetchone()[0] for i in event_ids)
+		next_retry = time.time() + min(DEAD_LETTER_MAX_DELAY, DEAD_LETTER_BASE_DELAY * 2 ** attempts)
+		with self.db:
+			self.db.executemany(
+				"UPDATE dead_letters SET attempts=attempts+1, error=?, next_retry=? WHERE id=?",
+				[(error, next_retry, i) for i in event_ids])
+		return next_retry
+
+	def retry_dead_letters(self, event_ids=None):
+		"""
+		Retry events in the dead letter store at the next run of the sync
+		worker (together with all other events of their objects).
+		:param event_ids: list: IDs of events or None for all
+		:return: int: number of events
+		"""
+		with self.db:
+			if event_ids is None:
+				return self.db.execute("UPDATE dead_letters SET next_retry=0").rowcount
+			return sum(self.db.execute(
+				"UPDATE dead_letters SET next_retry=0 WHERE object_key=(SELECT object_key FROM dead_letters WHERE id=?)",
+				(i,)).rowcount for i in event_ids)
+
+	def remove_dead_letters(self, *event_ids):
+		"""
+		Remove events from the dead letter store (processed or dropped).
+		:param event_ids: int: IDs of events
+		:return: int: number of removed events
+		"""
+		with self.db:
+			return sum(
+				self.db.execute("DELETE FROM dead_letters WHERE id=?", (i,)).rowcount for i in event_ids)
+
+	@staticmethod
+	def _dump(obj, attributes):
+		return json.dumps(dict((attr, obj[attr]) for attr in attributes if attr in (obj or {})))
+
+	@staticmethod
+	def _load(row):
+		# listener objects and DNs are byte strings, JSON and SQLite return unicode
+		def load(value):
+			return dict(
+				(attr.encode("utf-8"), [v.encode("utf-8") for v in values])
+				for attr, values in json.loads(value).items())
+
+		event = Event(*row)
+		return event._replace(
+			module=event.module.encode("utf-8"),
+			dn=event.dn.encode("utf-8"),
+			entry_uuid=event.entry_uuid and event.entry_uuid.encode("utf-8"),
+			command=event.command.encode("utf-8"),
+			old=load(event.old),
+			new=load(event.new))
+
+
+def get_object_key(module, entry_uuid, dn):
+	"""
+	Get the key that identifies the object of an event across renames.
+	:param module: str: name of listener module
+	:param entry_uuid: str: entryUUID of object or None
+	:param dn: str: DN of object
+	:return: str
+	"""
+	key = entry_uuid or dn
+	if isinstance(key, str):
+		key = key.decode("utf-8")
+	if not entry_uuid:
+		key = key.lower()
+	return u"{}:{}".format(module, key)
+
+
+def format_error(exc):
+	"""
+	:param exc: Exception
+	:return: str: error message for the dead letter store
+	"""
+	try:
+		msg = unicode(exc)
+	except UnicodeDecodeError:
+		msg = str(exc).decode("utf-8", "replace")
+	return u"{}: {}".format(exc.__class__.__name__, msg)
+
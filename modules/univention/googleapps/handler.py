@@ -32,15 +32,28 @@
 
 __package__ = ''  # workaround for PEP 366
 import json
+import socket
+import functools
 import random
 import string
 import re
+import sqlite3
 import time
+import urlparse
+from collections import Counter
+
+import httplib2
 
 from univention.lib.i18n import Translation
 from apiclient.errors import HttpError
-from univention.googleapps.auth import GappsAuth, GoogleAppError
+from apiclient.http import HttpRequest
+from univention.googleapps.auth import GappsAuth, GoogleAppError, PRIMARY_CREDENTIALS_NAME
+from univention.googleapps.cache import get_cached, CACHE_TTL
+from univention.googleapps.circuitbreaker import get_circuit_breaker, CLOSED, OPEN
 from univention.googleapps.logging2udebug import get_logger
+from univention.googleapps.mirror import DirectoryMirror
+from univention.googleapps.pool import PoolMember, ServicePool, QUOTA_ERROR_COOLDOWN
+from univention.googleapps.ratelimit import get_token_bucket
 
 
 _ = Translation('univention-googleapps').translate
@@ -71,6 +84,54 @@ class ForbiddenError(ApiError):
 	pass
 
 
+class CircuitOpenError(GoogleAppError):
+	pass
+
+
+BATCH_SIZE = 50  # Google allows up to 1000 calls per batch request
+
+# retry policy defaults, see google-apps/api/retry/*
+RETRY_ATTEMPTS = 5
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 32.0
+RETRY_DEADLINE = 120.0
+RETRY_STATUS = (429, 500, 502, 503, 504)
+RETRY_REASONS_403 = ("rateLimitExceeded", "userRateLimitExceeded", "quotaExceeded")
+# httplib2 errors that are retried like network errors (socket.error)
+RETRY_HTTPLIB2_ERRORS = (httplib2.ServerNotFoundError, httplib2.RedirectLimit)
+# retry reasons that are specific to the credentials used, see ServicePool
+QUOTA_REASONS = RETRY_REASONS_403 + ("HTTP 429",)
+
+# circuit breaker defaults, see google-apps/api/circuit-breaker/*
+CIRCUIT_BREAKER_THRESHOLD = 5
+CIRCUIT_BREAKER_RESET_TIMEOUT = 30.0
+# HTTP status codes that count as a failure of the API itself (like network errors)
+OUTAGE_STATUS = (500, 502, 503, 504)
+
+# number of retries per reason in this process
+retry_counter = Counter()
+
+# client side rate limits in calls per second, see google-apps/api/ratelimit/*
+RATE_LIMITS = dict(read=20, write=10, members=10)
+
+# Named presets for the "fields" argument of the get and list methods
+# (partial response: https://developers.google.com/admin-sdk/directory/v1/guides/performance#partial)
+FIELDS_PRESETS = {
+	"ids": dict(
+		users="id",
+		groups="id",
+		members="id"),
+	"membership": dict(
+		users="id,primaryEmail",
+		groups="id,email",
+		members="id,email,role,type,status"),
+	"sync-state": dict(
+		users="id,etag,primaryEmail,externalIds,suspended",
+		groups="id,etag,email,name,description",
+		members="id,etag,email,role,type,status"),
+}
+
+
 class GappsHandler(object):
 	"""
 	Abstraction of Googles Admin Directory API.
@@ -80,18 +141,40 @@ class GappsHandler(object):
 		self.listener = listener
 		self.logger = get_logger("google-apps", "gafw")
 		self.auth = GappsAuth(listener)
-		self.service = self.auth.get_service_object(service_name="admin", version="directory_v1")
+		members = [
+			PoolMember(name, service, http, self._get_rate_limiters(name))
+			for name, service, http in self.auth.get_service_pool(service_name="admin", version="directory_v1")
+		]
+		self.pool = ServicePool(
+			members,
+			self.auth.ucr.get("google-apps/api/credentials/strategy", "round-robin"),
+			float(self.auth.ucr.get("google-apps/api/credentials/cooldown", QUOTA_ERROR_COOLDOWN)))
+		# requests are built with the primary service object and executed with the HTTP object of any pool member
+		self.service = members[0].service
+		self.cache_ttl = int(self.auth.ucr.get("google-apps/cache/ttl", CACHE_TTL))
+		self.batch_size = int(self.auth.ucr.get("google-apps/api/batch/size", BATCH_SIZE))
+		self.retry_attempts = int(self.auth.ucr.get("google-apps/api/retry/attempts", RETRY_ATTEMPTS))
+		self.retry_base_delay = float(self.auth.ucr.get("google-apps/api/retry/base-delay", RETRY_BASE_DELAY))
+		self.retry_max_delay = float(self.auth.ucr.get("google-apps/api/retry/max-delay", RETRY_MAX_DELAY))
+		self.retry_deadline = float(self.auth.ucr.get("google-apps/api/retry/deadline", RETRY_DEADLINE))
+		self.rate_limiters = members[0].rate_limiters
+		self.circuit_breaker = get_directory_circuit_breaker(self.auth.ucr)
+		if self.auth.ucr.is_true("google-apps/mirror", False):
+			self.mirror = DirectoryMirror()
+		else:
+			self.mirror = None
 
-	def get_user(self, user_id, **kwargs):
+	def get_user(self, user_id, fields=None, **kwargs):
 		"""
 		Get a user from google directory.
 		:param user_id: str: user's primary email address, alias email address, or ID
+		:param fields: str: name of a preset in FIELDS_PRESETS or partial response field mask, None for all fields
 		:param kwargs: dict: all parameters that are allowed for the get() methods of the
 		user object (https://developers.google.com/admin-sdk/directory/v1/reference/users/get)
 		:return: dict: user
 		"""
 		key = dict(userKey=user_id)
-		return self._get_object("users", key)
+		return self._get_object("users", key, fields=fields, **kwargs)
 
 	def create_user(self, properties):
 		"""
@@ -105,30 +188,13 @@ class GappsHandler(object):
 		https://developers.google.com/admin-sdk/directory/v1/reference/users/insert
 		:return: dict: created user
 		"""
-		# check mandatory properties
-		try:
-			_ = properties["name"]
-			for attribute in ["givenName", "familyName"]:
-				try:
-					_ = properties["name"][attribute]
-				except KeyError:
-					self.logger.error("Mandatory property %r not supplied when creating user, using random string.",
-						attribute)
-					properties["name"][attribute] = self.get_random_ascii_string()
-		except KeyError:
-			self.logger.error("Mandatory property 'name' not supplied when creating user, creating random name.")
-			properties["name"] = dict(
-				givenName=self.get_random_ascii_string(),
-				familyName=self.get_random_ascii_string()
-			)
-		if not properties.get("password"):
-			properties["password"] = self.get_random_ascii_string(32)
-		properties["primaryEmail"] = self.fix_email(properties["primaryEmail"])
-
+		self._fix_user_properties(properties)
 		key = dict(userKey=properties["primaryEmail"])
-		return self._create_object("users", properties, modify_key=key)
+		user = self._create_object("users", properties, modify_key=key)
+		self._update_mirror("users", "insert", {user["id"]: user})
+		return user
 
-	def list_users(self, customer="my_customer", domain=None, **kwargs):
+	def list_users(self, customer="my_customer", domain=None, fields=None, **kwargs):
 		"""
 		Get list of users from google directory.
 		Paging is done by this method.
@@ -136,11 +202,22 @@ class GappsHandler(object):
 		represent the account's customerId, either customer or domain must be set
 		:param domain: str: get fields from only one domain, either customer or
 		domain must be set
+		:param fields: str: name of a preset in FIELDS_PRESETS or partial response
+		field mask of a single user, None for all fields
 		:param kwargs: dict: all parameters (except pageToken) that are documented in
 		https://developers.google.com/admin-sdk/directory/v1/reference/users/list
+		(e.g. maxResults: page size, 1-500)
 		:return: list of users (dicts)
 		"""
-		return self._list_objects("users", customer, domain, **kwargs)
+		return self._list_objects("users", customer, domain, fields=fields, **kwargs)
+
+	def iter_users(self, customer="my_customer", domain=None, fields=None, **kwargs):
+		"""
+		Get users from google directory, requesting the next page only when
+		the previous page has been consumed. See list_users() for arguments.
+		:return: generator of users (dicts)
+		"""
+		return self._iter_objects("users", customer, domain, fields=fields, **kwargs)
 
 	def list_groups_of_user(self, user_id):
 		"""
@@ -161,7 +238,9 @@ class GappsHandler(object):
 		if "primaryEmail" in properties:
 			properties["primaryEmail"] = self.fix_email(properties["primaryEmail"])
 		key = dict(userKey=user_id)
-		return self._modify_object("users", properties, key, method)
+		user = self._modify_object("users", properties, key, method)
+		self._update_mirror("users", method, {user_id: user})
+		return user
 
 	def delete_user(self, user_id):
 		"""
@@ -170,16 +249,63 @@ class GappsHandler(object):
 		:return: empty str or ResourceNotFoundError
 		"""
 		key = dict(userKey=user_id)
-		return self._delete_object("users", key)
+		try:
+			res = self._delete_object("users", key)
+		except ResourceNotFoundError:
+			self._update_mirror("users", "delete", {user_id: ""})
+			raise
+		self._update_mirror("users", "delete", {user_id: res})
+		return res
+
+	def batch_create_users(self, properties_list):
+		"""
+		Create users in the google directory using batch requests.
+		Users that exist will be modified instead.
+		See create_user() for the mandatory properties.
+		:param properties_list: list of dicts: properties as documented in
+		https://developers.google.com/admin-sdk/directory/v1/reference/users/insert
+		:return: dict: primaryEmail -> created user resource or exception (ApiError or HttpError)
+		"""
+		items = dict()
+		for properties in properties_list:
+			self._fix_user_properties(properties)
+			items[properties["primaryEmail"]] = (properties, dict(userKey=properties["primaryEmail"]))
+		return self._update_mirror("users", "insert", self._batch_create_objects("users", items))
 
-	def get_group(self, group_id):
+	def batch_modify_users(self, properties_by_id, method="patch"):
+		"""
+		Modify users in the google directory using batch requests.
+		:param properties_by_id: dict: user ID (or email address) -> dict: properties to change
+		:param method: str: see _modify_object()
+		:return: dict: user ID -> modified user resource or exception (ApiError or HttpError)
+		"""
+		calls = dict()
+		for user_id, properties in properties_by_id.items():
+			if "primaryEmail" in properties:
+				properties["primaryEmail"] = self.fix_email(properties["primaryEmail"])
+			calls[user_id] = dict(body=properties, userKey=user_id)
+		results = self._map_batch_results("users", method, self._execute_batch("users", method, calls))
+		return self._update_mirror("users", method, results)
+
+	def batch_delete_users(self, user_ids):
+		"""
+		Delete users using batch requests.
+		:param user_ids: list: primary email addresses, alias email addresses, or user IDs
+		:return: dict: user ID -> empty str or exception (ResourceNotFoundError or HttpError)
+		"""
+		calls = dict((user_id, dict(userKey=user_id)) for user_id in user_ids)
+		results = self._map_batch_results("users", "delete", self._execute_batch("users", "delete", calls))
+		return self._update_mirror("users", "delete", results)
+
+	def get_group(self, group_id, fields=None):
 		"""
 		Get a group from google directory.
 		:param group_id: str: group's email address, group alias, or ID
+		:param fields: str: name of a preset in FIELDS_PRESETS or partial response field mask, None for all fields
 		:return: dict: group resource
 		"""
 		key = dict(groupKey=group_id)
-		return self._get_object("groups", key)
+		return self._get_object("groups", key, fields=fields)
 
 	def create_group(self, email, description=None, name=None):
 		"""
@@ -193,9 +319,11 @@ class GappsHandler(object):
 		email = self.fix_email(email)
 		properties = dict(email=email, description=description, name=name)
 		key = dict(groupKey=email)
-		return self._create_object("groups", properties, modify_key=key)
+		group = self._create_object("groups", properties, modify_key=key)
+		self._update_mirror("groups", "insert", {group["id"]: group})
+		return group
 
-	def list_groups(self, customer="my_customer", domain=None, **kwargs):
+	def list_groups(self, customer="my_customer", domain=None, fields=None, **kwargs):
 		"""
 		Get list of groups from google directory.
 		Paging is done by this method.
@@ -203,12 +331,23 @@ class GappsHandler(object):
 		represent the account's customerId, either customer or domain must be set
 		:param domain: str: get fields from only one domain, either customer or
 		domain must be set
+		:param fields: str: name of a preset in FIELDS_PRESETS or partial response
+		field mask of a single group, None for all fields
 		:param kwargs: dict: all parameters (except pageToken) that are documented in
 		https://developers.google.com/admin-sdk/directory/v1/reference/groups/list
+		(e.g. maxResults: page size, 1-200)
 		Don't use the 'userKey' argument, use list_groups_of_user() instead.
 		:return: list of groups (dicts)
 		"""
-		return self._list_objects("groups", customer, domain, **kwargs)
+		return self._list_objects("groups", customer, domain, fields=fields, **kwargs)
+
+	def iter_groups(self, customer="my_customer", domain=None, fields=None, **kwargs):
+		"""
+		Get groups from google directory, requesting the next page only when
+		the previous page has been consumed. See list_groups() for arguments.
+		:return: generator of groups (dicts)
+		"""
+		return self._iter_objects("groups", customer, domain, fields=fields, **kwargs)
 
 	def modify_group(self, group_id, email=None, description=None, name=None, method="patch"):
 		"""
@@ -231,7 +370,9 @@ class GappsHandler(object):
 		else:
 			properties = dict(email=self.fix_email(email), description=description, name=name)
 		key = dict(groupKey=group_id)
-		return self._modify_object("groups", properties, key, method)
+		group = self._modify_object("groups", properties, key, method)
+		self._update_mirror("groups", method, {group_id: group})
+		return group
 
 	def delete_group(self, group_id):
 		"""
@@ -240,26 +381,71 @@ class GappsHandler(object):
 		:return: empty str or ResourceNotFoundError
 		"""
 		key = dict(groupKey=group_id)
-		return self._delete_object("groups", key)
+		try:
+			res = self._delete_object("groups", key)
+		except ResourceNotFoundError:
+			self._update_mirror("groups", "delete", {group_id: ""})
+			raise
+		self._update_mirror("groups", "delete", {group_id: res})
+		return res
 
-	def list_members_of_group(self, group_id):
+	def batch_create_groups(self, groups):
+		"""
+		Create groups in the google directory using batch requests.
+		Groups that exist will be modified instead.
+		:param groups: list of dicts with keys "email" and optionally "description" and "name"
+		:return: dict: email -> created group resource or exception (ApiError or HttpError)
+		"""
+		items = dict()
+		for group in groups:
+			email = self.fix_email(group["email"])
+			properties = dict(email=email, description=group.get("description"), name=group.get("name"))
+			items[email] = (properties, dict(groupKey=email))
+		return self._update_mirror("groups", "insert", self._batch_create_objects("groups", items))
+
+	def batch_delete_groups(self, group_ids):
+		"""
+		Delete groups using batch requests.
+		:param group_ids: list: group's email addresses, group aliases, or group IDs
+		:return: dict: group ID -> empty str or exception (ResourceNotFoundError or HttpError)
+		"""
+		calls = dict((group_id, dict(groupKey=group_id)) for group_id in group_ids)
+		results = self._map_batch_results("groups", "delete", self._execute_batch("groups", "delete", calls))
+		return self._update_mirror("groups", "delete", results)
+
+	def list_members_of_group(self, group_id, fields=None, **kwargs):
 		"""
 		Get list of member of a group from google directory.
 		Paging is done by this method.
 		:param group_id: str: group's email address, group alias, or group ID
+		:param fields: str: name of a preset in FIELDS_PRESETS or partial response
+		field mask of a single member, None for all fields
+		:param kwargs: dict: all parameters (except pageToken) that are documented in
+		https://developers.google.com/admin-sdk/directory/v1/reference/members/list
+		(e.g. maxResults: page size, 1-200)
 		:return: list of dicts of member ressources
 		"""
-		return self._list_objects("members", groupKey=group_id)
+		return self._list_objects("members", groupKey=group_id, fields=fields, **kwargs)
 
-	def get_member_of_group(self, group_id, member_id):
+	def iter_members(self, group_id, fields=None, **kwargs):
+		"""
+		Get members of a group from google directory, requesting the next
+		page only when the previous page has been consumed.
+		See list_members_of_group() for arguments.
+		:return: generator of dicts of member ressources
+		"""
+		return self._iter_objects("members", groupKey=group_id, fields=fields, **kwargs)
+
+	def get_member_of_group(self, group_id, member_id, fields=None):
 		"""
 		Retrieve a single group member.
 		:param group_id: string: group's email address, group alias, or group ID
 		:param member_id: user's primary email address, alias email address, or ID
+		:param fields: str: name of a preset in FIELDS_PRESETS or partial response field mask, None for all fields
 		:return: dict: member ressource
 		"""
 		key = dict(groupKey=group_id)
-		return self._get_object("members", key, memberKey=member_id)
+		return self._get_object("members", key, fields=fields, memberKey=member_id)
 
 	def add_member_to_group(self, group_id, obj_id, role="MEMBER"):
 		"""
@@ -271,7 +457,21 @@ class GappsHandler(object):
 		"""
 		modify_args = dict(memberKey=obj_id)
 		properties = dict(id=obj_id, role=role)
-		return self._create_object("members", properties, modify_args, groupKey=group_id)
+		member = self._create_object("members", properties, modify_args, groupKey=group_id)
+		self._update_mirror("members", "insert", {obj_id: member}, group_id)
+		return member
+
+	def batch_add_members(self, group_id, obj_ids, role="MEMBER"):
+		"""
+		Add users or groups to a group using batch requests.
+		:param group_id: str: group's email address, group alias, or group ID
+		:param obj_ids: list: user's or groups primary email addresses, alias email addresses, or IDs
+		:param role: str: "MANAGER", "MEMBER" or "OWNER"
+		:return: dict: object ID -> member resource or exception (ApiError or HttpError)
+		"""
+		items = dict((obj_id, (dict(id=obj_id, role=role), dict(memberKey=obj_id))) for obj_id in obj_ids)
+		results = self._batch_create_objects("members", items, groupKey=group_id)
+		return self._update_mirror("members", "insert", results, group_id)
 
 	def wait_for_group_member_to_appear(self, group_id, obj_id, timeout=10.0, interval=0.5):
 		"""
@@ -301,19 +501,50 @@ class GappsHandler(object):
 		"""
 		Common code for wait_for_group_member_to_appear() / wait_for_group_member_to_disappear().
 		"""
-		i = 0
-		while i < timeout:
-			google_users = self.list_members_of_group(group_id)
-			google_user_ids = [g['id'] for g in google_users]
-			if (appear and obj_id in google_user_ids) or (not appear and obj_id not in google_user_ids):
-				return True
-			time.sleep(interval)
-			i += interval
-		self.logger.warn(
-			'User %r did not %sappear in group %r after %r seconds.',
-			obj_id, '' if appear else 'dis', group_id, timeout
-		)
-		return False
+		if appear:
+			res = self.wait_for_group_members(group_id, appear=[obj_id], timeout=timeout, interval=interval)
+		else:
+			res = self.wait_for_group_members(group_id, disappear=[obj_id], timeout=timeout, interval=interval)
+		return res[obj_id]
+
+	def wait_for_group_members(self, group_id, appear=(), disappear=(), timeout=10.0, interval=0.5, max_interval=4.0):
+		"""
+		Wait for members to appear in and disappear from a group.
+
+		All members are checked against a single listing of the group per
+		poll. The time between polls doubles after each poll, up to max_interval.
+
+		:param group_id: str: group's email address, group alias, or group ID
+		:param appear: list: IDs of users or groups that should become members
+		:param disappear: list: IDs of users or groups that should not be members anymore
+		:param timeout: float: seconds to wait before giving up
+		:param interval: float: seconds to wait after the first poll
+		:param max_interval: float: maximum seconds to wait between polls
+		:return: dict: member ID -> bool: whether the member (dis)appeared in the group
+		"""
+		pending_appear = set(appear)
+		pending_disappear = set(disappear)
+		results = dict((obj_id, False) for obj_id in pending_appear | pending_disappear)
+		start = time.time()
+		polls = 0
+		while pending_appear or pending_disappear:
+			member_ids = set(m["id"] for m in self.iter_members(group_id, fields="ids", maxResults=200))
+			polls += 1
+			for obj_id in (pending_appear & member_ids) | (pending_disappear - member_ids):
+				results[obj_id] = True
+			pending_appear -= member_ids
+			pending_disappear &= member_ids
+			remaining = timeout - (time.time() - start)
+			if not (pending_appear or pending_disappear) or remaining <= 0:
+				break
+			time.sleep(min(interval, remaining))
+			interval = min(interval * 2, max_interval)
+		if pending_appear or pending_disappear:
+			self.logger.warn(
+				'After %r seconds (%d polls) in group %r members %r did not appear and %r did not disappear.',
+				timeout, polls, group_id, sorted(pending_appear), sorted(pending_disappear)
+			)
+		return results
 
 	def delete_member_from_group(self, group_id, obj_id):
 		"""
@@ -323,23 +554,92 @@ class GappsHandler(object):
 		:return: None
 		"""
 		key = dict(groupKey=group_id)
-		return self._delete_object("members", key=key, memberKey=obj_id)
+		try:
+			res = self._delete_object("members", key=key, memberKey=obj_id)
+		except ResourceNotFoundError:
+			self._update_mirror("members", "delete", {obj_id: ""}, group_id)
+			raise
+		self._update_mirror("members", "delete", {obj_id: res}, group_id)
+		return res
+
+	def batch_delete_members(self, group_id, obj_ids):
+		"""
+		Remove users or groups from a group using batch requests.
+		:param group_id: str: group's email address, group alias, or group ID
+		:param obj_ids: list: user's or groups primary email addresses, alias email addresses, or IDs
+		:return: dict: object ID -> empty str or exception (ResourceNotFoundError or HttpError)
+		"""
+		calls = dict((obj_id, dict(groupKey=group_id, memberKey=obj_id)) for obj_id in obj_ids)
+		results = self._map_batch_results("members", "delete", self._execute_batch("members", "delete", calls))
+		return self._update_mirror("members", "delete", results, group_id)
+
+	def find_user_id(self, external_id):
+		"""
+		Find a user by the entryUUID or entryDN stored in its externalIds.
+		The directory mirror (google-apps/mirror) is asked first. An ID from
+		the mirror is checked with a get() call, as the user may have been
+		deleted (and recreated) since the last refresh of the mirror. The
+		Google directory is searched if the user is not in the mirror.
+		:param external_id: str: entryUUID or entryDN
+		:return: str: ID of user or None if not found
+		"""
+		if self.mirror is not None:
+			try:
+				user_id = self.mirror.find_user_id(external_id)
+			except sqlite3.Error as exc:
+				self.logger.error("Could not read directory mirror: %s", exc)
+				user_id = None
+			if user_id:
+				try:
+					return self.get_user(user_id, fields="ids")["id"]
+				except ResourceNotFoundError:
+					self.logger.info("User %r from directory mirror does not exist anymore, searching.", user_id)
+					try:
+						self.mirror.remove_user(user_id)
+					except sqlite3.Error as exc:
+						self.logger.error("Could not update directory mirror: %s", exc)
+		user = next(self.iter_users(query="externalId={}".format(external_id), fields="ids", maxResults=1), None)
+		return user["id"] if user else None
+
+	def group_has_members(self, group_id):
+		"""
+		Check if a group has members. If the directory mirror
+		(google-apps/mirror) knows members of the group, the Google directory
+		is not asked. An empty group in the mirror is always confirmed with
+		the Google directory, as callers delete empty groups.
+		:param group_id: str: ID of group
+		:return: bool: whether the group has at least one member
+		"""
+		if self.mirror is not None:
+			try:
+				if self.mirror.get_member_ids(group_id):
+					return True
+			except sqlite3.Error as exc:
+				self.logger.error("Could not read directory mirror: %s", exc)
+		return next(self.iter_members(group_id, fields="ids", maxResults=1), None) is not None
 
 	def get_customer_id(self):
 		"""
 		Fetches the customerId - expecting a single-tenant
+		The value is cached for google-apps/cache/ttl seconds.
 		:return: str
 		"""
-		return self.list_users(maxResults=1)[0]["customerId"]
+		return get_cached(
+			"customerId",
+			lambda: next(self.iter_users(maxResults=1, fields="customerId"))["customerId"],
+			self.cache_ttl)
 
 	def list_domains(self):
 		"""
 		Retrieves the list of registered domains.
+		The list is cached for google-apps/cache/ttl seconds, don't modify it.
 		:return: list of dicts (domain resource:
 		https://developers.google.com/admin-sdk/directory/v1/reference/domains)
 		"""
-		customer_id = self.get_customer_id()
-		return self._list_objects("domains", customer=customer_id)
+		return get_cached(
+			"domains",
+			lambda: self._list_objects("domains", customer=self.get_customer_id()),
+			self.cache_ttl)
 
 	def get_primary_domain_from_google(self, verified=True):
 		"""
@@ -360,9 +660,10 @@ class GappsHandler(object):
 	def get_primary_domain_from_disk(self):
 		"""
 		Gert domain name that was configured in wizard.
+		The value is cached until the credentials file changes.
 		:return: str: domain name
 		"""
-		return self.auth.get_domain()
+		return get_cached("domain", self.auth.get_domain, self.cache_ttl)
 
 	def fix_email(self, email):
 		"""
@@ -370,8 +671,6 @@ class GappsHandler(object):
 		:param email: str: email address to check
 		:return: str: possibly modified email address
 		"""
-		# TODO: impl. (mem)cache, ~5min for domains
-
 		m = re.match(r"(.*)@([^@]*)", email)
 		if m:
 			local_part, domain_part = m.groups()
@@ -395,22 +694,53 @@ class GappsHandler(object):
 		"""
 		return "".join([random.choice(string.ascii_letters + string.digits) for _ in range(length)])
 
-	def _get_object(self, object_type, key, **kwargs):
+	def _fix_user_properties(self, properties):
+		"""
+		Add missing mandatory properties to a user resource, fix its email address.
+		Works in-place!
+		:param properties: dict: properties as documented in
+		https://developers.google.com/admin-sdk/directory/v1/reference/users/insert
+		:return: None
+		"""
+		# check mandatory properties
+		try:
+			_ = properties["name"]
+			for attribute in ["givenName", "familyName"]:
+				try:
+					_ = properties["name"][attribute]
+				except KeyError:
+					self.logger.error("Mandatory property %r not supplied when creating user, using random string.",
+						attribute)
+					properties["name"][attribute] = self.get_random_ascii_string()
+		except KeyError:
+			self.logger.error("Mandatory property 'name' not supplied when creating user, creating random name.")
+			properties["name"] = dict(
+				givenName=self.get_random_ascii_string(),
+				familyName=self.get_random_ascii_string()
+			)
+		if not properties.get("password"):
+			properties["password"] = self.get_random_ascii_string(32)
+		properties["primaryEmail"] = self.fix_email(properties["primaryEmail"])
+
+	def _get_object(self, object_type, key, fields=None, **kwargs):
 		"""
 		Retrieve object from google directory.
 		(Tested only for users, groups and members.)
 		:param object_type: str: "users", "groups" or "members"
 		:param key: dict: with a single key->value used to identify object
+		:param fields: str: name of a preset in FIELDS_PRESETS or partial response field mask, None for all fields
 		:param kwargs: dict: all parameters that are allowed for the get()
 		methods of the respective objects
 		:return: dict (object_type resources)
 		"""
-		self.logger.debug("object_type=%r key=%r kwargs=%r", object_type, key, kwargs)
+		self.logger.debug("object_type=%r key=%r fields=%r kwargs=%r", object_type, key, fields, kwargs)
 		kwargs.update(key)
 		kwargs["prettyPrint"] = False
+		if fields:
+			kwargs["fields"] = self._get_fields(object_type, fields)
 
 		try:
-			return getattr(self.service, object_type)().get(**kwargs).execute()
+			return self._execute(getattr(self.service, object_type)().get(**kwargs))
 		except HttpError as exc:
 			if exc.resp.status == 404:
 				raise ResourceNotFoundError(http_error=exc)
@@ -432,7 +762,23 @@ class GappsHandler(object):
 		list() methods of the respective objects
 		:return: list dicts (object_type resources)
 		"""
-		self.logger.debug("object_type=%r customer=%r domain=%r kwargs=%r", object_type, customer, domain, kwargs)
+		return list(self._iter_objects(object_type, customer, domain, **kwargs))
+
+	def _iter_objects(self, object_type, customer=None, domain=None, fields=None, **kwargs):
+		"""
+		Retrieve objects from google directory page by page.
+		Arguments are checked immediately, pages are requested while iterating.
+		(Tested only for users, groups and members.)
+		:param object_type: str: "users", "groups" or "members"
+		:param customer: str: see _list_objects()
+		:param domain: str: see _list_objects()
+		:param fields: str: name of a preset in FIELDS_PRESETS or partial response
+		field mask of a single object, None for all fields
+		:param kwargs: dict: see _list_objects()
+		:return: generator of dicts (object_type resources)
+		"""
+		self.logger.debug("object_type=%r customer=%r domain=%r fields=%r kwargs=%r", object_type, customer, domain,
+			fields, kwargs)
 		if object_type == "users" and not (customer or domain):
 			raise BadArgumentError("GappsHandler._list_objects(object_type='{}', customer='{}', domain='{}', kwargs={}):"
 				"either customer or domain must be set.".format(object_type, customer, domain, kwargs))
@@ -443,14 +789,22 @@ class GappsHandler(object):
 			kwargs["customer"] = customer
 		if domain:
 			kwargs["domain"] = domain
+		if fields:
+			kwargs["fields"] = "nextPageToken,{}({})".format(object_type, self._get_fields(object_type, fields))
 		kwargs["prettyPrint"] = False
+		return self._iter_pages(object_type, kwargs)
 
-		objs = list()
+	def _iter_pages(self, object_type, kwargs):
+		"""
+		Generator used by _iter_objects().
+		:param object_type: str: "users", "groups" or "members"
+		:param kwargs: dict: arguments for the list() method of the respective objects
+		:return: generator of dicts (object_type resources)
+		"""
 		while True:
 			try:
-				results = getattr(self.service, object_type)().list(**kwargs).execute()
+				results = self._execute(getattr(self.service, object_type)().list(**kwargs))
 			except HttpError as exc:
-				results = dict()
 				if exc.resp.status == 403:
 					raise ForbiddenError(
 						_('API Access forbidden: Either the Admin Directory API has not been configured in the developers-console or the scopes were not configured in the admin-console. Please rerun the wizard.'),
@@ -459,16 +813,15 @@ class GappsHandler(object):
 				elif exc.resp.status == 404:
 					raise ResourceNotFoundError(http_error=exc)
 				else:
-					self.logger.exception("Error listing, object_type=%r customer=%r domain=%r kwargs=%r.",
-						object_type, customer, domain, kwargs)
+					self.logger.exception("Error listing, object_type=%r kwargs=%r.", object_type, kwargs)
 					raise
-			objs.extend(results.get(object_type, []))
+			for obj in results.get(object_type, []):
+				yield obj
 			next_page_token = results.get("nextPageToken")
 			if next_page_token:
 				kwargs["pageToken"] = next_page_token
 			else:
 				break
-		return objs
 
 	def _create_object(self, object_type, properties, modify_key, **kwargs):
 		"""
@@ -485,7 +838,7 @@ class GappsHandler(object):
 			kwargs)
 		kwargs["prettyPrint"] = False
 		try:
-			return getattr(self.service, object_type)().insert(body=properties, **kwargs).execute()
+			return self._execute(getattr(self.service, object_type)().insert(body=properties, **kwargs))
 		except HttpError as exc:
 			if exc.resp.status == 409:
 				# "Entity already exists."
@@ -494,13 +847,8 @@ class GappsHandler(object):
 			elif exc.resp.status == 412:
 				# PRECONDITION_FAILED / conditionNotMet
 				# probably a license limit was reached
-				if "application/json" in exc.resp["content-type"]:
-					content = json.loads(exc.content)
-					error = content.get("error")
-					try:
-						message = error["message"]
-					except KeyError:
-						message = str(error)
+				message = self._get_error_message(exc)
+				if message is not None:
 					self.logger.exception("Could not create %r: %r", object_type[:-1], message)
 					if "limit" in message:
 						raise LimitReachedError(http_error=exc)
@@ -532,7 +880,7 @@ class GappsHandler(object):
 		kwargs.update(key)
 		self.logger.debug("kwargs=%r", kwargs)
 		try:
-			return meth(body=properties, **kwargs).execute()
+			return self._execute(meth(body=properties, **kwargs))
 		except HttpError as exc:
 			if exc.resp.status == 404:
 				raise ResourceNotFoundError(http_error=exc)
@@ -553,9 +901,374 @@ class GappsHandler(object):
 		kwargs["prettyPrint"] = False
 		kwargs.update(key)
 		try:
-			return getattr(self.service, object_type)().delete(**kwargs).execute()
+			return self._execute(getattr(self.service, object_type)().delete(**kwargs))
 		except HttpError as exc:
 			if exc.resp.status == 404:
 				raise ResourceNotFoundError(http_error=exc)
 			self.logger.exception("HttpError %d trying to delete %r with  key %r.", exc.resp.status, object_type, key)
 			raise
+
+	def _execute(self, request, member=None):
+		"""
+		Execute an API request. Retry it with exponential backoff and full
+		jitter if it failed because of a quota limit or a transient error.
+		Gives up after google-apps/api/retry/attempts retries or when the
+		next try would start later than google-apps/api/retry/deadline
+		seconds after the first.
+		The credentials to use are selected from the pool for each try. After
+		a quota error the request is retried without delay if the pool has
+		credentials that had no recent quota error.
+		:param request: HttpRequest or BatchHttpRequest
+		:param member: PoolMember: credentials to use for all tries (requests
+		in a batch request are bound to the credentials they were built with)
+		:return: response of request
+		"""
+		deadline = time.time() + self.retry_deadline
+		attempt = 0
+		while True:
+			use_member = member or self.pool.select()
+			if isinstance(request, HttpRequest):
+				# batch requests are rate limited in _execute_batch()
+				path = urlparse.urlparse(request.uri).path
+				self._rate_limit("members" in path.split("/"), request.method == "GET", member=use_member)
+			self._check_circuit(use_member)
+			try:
+				response = request.execute(http=use_member.http)
+			except (HttpError, socket.error, httplib2.HttpLib2Error) as exc:
+				self._record_call_result(exc)
+				reason = self._get_retry_reason(exc)
+				if not reason:
+					raise
+				delay = self._get_retry_delay(exc, attempt)
+				if reason in QUOTA_REASONS:
+					self.pool.report_quota_error(use_member)
+					if member is None and any(self.pool.is_healthy(m) for m in self.pool.members):
+						self.logger.info("Quota error with credentials %r, switching credentials.", use_member.name)
+						delay = 0.0
+				attempt += 1
+				if attempt > self.retry_attempts or time.time() + delay > deadline:
+					self.logger.error("Giving up after %d tries (%s): %s", attempt, reason, exc)
+					raise
+				self._count_retry([reason], attempt, delay)
+				time.sleep(delay)
+			else:
+				self._record_call_result(None)
+				return response
+
+	def _check_circuit(self, member):
+		"""
+		Fail fast while the circuit breaker is open (the Google API was
+		unreachable for google-apps/api/circuit-breaker/threshold calls in a
+		row). When a probe is due, make a cheap call to check if the API is
+		reachable again.
+		:param member: PoolMember: credentials to probe with
+		:return: None
+		:raises CircuitOpenError: if the API is (still) unreachable
+		"""
+		state = self.circuit_breaker.allow_request()
+		if state == CLOSED:
+			return
+		if state == OPEN:
+			raise CircuitOpenError("The Google API is unreachable, not trying again before {}.".format(
+				time.strftime("%H:%M:%S", time.localtime(self.circuit_breaker.retry_at()))))
+		self.logger.info("Checking if the Google API is reachable again.")
+		try:
+			self.service.users().list(
+				customer="my_customer", maxResults=1, fields="users(id)", prettyPrint=False).execute(http=member.http)
+		except (HttpError, socket.error, httplib2.HttpLib2Error) as exc:
+			self._record_call_result(exc)
+			if self._is_outage(exc):
+				raise CircuitOpenError("The Google API is still unreachable: {}".format(exc))
+		else:
+			self._record_call_result(None)
+
+	def _record_call_result(self, exc):
+		"""
+		Report the result of a call to the circuit breaker. Only network
+		errors and server errors count as failures, any other response shows
+		that the API is reachable.
+		:param exc: exception of failed call or None
+		:return: None
+		"""
+		if exc is not None and self._is_outage(exc):
+			if self.circuit_breaker.record_failure():
+				self.logger.error(
+					"The Google API failed %d times in a row (%s), failing fast for the next %.0fs.",
+					self.circuit_breaker.threshold, exc, self.circuit_breaker.reset_timeout)
+		elif self.circuit_breaker.record_success():
+			self.logger.info("The Google API is reachable again.")
+
+	@staticmethod
+	def _is_outage(exc):
+		"""
+		:param exc: HttpError, socket.error or httplib2.HttpLib2Error
+		:return: bool: whether the error indicates that the API is down or unreachable
+		"""
+		if isinstance(exc, HttpError):
+			return exc.resp.status in OUTAGE_STATUS
+		return isinstance(exc, (socket.error,) + RETRY_HTTPLIB2_ERRORS)
+
+	def _rate_limit(self, members, read, calls=1, member=None):
+		"""
+		Wait until the client side rate limit allows the next call(s).
+		:param members: bool: if the call is for the members resource
+		:param read: bool: if the call only reads data
+		:param calls: int: number of calls (in a batch request)
+		:param member: PoolMember: credentials the call is made with, None for the primary credentials
+		:return: None
+		"""
+		name = "members" if members else "read" if read else "write"
+		rate_limiters = member.rate_limiters if member else self.rate_limiters
+		waited = rate_limiters[name].acquire(calls)
+		if waited:
+			self.logger.debug("Rate limit %r: waited %.2fs for %d call(s).", name, waited, calls)
+
+	def _get_rate_limiters(self, credentials_name):
+		"""
+		Get the process wide rate limiters of a credential, see google-apps/api/ratelimit/*.
+		The limits apply to each credential separately.
+		:param credentials_name: str: name of credentials, see GappsAuth.list_credentials_files()
+		:return: dict: name -> TokenBucket
+		"""
+		rate_limiters = dict()
+		for name, default in RATE_LIMITS.items():
+			rate = float(self.auth.ucr.get("google-apps/api/ratelimit/{}".format(name), default))
+			burst = float(self.auth.ucr.get("google-apps/api/ratelimit/{}/burst".format(name), rate))
+			if credentials_name == PRIMARY_CREDENTIALS_NAME:
+				bucket_name = name
+			else:
+				bucket_name = "{}/{}".format(credentials_name, name)
+			rate_limiters[name] = get_token_bucket(bucket_name, rate, burst)
+		return rate_limiters
+
+	def _get_retry_reason(self, exc):
+		"""
+		Check if a failed request should be retried.
+		:param exc: HttpError, socket.error or httplib2.HttpLib2Error
+		:return: str: reason for retrying or None if the request should not be retried
+		"""
+		if isinstance(exc, (socket.error,) + RETRY_HTTPLIB2_ERRORS):
+			return "transport error"
+		if isinstance(exc, httplib2.HttpLib2Error):
+			return None
+		if exc.resp.status in RETRY_STATUS:
+			return "HTTP {}".format(exc.resp.status)
+		if exc.resp.status == 403:
+			reason = self._get_error_reason(exc)
+			if reason in RETRY_REASONS_403:
+				return reason
+		return None
+
+	def _get_retry_delay(self, exc, attempt):
+		"""
+		Calculate the time to wait before the next try: exponential backoff
+		with full jitter, but not less than the Retry-After header demands.
+		:param exc: HttpError or socket.error or None
+		:param attempt: int: number of retries already done
+		:return: float: seconds
+		"""
+		delay = random.uniform(0, min(self.retry_max_delay, self.retry_base_delay * 2 ** attempt))
+		try:
+			retry_after = float(exc.resp["retry-after"])
+		except (AttributeError, KeyError, TypeError, ValueError):
+			# no HttpError or header missing or not in seconds (HTTP-date)
+			return delay
+		return max(delay, retry_after)
+
+	def _count_retry(self, reasons, attempt, delay):
+		"""
+		Record retries in retry_counter and log them.
+		:param reasons: list: str: reason of each call that will be retried
+		:param attempt: int: number of the retry
+		:param delay: float: seconds until the retry
+		:return: None
+		"""
+		retry_counter.update(reasons)
+		self.logger.warn("%d Google API call(s) failed (%s), retry %d/%d in %.1fs. Retries in this process: %s",
+			len(reasons), ", ".join(sorted(set(reasons))), attempt, self.retry_attempts, delay,
+			", ".join("{}={}".format(k, v) for k, v in sorted(retry_counter.items())))
+
+	def _execute_batch(self, object_type, method, calls):
+		"""
+		Execute API calls of the same kind using batch requests of at most
+		google-apps/api/batch/size calls each.
+		(Tested only for users, groups and members.)
+		:param object_type: str: "users", "groups" or "members"
+		:param method: str: method of the resource to call ("insert", "patch", "delete" etc)
+		:param calls: dict: item key -> dict: arguments for the method
+		:return: dict: item key -> response or HttpError
+		"""
+		self.logger.debug("object_type=%r method=%r len(calls)=%d", object_type, method, len(calls))
+		results = dict()
+
+		def callback(request_id, response, exception, _keys=None):
+			results[_keys[int(request_id)]] = exception if exception else response
+
+		deadline = time.time() + self.retry_deadline
+		attempt = 0
+		keys = list(calls)
+		members = dict()  # item key -> PoolMember used for last try
+		while True:
+			for start in range(0, len(keys), self.batch_size):
+				chunk = keys[start:start + self.batch_size]
+				member = self.pool.select()
+				batch = member.service.new_batch_http_request(callback=functools.partial(callback, _keys=chunk))
+				for num, key in enumerate(chunk):
+					kwargs = dict(calls[key], prettyPrint=False)
+					batch.add(getattr(getattr(member.service, object_type)(), method)(**kwargs), request_id=str(num))
+					members[key] = member
+				self._rate_limit(object_type == "members", method in ("get", "list"), len(chunk), member=member)
+				self._execute(batch, member)
+			# retry the calls that failed because of a quota limit or a transient error
+			retry = [(key, self._get_retry_reason(results[key])) for key in keys if isinstance(results[key], HttpError)]
+			keys = [key for key, reason in retry if reason]
+			if not keys:
+				return results
+			for member in set(members[key] for key, reason in retry if reason in QUOTA_REASONS):
+				self.pool.report_quota_error(member)
+			delay = max(self._get_retry_delay(results[key], attempt) for key in keys)
+			attempt += 1
+			if attempt > self.retry_attempts or time.time() + delay > deadline:
+				self.logger.error("Giving up on %d calls of batch request after %d tries.", len(keys), attempt)
+				return results
+			self._count_retry([reason for key, reason in retry if reason], attempt, delay)
+			time.sleep(delay)
+
+	def _batch_create_objects(self, object_type, items, **kwargs):
+		"""
+		Create objects in the google directory using batch requests, modify
+		those that exist.
+		(Tested only for users, groups and members.)
+		:param object_type:  str: "users", "groups" or "members"
+		:param items: dict: item key -> tuple (properties, modify_key), see _create_object()
+		:param kwargs: dict: additional arguments to pass to all insert and patch calls
+		:return: dict: item key -> resource of created object or exception (ApiError or HttpError)
+		"""
+		calls = dict((key, dict(kwargs, body=properties)) for key, (properties, modify_key) in items.items())
+		results = self._execute_batch(object_type, "insert", calls)
+		existing = [key for key, result in results.items() if isinstance(result, HttpError) and result.resp.status == 409]
+		if existing:
+			# "Entity already exists."
+			self.logger.info("%d %r exist, modifying instead.", len(existing), object_type)
+			calls = dict()
+			for key in existing:
+				properties, modify_key = items[key]
+				calls[key] = dict(kwargs, body=properties, **modify_key)
+			results.update(self._execute_batch(object_type, "patch", calls))
+		return self._map_batch_results(object_type, "insert", results)
+
+	def _map_batch_results(self, object_type, method, results):
+		"""
+		Replace HttpErrors in the results of a batch request with the
+		exceptions the non-batch methods would raise.
+		:param object_type: str: "users", "groups" or "members"
+		:param method: str: method of the resource that was called
+		:param results: dict: item key -> response or HttpError
+		:return: dict: item key -> response or exception (ApiError or HttpError)
+		"""
+		for key, result in results.items():
+			if not isinstance(result, HttpError):
+				continue
+			if result.resp.status == 404:
+				results[key] = ResourceNotFoundError(http_error=result)
+				continue
+			message = self._get_error_message(result)
+			self.logger.error("HttpError %d in batch request %s.%s() for %r: %r", result.resp.status, object_type,
+				method, key, message)
+			if result.resp.status == 412 and "limit" in (message or ""):
+				# PRECONDITION_FAILED / conditionNotMet: probably a license limit was reached
+				results[key] = LimitReachedError(http_error=result)
+		return results
+
+	def _update_mirror(self, object_type, method, results, group_id=None):
+		"""
+		Write the results of successful calls to the directory mirror, if
+		enabled. The mirror is a cache: errors are logged and ignored, the
+		next refresh corrects it.
+		:param object_type: str: "users", "groups" or "members"
+		:param method: str: method of the resource that was called
+		:param results: dict: item key -> resource, empty str (delete) or exception
+		:param group_id: str: ID of group (for object_type "members")
+		:return: dict: results, unchanged
+		"""
+		if self.mirror is None:
+			return results
+		try:
+			for key, result in results.items():
+				if method == "delete":
+					if isinstance(result, Exception) and not isinstance(result, ResourceNotFoundError):
+						continue
+					if object_type == "users":
+						self.mirror.remove_user(key)
+					elif object_type == "groups":
+						self.mirror.remove_group(key)
+					else:
+						self.mirror.remove_members(group_id, [key])
+				elif not isinstance(result, Exception):
+					if object_type == "users":
+						self.mirror.store_user(result)
+					elif object_type == "groups":
+						self.mirror.store_group(result)
+					else:
+						self.mirror.add_members(group_id, [result.get("id", key)])
+		except sqlite3.Error as exc:
+			self.logger.error("Could not update directory mirror: %s", exc)
+		return results
+
+	@staticmethod
+	def _get_fields(object_type, fields):
+		"""
+		Resolve the name of a partial response preset.
+		:param object_type: str: "users", "groups" or "members"
+		:param fields: str: name of a preset in FIELDS_PRESETS or a field mask
+		:return: str: field mask of a single object
+		"""
+		try:
+			return FIELDS_PRESETS[fields][object_type]
+		except KeyError:
+			return fields
+
+	@staticmethod
+	def _get_error_reason(exc):
+		"""
+		Extract the reason of the first error from a HttpError.
+		:param exc: HttpError
+		:return: str: reason (e.g. "rateLimitExceeded") or None
+		"""
+		if "application/json" not in exc.resp.get("content-type", ""):
+			return None
+		try:
+			return json.loads(exc.content)["error"]["errors"][0]["reason"]
+		except (ValueError, KeyError, IndexError, TypeError):
+			return None
+
+	@staticmethod
+	def _get_error_message(exc):
+		"""
+		Extract the error message from a HttpError.
+		:param exc: HttpError
+		:return: str: error message or None if the error has no JSON content
+		"""
+		if "application/json" not in exc.resp.get("content-type", ""):
+			return None
+		try:
+			error = json.loads(exc.content).get("error")
+		except ValueError:
+			return None
+		try:
+			return error["message"]
+		except (KeyError, TypeError):
+			return str(error)
+
+
+def get_directory_circuit_breaker(ucr):
+	"""
+	Get the process wide circuit breaker for the Directory API, see
+	google-apps/api/circuit-breaker/*.
+	:param ucr: ConfigRegistry
+	:return: CircuitBreaker
+	"""
+	return get_circuit_breaker(
+		"directory",
+		int(ucr.get("google-apps/api/circuit-breaker/threshold", CIRCUIT_BREAKER_THRESHOLD)),
+		float(ucr.get("google-apps/api/circuit-breaker/reset-timeout", CIRCUIT_BREAKER_RESET_TIMEOUT)))
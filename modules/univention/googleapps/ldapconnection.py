@@ -0,0 +1,241 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+#
+# Univention Google Apps for Work - process wide LDAP connection
+#
+# Copyright 2016-2019 Univention GmbH
+#
+# http://www.univention.de/
+#
+# All rights reserved.
+#
+# The source code of this program is made available
+# under the terms of the GNU Affero General Public License version 3
+# (GNU AGPL V3) as published by the Free Software Foundation.
+#
+# Binary versions of this program provided by Univention to you as
+# well as other copyrighted, protected or trademarked materials like
+# Logos, graphics, fonts, specific documentations and configurations,
+# cryptographic keys etc. are subject to a license agreement between
+# you and Univention and not subject to the GNU AGPL V3.
+#
+# In the case you use this program under the terms of the GNU AGPL V3,
+# the program is provided in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License with the Debian GNU/Linux or Univention distribution in file
+# /usr/share/common-licenses/AGPL-3; if not, see
+# <http://www.gnu.org/licenses/>.
+
+
+
+import threading
+import time
+
+import ldap
+import univention.admin.uldap
+import univention.admin.uexceptions
+
+from univention.googleapps.logging2udebug import get_logger
+
+
+HEALTH_CHECK_INTERVAL = 60  # seconds a connection may be idle before it is checked
+REPLICATION_WINDOW = 300  # seconds after a write during which the object is read from the primary
+
+# the connections of each thread, shared by all listener events it handles:
+# _connections.connections = {"primary": .., "replica": ..}
+# (python-ldap and UDM objects must not be used by several threads at once)
+_connections = threading.local()
+# objects written through the primary, not yet seen on the replica: {dn: (timestamp, {attr: [values]})}
+_pending_writes = dict()
+_lock = threading.RLock()
+
+logger = get_logger("google-apps", "gafw")
+
+
+def get_connection(ldap_cred, base, replica_host=None):
+	"""
+	Get an LDAP connection of the current thread.
+
+	The connection is opened on first use and then reused by all listener
+	events handled by the thread (the listener itself or a sync worker
+	thread). It is opened again, if the credentials handed over by the
+	listener (setdata()) change or if it was idle for more than
+	HEALTH_CHECK_INTERVAL seconds and does not answer anymore.
+
+	:param ldap_cred: dict: credentials collected by listener.setdata(), if
+	empty or None the admin connection is used (when run by root)
+	:param base: str: LDAP base for the position object
+	:param replica_host: str: FQDN of a (local) LDAP server to use instead of
+	the one in ldap_cred, for read-only access, None for the primary
+	:return: tuple (lo, po), po is a new position object for each call
+	"""
+	role = "replica" if replica_host else "primary"
+	key = (replica_host, _get_key(ldap_cred))
+	connection = _get_thread_connections().setdefault(role, dict(lo=None, key=None, last_used=0.0))
+	lo = connection["lo"]
+	now = time.time()
+	if lo is None or connection["key"] != key:
+		if lo is not None:
+			logger.info("LDAP credentials changed, reconnecting (%s).", role)
+		lo = _connect(connection, ldap_cred, key, replica_host)
+	elif now - connection["last_used"] > HEALTH_CHECK_INTERVAL and not _is_healthy(lo):
+		logger.warn("LDAP connection is not usable anymore, reconnecting (%s).", role)
+		lo = _connect(connection, ldap_cred, key, replica_host)
+	connection["last_used"] = now
+	return lo, univention.admin.uldap.position(base)
+
+
+def reset_connection(replica=False):
+	"""
+	Drop an LDAP connection of the current thread, the next call of
+	get_connection() opens a new one.
+	:param replica: bool: drop the connection to the replica instead of the primary
+	:return: None
+	"""
+	_get_thread_connections().pop("replica" if replica else "primary", None)
+
+
+def call_with_reconnect(func, ldap_cred, base, replica_host=None):
+	"""
+	Run func with an LDAP connection of the current thread. If the LDAP server
+	went away, reconnect and run func a second time.
+
+	:param func: callable that gets (lo, po) as arguments, must be safe to be
+	run twice (read only or idempotent)
+	:param ldap_cred: dict: credentials collected by listener.setdata() or None
+	:param base: str: LDAP base for the position object
+	:param replica_host: str: FQDN of LDAP server to use instead of the primary or None
+	:return: whatever func returns
+	"""
+	lo, po = get_connection(ldap_cred, base, replica_host)
+	try:
+		return func(lo, po)
+	except (ldap.LDAPError, univention.admin.uexceptions.base) as exc:
+		if not is_server_down(exc):
+			raise
+		logger.warn("LDAP server down (%s), reconnecting.", exc)
+		reset_connection(bool(replica_host))
+	lo, po = get_connection(ldap_cred, base, replica_host)
+	return func(lo, po)
+
+
+def call_read(func, ldap_cred, base, replica_host=None, dn=None):
+	"""
+	Run a read-only func on the replica, unless it might return data older
+	than our own writes. Falls back to the primary if the replica cannot be
+	reached.
+
+	:param func: callable that gets (lo, po) as arguments, read only
+	:param ldap_cred: dict: credentials collected by listener.setdata() or None
+	:param base: str: LDAP base for the position object
+	:param replica_host: str: FQDN of LDAP server to read from or None to
+	read from the primary
+	:param dn: str: DN of the object read by func or None if func searches
+	(a search is sent to the primary while any write is not replicated yet)
+	:return: whatever func returns
+	"""
+	if replica_host:
+		try:
+			if not _has_pending_writes(ldap_cred, base, replica_host, dn):
+				return call_with_reconnect(func, ldap_cred, base, replica_host)
+		except (ldap.LDAPError, univention.admin.uexceptions.base) as exc:
+			if not is_server_down(exc):
+				raise
+			logger.warn("Cannot read from LDAP server %r (%s), using primary.", replica_host, exc)
+			reset_connection(replica=True)
+	return call_with_reconnect(func, ldap_cred, base)
+
+
+def remember_write(dn, attrs):
+	"""
+	Register a write through the primary. Until the replica has the same
+	values (or REPLICATION_WINDOW has passed), call_read() reads the object
+	from the primary.
+	:param dn: str: DN of modified object
+	:param attrs: dict: {attr: [values]} as written, [] for removed attributes
+	:return: None
+	"""
+	with _lock:
+		_pending_writes[dn.lower()] = (time.time(), attrs)
+
+
+def is_server_down(exc):
+	"""
+	Check if an exception (possibly wrapped by UDM) means that the LDAP
+	connection is lost.
+	:param exc: Exception
+	:return: bool
+	"""
+	return isinstance(exc, ldap.SERVER_DOWN) or isinstance(getattr(exc, "original_exception", None), ldap.SERVER_DOWN)
+
+
+def _has_pending_writes(ldap_cred, base, replica_host, dn):
+	"""
+	Check if the replica may be missing own writes. Expired writes are
+	forgotten. For a search (dn is None) any write within REPLICATION_WINDOW
+	counts, without checking the replica. For a DN the replica is checked
+	and the write is forgotten if it has been replicated.
+	:return: bool
+	"""
+	now = time.time()
+	with _lock:
+		for pending_dn, (timestamp, attrs) in _pending_writes.items():
+			if now - timestamp >= REPLICATION_WINDOW:
+				del _pending_writes[pending_dn]
+		if dn is None:
+			return bool(_pending_writes)
+		try:
+			timestamp, attrs = _pending_writes[dn.lower()]
+		except KeyError:
+			return False
+	lo, po = get_connection(ldap_cred, base, replica_host)
+	replica_attrs = lo.get(dn, attr=attrs.keys())
+	if any(replica_attrs.get(attr, []) != values for attr, values in attrs.items()):
+		return True
+	with _lock:
+		if _pending_writes.get(dn.lower(), (None,))[0] == timestamp:
+			del _pending_writes[dn.lower()]
+	return False
+
+
+def _get_thread_connections():
+	if not hasattr(_connections, "connections"):
+		_connections.connections = dict()
+	return _connections.connections
+
+
+def _get_key(ldap_cred):
+	if not ldap_cred:
+		return None
+	return tuple(ldap_cred.get(attr) for attr in ("ldapserver", "basedn", "binddn", "bindpw"))
+
+
+def _connect(connection, ldap_cred, key, replica_host):
+	connection["lo"] = None
+	if ldap_cred:
+		lo = univention.admin.uldap.access(
+			host=replica_host or ldap_cred["ldapserver"],
+			base=ldap_cred["basedn"],
+			binddn=ldap_cred["binddn"],
+			bindpw=ldap_cred["bindpw"])
+	elif replica_host:
+		lo, po = univention.admin.uldap.getMachineConnection(ldap_master=False)
+	else:
+		lo, po = univention.admin.uldap.getAdminConnection()
+	connection["lo"] = lo
+	connection["key"] = key
+	logger.debug("Opened LDAP connection to %r as %r.", replica_host or "primary", lo.binddn)
+	return lo
+
+
+def _is_healthy(lo):
+	try:
+		lo.searchDn(filter="(objectClass=*)", base=lo.base, scope="base")
+		return True
+	except (ldap.LDAPError, univention.admin.uexceptions.base) as exc:
+		logger.debug("LDAP health check failed: %s", exc)
+		return False
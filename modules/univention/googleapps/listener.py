@@ -29,22 +29,60 @@
 # /usr/share/common-licenses/AGPL-3; if not, see
 # <http://www.gnu.org/licenses/>.
 
+import os
 import uuid
+import fcntl
 import random
 import string
 import json
 import base64
+import binascii
 import zlib
 import copy
+import threading
 
+from ldap.filter import escape_filter_chars
 import univention.admin.uldap
 import univention.admin.objects
 
+from univention.googleapps.auth import VARDIR
 from univention.googleapps.handler import GappsHandler, ResourceNotFoundError
+from univention.googleapps.ldapconnection import get_connection, call_read, call_with_reconnect, remember_write
+from univention.googleapps.localdb import set_file_owner
 from univention.googleapps.logging2udebug import get_logger
 
 logger = get_logger("google-apps", "gafw")
 
+# UDM modules are loaded and initialized only once per process: {"users/user": UDM module}
+_udm_modules = dict()
+_udm_modules_lock = threading.Lock()
+
+# serializes changes to a group between threads and processes: {slot: GroupLock}
+_group_locks = dict()
+_group_locks_lock = threading.Lock()
+# byte range locks on this file serialize changes to a group between processes (listener, sync worker, verifier)
+GROUP_LOCK_FILE = os.path.join(VARDIR, "groups.lock")
+GROUP_LOCK_SLOTS = 65536  # groups whose DNs hash to the same slot share a lock
+_group_lock_fp = None
+
+# number of member DNs per LDAP search when resolving group members without the memberOf overlay
+MEMBER_FILTER_CHUNK_SIZE = 200
+
+# LDAP attributes read by get_sync_state()
+SYNC_STATE_ATTRIBUTES = [
+	"objectClass", "cn", "description", "mailPrimaryAddress", "uniqueMember",
+	"univentionGoogleAppsEnabled", "univentionGoogleAppsObjectID",
+]
+
+# LDAP attributes read by set_sync_state() before writing
+SYNC_STATE_WRITE_ATTRIBUTES = [
+	"objectClass", "univentionGoogleAppsEnabled", "univentionGoogleAppsObjectID",
+	"univentionGoogleAppsData", "univentionGoogleAppsPrimaryEmail",
+]
+
+# sentinel for set_sync_state(): leave univentionGoogleAppsData untouched
+_KEEP_DATA = object()
+
 
 class GoogleAppsListener(object):
 	def __init__(self, listener, attrs, ldap_cred):
@@ -57,9 +95,7 @@ class GoogleAppsListener(object):
 		self.listener = listener
 		self.attrs = attrs or dict(never=["customerId"])
 		self.ldap_cred = ldap_cred
-		self.lo = None
-		self.po = None
-		self.groupmod = None
+		self.verification_queue = None
 
 		if self.listener:
 			self.ucr = self.listener.configRegistry
@@ -68,6 +104,7 @@ class GoogleAppsListener(object):
 			from univention.config_registry import ConfigRegistry
 			self.ucr = ConfigRegistry()
 		self.ucr.load()
+		self.deferred_verification = self.ucr.is_true("google-apps/groups/verify/deferred", False)
 
 	def create_google_user(self, new):
 		"""
@@ -126,10 +163,11 @@ class GoogleAppsListener(object):
 		except KeyError:
 			logger.warn("Trying to retrieve user '{}' without an univentionGoogleAppsObjectID.".format(
 				new["entryDN"][0]))
-		try:
-			return self.gh.list_users(query="externalId={}".format(new["entryUUID"][0]))[0]
-		except IndexError:
-			logger.exception("Could not find user '{}' with entryUUID={} in google directory.".format(
+		user_id = self.gh.find_user_id(new["entryUUID"][0])
+		if user_id:
+			return self.gh.get_user(user_id)
+		else:
+			logger.error("Could not find user '{}' with entryUUID={} in google directory.".format(
 				new["entryDN"][0], new["entryUUID"][0]))
 			raise ResourceNotFoundError("Could not find user in google directory.")
 
@@ -238,10 +276,10 @@ class GoogleAppsListener(object):
 		:return: dict: created group resource
 		"""
 		logger.debug("groupdn=%r add_members=%r", group_dn, add_members)
-		udm_group = self.get_udm_group(group_dn)
-		desc = udm_group["description"]
-		name = udm_group["name"]
-		email = udm_group["mailAddress"] or "{}@{}".format(name.replace(" ", "_"),
+		group = self.get_sync_state(group_dn)
+		desc = group["description"]
+		name = group["name"]
+		email = group["mail_primary_address"] or "{}@{}".format(name.replace(" ", "_"),
 			self.gh.get_primary_domain_from_disk())
 		return self.create_google_group(name, desc, group_dn, email, add_members)
 
@@ -264,18 +302,17 @@ class GoogleAppsListener(object):
 			logger.warn("No modifications found, ignoring.")
 			return
 
-		udm_group = self.get_udm_group(new["entryDN"][0])
-		group_id = udm_group.get("UniventionGoogleAppsObjectID")
-		logger.debug("udm_group[name]=%r group_id=%r", udm_group.get("name"), group_id)
+		group = self.get_sync_state(new["entryDN"][0])
+		group_id = group["object_id"]
+		logger.debug("group[name]=%r group_id=%r", group["name"], group_id)
 
 		new_google_group = None
 		user_ids_added_to_group_in_google_dir = []
 		user_ids_removed_from_group_in_google_dir = []
 
 		if "uniqueMember" in modification_attributes:
-			# In uniqueMember users and groups are both listed. There is no
-			# secure way to distinguish between them, so lets have UDM do that
-			# for us.
+			# In uniqueMember users and groups are both listed, they are
+			# distinguished by their objectClass.
 			modification_attributes.remove("uniqueMember")
 			set_old = set(old.get("uniqueMember", []))
 			set_new = set(new.get("uniqueMember", []))
@@ -284,48 +321,44 @@ class GoogleAppsListener(object):
 			logger.debug("members to add: %r, members to remove: %r", added_members, removed_members)
 
 			# add new members to google directory
+			member_ids_to_add = []
 			for added_member in added_members:
-				if added_member in udm_group["users"]:
-					udm_user = self.get_udm_user(added_member)
-					if (bool(int(udm_user.get("UniventionGoogleAppsEnabled", "0"))) and
-						udm_user.get("UniventionGoogleAppsObjectID")):
-						if group_id:
-							self.gh.add_member_to_group(group_id, udm_user["UniventionGoogleAppsObjectID"])
-							user_ids_added_to_group_in_google_dir.append(udm_user["UniventionGoogleAppsObjectID"])
-						else:
-							# group doesn't exist yet, this is the first member -> create it
-							# all group members will be added automatically (if they are synced)
-							new_google_group = self.create_google_group_from_new(new)
-							group_id = new_google_group["id"]
-							user_ids_added_to_group_in_google_dir = new_google_group['_members']
-							break
-				elif added_member in udm_group["nestedGroup"]:
+				member = self.get_sync_state(added_member)
+				if member["is_group"]:
 					# ignore, let's not support nested groups for now
 					logger.info("Nested group %r ignored.", added_member)
-				else:
+				elif not member["is_user"]:
 					raise RuntimeError("GoogleAppsListener.modify_google_group() '{}' from new[uniqueMember] not in "
 						"'nestedGroup' or 'users'.".format(added_member))
+				elif member["enabled"] and member["object_id"]:
+					if group_id:
+						member_ids_to_add.append(member["object_id"])
+					else:
+						# group doesn't exist yet, this is the first member -> create it
+						# all group members will be added automatically (if they are synced)
+						new_google_group = self.create_google_group_from_new(new)
+						group_id = new_google_group["id"]
+						user_ids_added_to_group_in_google_dir = new_google_group['_members']
+						break
+			if member_ids_to_add:
+				results = self.gh.batch_add_members(group_id, member_ids_to_add)
+				user_ids_added_to_group_in_google_dir.extend(self._check_batch_results(results))
 
 			# remove members
 			if group_id:
+				member_ids_to_remove = []
 				for removed_member in removed_members:
-					# try with UDM user
-					udm_obj = self.get_udm_user(removed_member)
-					member_id = udm_obj.get("UniventionGoogleAppsObjectID")
-					if not member_id:
-						# try with UDM group
-						udm_obj = self.get_udm_group(removed_member)
-						member_id = udm_obj.get("UniventionGoogleAppsObjectID")
+					# user or group
+					member_id = self.get_sync_state(removed_member)["object_id"]
 					if not member_id:
 						# user/group may have been deleted or user/group may not be marked as a google group
 						# let's try to remove it from google directory anyway
 						# get user or group using DN/email
 
 						# try with a user, have to use entryDN, entryUUID is not accessible to us
-						google_user = self.gh.list_users(query="externalId={}".format(removed_member))
-						if google_user:
-							logger.debug("google_user=%r", google_user)
-							member_id = google_user[0]["id"]
+						member_id = self.gh.find_user_id(removed_member)
+						if member_id:
+							logger.debug("member_id=%r", member_id)
 						else:
 							# try with a group
 							# ignore, let's not support nested groups for now
@@ -336,21 +369,21 @@ class GoogleAppsListener(object):
 							logger.info("Couldn't find %r in google directory, was not deleted.", removed_member)
 							continue
 
-					self.gh.delete_member_from_group(group_id, member_id)
-					user_ids_removed_from_group_in_google_dir.append(member_id)
-
-		# wait for member changes to activate (0.5 - 5 sec per modification)
-		if group_id:
-			for user_id in user_ids_added_to_group_in_google_dir:
-				self.gh.wait_for_group_member_to_appear(group_id, user_id)
-			for user_id in user_ids_removed_from_group_in_google_dir:
-				self.gh.wait_for_group_member_to_disappear(group_id, user_id)
-		logger.debug("Done handling 'uniqueMember' for group %r (%r).", udm_group.get("name"), group_id)
+					member_ids_to_remove.append(member_id)
+				if member_ids_to_remove:
+					results = self.gh.batch_delete_members(group_id, member_ids_to_remove)
+					user_ids_removed_from_group_in_google_dir.extend(
+						self._check_batch_results(results, ignore=(ResourceNotFoundError,)))
 
-		# remove google group if it is empty
+		# wait for member changes to activate (0.5 - 5 sec) and remove google group if it is empty
 		if group_id:
-			if self.delete_google_group_if_empty(old["entryDN"][0], group_id):
+			if self.verify_group_members(
+				new["entryDN"][0],
+				group_id,
+				appear=user_ids_added_to_group_in_google_dir,
+				disappear=user_ids_removed_from_group_in_google_dir):
 				group_id = None
+		logger.debug("Done handling 'uniqueMember' for group %r (%r).", group["name"], group_id)
 
 		# modify other attributes
 		if not group_id:
@@ -401,8 +434,7 @@ class GoogleAppsListener(object):
 		:param group_id: str: ID of group in googles directory
 		:return: bool: if the group was removed
 		"""
-		google_users = self.gh.list_members_of_group(group_id)
-		if google_users:
+		if self.gh.group_has_members(group_id):
 			return False
 		else:
 			logger.info("Group %r (%r) has no users in google directory, removing...", group_id, group_dn)
@@ -410,6 +442,62 @@ class GoogleAppsListener(object):
 			self.udm_group_set_group_id(group_dn, None)
 			return True
 
+	def verify_group_members(self, group_dn, group_id, appear=(), disappear=()):
+		"""
+		Make sure member changes are active in the google directory, then
+		remove the google group if it is empty.
+
+		If google-apps/groups/verify/deferred is set, the expected state is
+		recorded in the membership verification queue and the check is done
+		later by verify_group_membership (see verification.py). Otherwise
+		this waits for the changes.
+
+		:param group_dn: str: DN of group in LDAP
+		:param group_id: str: ID of group in googles directory
+		:param appear: list: IDs of users added to the group
+		:param disappear: list: IDs of users removed from the group
+		:return: bool: if the group was removed
+		"""
+		if self.deferred_verification:
+			if not self.verification_queue:
+				from univention.googleapps.verification import MembershipVerificationQueue
+				self.verification_queue = MembershipVerificationQueue()
+			self.verification_queue.add(group_id, group_dn, appear, disappear, delete_if_empty=True)
+			logger.debug("Queued verification of group %r: appear=%r disappear=%r.", group_id, appear, disappear)
+			return False
+		if appear or disappear:
+			self.gh.wait_for_group_members(group_id, appear=appear, disappear=disappear)
+		return self.delete_google_group_if_empty(group_dn, group_id)
+
+	def get_sync_state(self, dn):
+		"""
+		Read the attributes relevant for the synchronization of a user or
+		group directly from LDAP (without opening a UDM object).
+		Use get_udm_user() / get_udm_group() only where UDM semantics are needed.
+		:param dn: str: DN of user or group
+		:return: dict: with keys "dn", "exists" (bool), "is_group" (bool),
+		"is_user" (bool: neither group nor host), "enabled" (bool: univentionGoogleAppsEnabled), "object_id"
+		(univentionGoogleAppsObjectID or None), "name" (cn or None),
+		"description", "mail_primary_address" and "members" (list: uniqueMember)
+		"""
+		attrs = self._ldap_get(dn, SYNC_STATE_ATTRIBUTES)
+
+		def first(attr):
+			return attrs.get(attr, [None])[0] or None
+
+		return dict(
+			dn=dn,
+			exists=bool(attrs),
+			is_group="univentionGroup" in attrs.get("objectClass", []),
+			is_user=bool(attrs) and not set(attrs.get("objectClass", [])) & {"univentionGroup", "univentionHost"},
+			enabled=first("univentionGoogleAppsEnabled") == "1",
+			object_id=first("univentionGoogleAppsObjectID"),
+			name=first("cn"),
+			description=first("description"),
+			mail_primary_address=first("mailPrimaryAddress"),
+			members=attrs.get("uniqueMember", []),
+		)
+
 	def get_udm_user(self, userdn):
 		"""
 		Fetch UDM user object.
@@ -417,13 +505,48 @@ class GoogleAppsListener(object):
 		:return: dict: opened UDM user object
 		"""
 		lo, po = self._get_ldap_connection()
-		univention.admin.modules.update()
-		usersmod = univention.admin.modules.get("users/user")
-		univention.admin.modules.init(lo, po, usersmod)
+		usersmod = self.get_udm_module("users/user", lo, po)
 		user = usersmod.object(None, lo, po, userdn)
 		user.open()
 		return user
 
+	@staticmethod
+	def group_lock(group_dn):
+		"""
+		Get the lock for changes to a group (and its members) in the google
+		directory, for use in a with statement. It is shared by all threads
+		and processes. Changes to different groups can be done in parallel.
+		:param group_dn: str: DN of group in UCS
+		:return: GroupLock
+		"""
+		if isinstance(group_dn, unicode):
+			group_dn = group_dn.encode("utf-8")
+		slot = (zlib.crc32(group_dn.lower()) & 0xffffffff) % GROUP_LOCK_SLOTS
+		with _group_locks_lock:
+			return _group_locks.setdefault(slot, GroupLock(slot))
+
+	@staticmethod
+	def get_udm_module(module_s, lo, po):
+		"""
+		Get an initialized UDM module. The UDM handler modules are loaded
+		and each module is initialized only on first use in a process
+		(changes to extended attributes require a restart of the process).
+		:param module_s: str: "users/user", "groups/group", etc
+		:param lo: univention.admin.uldap.access object, used for initialization
+		:param po: univention.admin.uldap.position object, used for initialization
+		:return: UDM module
+		"""
+		with _udm_modules_lock:
+			try:
+				return _udm_modules[module_s]
+			except KeyError:
+				if not _udm_modules:
+					univention.admin.modules.update()
+				module = univention.admin.modules.get(module_s)
+				univention.admin.modules.init(lo, po, module)
+				_udm_modules[module_s] = module
+				return module
+
 	@staticmethod
 	def find_udm_objects(module_s, filter_s, base, ldap_cred):
 		"""
@@ -434,15 +557,8 @@ class GoogleAppsListener(object):
 		:param ldap_cred: dict: credentials collected by listener.setdata()
 		:return: list of (not yet opened) UDM objects
 		"""
-		lo = univention.admin.uldap.access(
-					host=ldap_cred["ldapserver"],
-					base=ldap_cred["basedn"],
-					binddn=ldap_cred["binddn"],
-					bindpw=ldap_cred["bindpw"])
-		po = univention.admin.uldap.position(base)
-		univention.admin.modules.update()
-		module = univention.admin.modules.get(module_s)
-		univention.admin.modules.init(lo, po, module)
+		lo, po = get_connection(ldap_cred, base)
+		module = GoogleAppsListener.get_udm_module(module_s, lo, po)
 		config = univention.admin.config.config()
 		return module.lookup(config, lo, filter_s=filter_s, base=base)
 
@@ -455,27 +571,106 @@ class GoogleAppsListener(object):
 		:return: list: IDs of users added to group
 		"""
 		logger.debug("group_dn=%r group_id=%r", group_dn, group_id)
-		members_ids_added = []
+		member_ids_to_add = []
 		for user in self.udm_group_list_google_users(group_dn):
 			if user["UniventionGoogleAppsObjectID"]:
-				member = self.gh.add_member_to_group(group_id, user["UniventionGoogleAppsObjectID"])
-				members_ids_added.append(member['id'])
+				member_ids_to_add.append(user["UniventionGoogleAppsObjectID"])
 			else:
 				logger.error("User %r has no objectID, not adding to group %r.", user["username"], group_id)
-		return members_ids_added
+		if not member_ids_to_add:
+			return []
+		results = self.gh.batch_add_members(group_id, member_ids_to_add)
+		return [results[member_id]['id'] for member_id in self._check_batch_results(results)]
 
 	def udm_group_set_group_id(self, group_dn, group_id):
 		"""
 		Save the object ID of the google group in LDAP.
 		:param group_dn: DN of group in UCS
 		:param group_id: object ID of google group
-		:return: opened UDM group
+		:return: bool: whether LDAP was modified
 		"""
 		logger.debug("storing %r in %r.", group_id, group_dn)
-		udm_group = self.get_udm_group(group_dn)
-		udm_group["UniventionGoogleAppsObjectID"] = group_id
-		udm_group.modify()
-		return udm_group
+		return self.set_sync_state(group_dn, group_id)
+
+	def set_sync_state(self, dn, object_id, google_data=_KEEP_DATA):
+		"""
+		Store univentionGoogleAppsObjectID and univentionGoogleAppsData of a
+		user or group with a minimal LDAP modify operation (without opening a
+		UDM object). Nothing is written if the values are unchanged. If the
+		primary email address in google_data changes, the UDM object is
+		modified instead, so that GooglePrimaryAdressHook updates
+		univentionGoogleAppsPrimaryEmail. If the LDAP server went away, it
+		reconnects and tries again.
+		:param dn: str: DN of user or group
+		:param object_id: str: google object ID or None to remove it
+		:param google_data: dict: google user resource (or None) to store in
+		univentionGoogleAppsData, not passed for groups
+		:return: bool: whether LDAP was modified
+		"""
+		# modify operations sent before the connection was lost may have been
+		# applied, so the retry of call_with_reconnect() starts by reading again
+		written = []
+
+		def _set_sync_state(lo, po):
+			current = lo.get(dn, attr=SYNC_STATE_WRITE_ATTRIBUTES)
+			ml = []
+			old_object_ids = current.get("univentionGoogleAppsObjectID", [])
+			new_object_ids = [object_id] if object_id else []
+			if old_object_ids != new_object_ids:
+				ml.append(("univentionGoogleAppsObjectID", old_object_ids, new_object_ids))
+			use_udm = False
+			if google_data is not _KEEP_DATA:
+				old_data = current.get("univentionGoogleAppsData", [])
+				if not old_data or self._decode_data(old_data[0]) != google_data:
+					ml.append(("univentionGoogleAppsData", old_data, [self._encode_data(google_data)]))
+					# same as GooglePrimaryAdressHook.hook_ldap_modlist()
+					if current.get("univentionGoogleAppsEnabled", [""])[0] == "1":
+						new_primary = (google_data or {}).get("primaryEmail")
+					else:
+						new_primary = ""
+					old_primary = current.get("univentionGoogleAppsPrimaryEmail", [None])[0]
+					use_udm = (old_primary or "") != (new_primary or "")
+			if not ml:
+				logger.debug("Sync state of %r unchanged.", dn)
+				return
+			written.append(dn)
+			if use_udm:
+				logger.debug("Modifying %r through UDM (primary email address changed).", dn)
+				udm_user = self.get_udm_user(dn)
+				udm_user["UniventionGoogleAppsObjectID"] = object_id
+				udm_user["UniventionGoogleAppsData"] = self._encode_data(google_data)
+				udm_user.modify()
+			else:
+				if "univentionGoogleApps" not in current.get("objectClass", []):
+					ml.append(("objectClass", [], ["univentionGoogleApps"]))
+				logger.debug("Modifying %r: %r", dn, [attr for attr, old, new in ml])
+				lo.modify(dn, ml)
+
+		call_with_reconnect(_set_sync_state, self.ldap_cred, self.ucr["ldap/base"])
+		if not written:
+			return False
+		self.remember_object_id_write(dn, object_id)
+		return True
+
+	@staticmethod
+	def _encode_data(google_data):
+		return base64.encodestring(zlib.compress(json.dumps(google_data)))
+
+	@staticmethod
+	def _decode_data(value):
+		try:
+			return json.loads(zlib.decompress(base64.decodestring(value)))
+		except (ValueError, zlib.error, binascii.Error):
+			return _KEEP_DATA
+
+	def list_user_group_dns(self, user_dn):
+		"""
+		Get the groups a user is a direct member of (like the UDM property 'groups').
+		:param user_dn: str: DN of user
+		:return: list: DNs of groups
+		"""
+		filter_s = "(&(objectClass=univentionGroup)(uniqueMember={}))".format(escape_filter_chars(user_dn))
+		return [dn for dn, attrs in self._ldap_search(filter_s, ["cn"])]
 
 	@classmethod
 	def clean_udm_objects(cls, module_s, base, ldap_cred):
@@ -506,11 +701,8 @@ class GoogleAppsListener(object):
 		:return: dict: opened UDM group object
 		"""
 		lo, po = self._get_ldap_connection()
-		if not self.groupmod:
-			univention.admin.modules.update()
-			self.groupmod = univention.admin.modules.get("groups/group")
-			univention.admin.modules.init(lo, po, self.groupmod)
-		group = self.groupmod.object(None, lo, po, group_dn)
+		groupmod = self.get_udm_module("groups/group", lo, po)
+		group = groupmod.object(None, lo, po, group_dn)
 		group.open()
 		return group
 
@@ -518,16 +710,18 @@ class GoogleAppsListener(object):
 		"""
 		Get users of this group that are google users (non-recursively).
 		:param group_dn: group to check
-		:return: list: opened UDM users in this group that are google users
+		:return: list of dicts with keys "dn", "username" and
+		"UniventionGoogleAppsObjectID" of the users in this group that are google users
 		"""
 		logger.debug("groupdn=%r", group_dn)
-		udm_group = self.get_udm_group(group_dn)
-		result = list()
-		for userdn in udm_group.get("users", []):
-			udm_user = self.get_udm_user(userdn)
-			if bool(int(udm_user.get("UniventionGoogleAppsEnabled", "0"))) and udm_user.get("UniventionGoogleAppsObjectID"):
-				result.append(udm_user)
-		return result
+		return [
+			dict(
+				dn=dn,
+				username=attrs.get("uid", [None])[0],
+				UniventionGoogleAppsObjectID=attrs["univentionGoogleAppsObjectID"][0])
+			for dn, attrs in self._search_group_google_users(
+				group_dn, True, ["uid", "univentionGoogleAppsObjectID"])
+		]
 
 	def udm_group_has_google_users(self, group_dn):
 		"""
@@ -537,12 +731,33 @@ class GoogleAppsListener(object):
 		:return: bool: if group has at least one user with univentionGoogleAppsEnabled=1
 		"""
 		logger.debug("groupdn=%r", group_dn)
-		udm_group = self.get_udm_group(group_dn)
-		for userdn in udm_group.get("users", []):
-			udm_user = self.get_udm_user(userdn)
-			if bool(int(udm_user.get("UniventionGoogleAppsEnabled", "0"))):
-				return True
-		return False
+		return next(self._search_group_google_users(group_dn, False, ["uid"]), None) is not None
+
+	def _search_group_google_users(self, group_dn, with_object_id, attrs):
+		"""
+		Search the members of a group that are google users with as few LDAP
+		searches as possible: a single search if the memberOf overlay is
+		active, otherwise one search per MEMBER_FILTER_CHUNK_SIZE members.
+		:param group_dn: str: DN of group
+		:param with_object_id: bool: find only users that have an univentionGoogleAppsObjectID
+		:param attrs: list: LDAP attributes to retrieve
+		:return: generator of tuples (dn, dict: attributes)
+		"""
+		google_filter = "(univentionGoogleAppsEnabled=1)"
+		if with_object_id:
+			google_filter += "(univentionGoogleAppsObjectID=*)"
+		if self.ucr.is_true("ldap/overlay/memberof", False):
+			filter_s = "(&(memberOf={}){})".format(escape_filter_chars(group_dn), google_filter)
+			for res in self._ldap_search(filter_s, attrs):
+				yield res
+			return
+		member_dns = self._ldap_get(group_dn, ["uniqueMember"]).get("uniqueMember", [])
+		for start in range(0, len(member_dns), MEMBER_FILTER_CHUNK_SIZE):
+			chunk = member_dns[start:start + MEMBER_FILTER_CHUNK_SIZE]
+			filter_s = "(&{}(|{}))".format(
+				google_filter, "".join("(entryDN={})".format(escape_filter_chars(dn)) for dn in chunk))
+			for res in self._ldap_search(filter_s, attrs):
+				yield res
 
 	def wait_for_group_member_to_disappear(self, group_id, object_id):
 		return self.gh.wait_for_group_member_to_disappear(group_id, object_id)
@@ -569,6 +784,27 @@ class GoogleAppsListener(object):
 		random.shuffle(pw)
 		return u"".join(pw)
 
+	@staticmethod
+	def _check_batch_results(results, ignore=()):
+		"""
+		Raise the first error found in the results of a batch request.
+		:param results: dict: item key -> resource or exception, as returned by GappsHandler.batch_*()
+		:param ignore: tuple: exception classes that are only logged
+		:return: list: keys of successful items
+		"""
+		successful = []
+		error = None
+		for key, result in results.items():
+			if isinstance(result, ignore):
+				logger.warn("Ignoring %s for %r.", result.__class__.__name__, key)
+			elif isinstance(result, Exception):
+				error = error or result
+			else:
+				successful.append(key)
+		if error:
+			raise error
+		return successful
+
 	@staticmethod
 	def _diff_old_new(attribs, old, new):
 		"""
@@ -586,19 +822,61 @@ class GoogleAppsListener(object):
 	def _get_ldap_connection(self):
 		"""
 		Get lo and po, allows this class to be used outside listener by root.
+		The LDAP connection is shared by all instances in a process.
 		:return: tuple (lo, po)
 		"""
-		if not self.lo or not self.po:
-			if self.ldap_cred:
-				self.lo = univention.admin.uldap.access(
-					host=self.ldap_cred["ldapserver"],
-					base=self.ldap_cred["basedn"],
-					binddn=self.ldap_cred["binddn"],
-					bindpw=self.ldap_cred["bindpw"])
-				self.po = univention.admin.uldap.position(self.ucr["ldap/base"])
-			else:
-				self.lo, self.po = univention.admin.uldap.getAdminConnection()
-		return self.lo, self.po
+		return get_connection(self.ldap_cred, self.ucr["ldap/base"])
+
+	def _get_read_replica(self):
+		"""
+		Get the LDAP server for read-only lookups, if reads should not go to
+		the server that is written to (UCR google-apps/ldap/read-local).
+		:return: str: FQDN of local LDAP server or None to read from the primary
+		"""
+		if not self.ucr.is_true("google-apps/ldap/read-local", False):
+			return None
+		host = self.ucr.get("ldap/server/name")
+		if not host or host == (self.ldap_cred or {}).get("ldapserver", self.ucr.get("ldap/master")):
+			return None
+		return host
+
+	def remember_object_id_write(self, dn, object_id):
+		"""
+		Register that univentionGoogleAppsObjectID of an object was written,
+		so that it is not read from the replica before it has been replicated.
+		:param dn: str: DN of user or group
+		:param object_id: str: google object ID or None if it was removed
+		:return: None
+		"""
+		if self._get_read_replica():
+			remember_write(dn, {"univentionGoogleAppsObjectID": [object_id] if object_id else []})
+
+	def _ldap_get(self, dn, attrs):
+		"""
+		Read attributes of an LDAP object, reconnect if the LDAP server went away.
+		:param dn: str: DN of object
+		:param attrs: list: LDAP attributes to retrieve
+		:return: dict: attributes (empty if object does not exist)
+		"""
+		return call_read(
+			lambda lo, po: lo.get(dn, attr=attrs),
+			self.ldap_cred,
+			self.ucr["ldap/base"],
+			self._get_read_replica(),
+			dn)
+
+	def _ldap_search(self, filter_s, attrs):
+		"""
+		Search LDAP below ldap/base, reconnect if the LDAP server went away.
+		:param filter_s: str: LDAP filter
+		:param attrs: list: LDAP attributes to retrieve
+		:return: list of tuples (dn, dict: attributes)
+		"""
+		return call_read(
+			lambda lo, po: lo.search(filter=filter_s, base=self.ucr["ldap/base"], attr=attrs),
+			self.ldap_cred,
+			self.ucr["ldap/base"],
+			self._get_read_replica())
 
 	def _get_random_email_address(self):
 		local_part = "".join([random.choice(string.ascii_letters + string.digits) for _ in range(12)])
@@ -773,3 +1051,47 @@ class GoogleAppsListener(object):
 				value=data_source["entryDN"][0]
 			)
 		]
+
+
+class GroupLock(object):
+	"""
+	Reentrant lock for changes to a group. Between the threads of a process
+	it is a threading.RLock, between processes a byte range lock on byte
+	slot of GROUP_LOCK_FILE (POSIX record locks belong to the process, so
+	the file lock is taken only by the outermost acquisition).
+	"""
+	def __init__(self, slot):
+		self.slot = slot
+		self._lock = threading.RLock()
+		self._depth = 0
+
+	def __enter__(self):
+		self._lock.acquire()
+		if self._depth == 0:
+			try:
+				fcntl.lockf(_get_group_lock_fp(), fcntl.LOCK_EX, 1, self.slot)
+			except:
+				self._lock.release()
+				raise
+		self._depth += 1
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self._depth -= 1
+		try:
+			if self._depth == 0:
+				fcntl.lockf(_get_group_lock_fp(), fcntl.LOCK_UN, 1, self.slot)
+		finally:
+			self._lock.release()
+
+
+def _get_group_lock_fp():
+	# kept open: closing any descriptor of the file would release all record locks of the process
+	global _group_lock_fp
+	with _group_locks_lock:
+		if _group_lock_fp is None:
+			is_new = not os.path.exists(GROUP_LOCK_FILE)
+			_group_lock_fp = open(GROUP_LOCK_FILE, "a")
+			if is_new:
+				set_file_owner(GROUP_LOCK_FILE)
+		return _group_lock_fp
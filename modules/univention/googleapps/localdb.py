@@ -0,0 +1,82 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+#
+# Univention Google Apps for Work - local SQLite databases
+#
+# Copyright 2016-2019 Univention GmbH
+#
+# http://www.univention.de/
+#
+# All rights reserved.
+#
+# The source code of this program is made available
+# under the terms of the GNU Affero General Public License version 3
+# (GNU AGPL V3) as published by the Free Software Foundation.
+#
+# Binary versions of this program provided by Univention to you as
+# well as other copyrighted, protected or trademarked materials like
+# Logos, graphics, fonts, specific documentations and configurations,
+# cryptographic keys etc. are subject to a license agreement between
+# you and Univention and not subject to the GNU AGPL V3.
+#
+# In the case you use this program under the terms of the GNU AGPL V3,
+# the program is provided in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License with the Debian GNU/Linux or Univention distribution in file
+# /usr/share/common-licenses/AGPL-3; if not, see
+# <http://www.gnu.org/licenses/>.
+
+
+import os
+import pwd
+import sqlite3
+
+from univention.googleapps.logging2udebug import get_logger
+
+
+DB_OWNER = "listener"
+
+logger = get_logger("google-apps", "gafw")
+
+
+def open_database(path, schema=None):
+	"""
+	Open a SQLite database, create it if it doesn't exist.
+
+	Databases are written by the listener (running as user 'listener') and by
+	scripts running as root. A database created by root is given to the
+	listener user, SQLite gives its journal files the same owner.
+
+	:param path: str: path of database file
+	:param schema: str: SQL statements to run when opening the database
+	(should use "CREATE ... IF NOT EXISTS")
+	:return: sqlite3.Connection
+	"""
+	is_new = not os.path.exists(path)
+	db = sqlite3.connect(path, timeout=30.0)
+	if is_new:
+		set_file_owner(path)
+	if schema:
+		with db:
+			db.executescript(schema)
+	return db
+
+
+def set_file_owner(path, mode=0o600):
+	"""
+	Make a file created by root accessible to the listener user.
+	:param path: str: path of file
+	:param mode: int: permissions to set
+	:return: None
+	"""
+	os.chmod(path, mode)
+	if os.geteuid() == 0:
+		try:
+			pw = pwd.getpwnam(DB_OWNER)
+			os.chown(path, pw.pw_uid, pw.pw_gid)
+		except (KeyError, OSError) as exc:
+			logger.warn("set_file_owner() could not change owner of %r: %s", path, exc)
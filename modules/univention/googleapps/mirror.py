@@ -0,0 +1,239 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+#
+# Univention Google Apps for Work - local mirror of the Google directory
+#
+# Copyright 2016-2019 Univention GmbH
+#
+# http://www.univention.de/
+#
+# All rights reserved.
+#
+# The source code of this program is made available
+# under the terms of the GNU Affero General Public License version 3
+# (GNU AGPL V3) as published by the Free Software Foundation.
+#
+# Binary versions of this program provided by Univention to you as
+# well as other copyrighted, protected or trademarked materials like
+# Logos, graphics, fonts, specific documentations and configurations,
+# cryptographic keys etc. are subject to a license agreement between
+# you and Univention and not subject to the GNU AGPL V3.
+#
+# In the case you use this program under the terms of the GNU AGPL V3,
+# the program is provided in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License with the Debian GNU/Linux or Univention distribution in file
+# /usr/share/common-licenses/AGPL-3; if not, see
+# <http://www.gnu.org/licenses/>.
+
+
+import os
+import time
+
+from univention.googleapps.auth import VARDIR
+from univention.googleapps.localdb import open_database
+from univention.googleapps.logging2udebug import get_logger
+
+
+MIRROR_DB = os.path.join(VARDIR, "mirror.sqlite")
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+	id TEXT NOT NULL PRIMARY KEY,
+	etag TEXT,
+	primary_email TEXT,
+	entry_uuid TEXT,
+	entry_dn TEXT
+);
+CREATE INDEX IF NOT EXISTS users_entry_uuid ON users (entry_uuid);
+CREATE INDEX IF NOT EXISTS users_entry_dn ON users (entry_dn);
+CREATE INDEX IF NOT EXISTS users_primary_email ON users (primary_email);
+CREATE TABLE IF NOT EXISTS groups (
+	id TEXT NOT NULL PRIMARY KEY,
+	etag TEXT,
+	email TEXT
+);
+CREATE INDEX IF NOT EXISTS groups_email ON groups (email);
+CREATE TABLE IF NOT EXISTS members (
+	group_id TEXT NOT NULL,
+	member_id TEXT NOT NULL,
+	PRIMARY KEY (group_id, member_id)
+);
+CREATE INDEX IF NOT EXISTS members_member_id ON members (member_id);
+CREATE TABLE IF NOT EXISTS meta (
+	key TEXT NOT NULL PRIMARY KEY,
+	value TEXT
+);
+"""
+# properties requested when refreshing the mirror
+USER_FIELDS = "id,etag,primaryEmail,externalIds"
+GROUP_FIELDS = "id,etag,email"
+
+logger = get_logger("google-apps", "gafw")
+
+
+class DirectoryMirror(object):
+	"""
+	Local copy of the IDs, email addresses and externalIds of the users and
+	groups in the Google directory and of the group memberships.
+
+	GappsHandler writes every change it makes to the mirror (write-through),
+	refresh() reads the complete directory to pick up changes made on the
+	Google side.
+	"""
+	def __init__(self, path=MIRROR_DB):
+		self.db = open_database(path, SCHEMA)
+
+	@property
+	def last_refresh(self):
+		"""
+		:return: float: timestamp of last complete refresh or None if never refreshed
+		"""
+		row = self.db.execute("SELECT value FROM meta WHERE key='last_refresh'").fetchone()
+		return float(row[0]) if row else None
+
+	def store_user(self, user):
+		"""
+		:param user: dict: user resource (at least "id")
+		:return: None
+		"""
+		with self.db:
+			self._store_user(user)
+
+	def _store_user(self, user):
+		external_ids = dict(
+			(ext_id.get("customType"), ext_id.get("value")) for ext_id in user.get("externalIds", [])
+			if ext_id.get("type") == "custom"
+		)
+		self.db.execute(
+			"INSERT OR REPLACE INTO users (id, etag, primary_email, entry_uuid, entry_dn) VALUES (?, ?, ?, ?, ?)",
+			(user["id"], user.get("etag"), user.get("primaryEmail"), external_ids.get("entryUUID"),
+				external_ids.get("entryDN")))
+
+	def remove_user(self, user_id):
+		"""
+		:param user_id: str: ID or primary email address of user
+		:return: None
+		"""
+		with self.db:
+			for (_id,) in self.db.execute("SELECT id FROM users WHERE id=? OR primary_email=?", (user_id, user_id)).fetchall():
+				self.db.execute("DELETE FROM members WHERE member_id=?", (_id,))
+				self.db.execute("DELETE FROM users WHERE id=?", (_id,))
+
+	def store_group(self, group):
+		"""
+		:param group: dict: group resource (at least "id")
+		:return: None
+		"""
+		with self.db:
+			self.db.execute(
+				"INSERT OR REPLACE INTO groups (id, etag, email) VALUES (?, ?, ?)",
+				(group["id"], group.get("etag"), group.get("email")))
+
+	def remove_group(self, group_id):
+		"""
+		:param group_id: str: ID or email address of group
+		:return: None
+		"""
+		with self.db:
+			for (_id,) in self.db.execute("SELECT id FROM groups WHERE id=? OR email=?", (group_id, group_id)).fetchall():
+				self.db.execute("DELETE FROM members WHERE group_id=?", (_id,))
+				self.db.execute("DELETE FROM groups WHERE id=?", (_id,))
+
+	def add_members(self, group_id, member_ids):
+		"""
+		:param group_id: str: ID of group
+		:param member_ids: list: IDs of users or groups
+		:return: None
+		"""
+		with self.db:
+			self.db.executemany(
+				"INSERT OR IGNORE INTO members (group_id, member_id) VALUES (?, ?)", [(group_id, m) for m in member_ids])
+
+	def remove_members(self, group_id, member_ids):
+		"""
+		:param group_id: str: ID of group
+		:param member_ids: list: IDs of users or groups
+		:return: None
+		"""
+		with self.db:
+			self.db.executemany(
+				"DELETE FROM members WHERE group_id=? AND member_id=?", [(group_id, m) for m in member_ids])
+
+	def find_user_id(self, external_id):
+		"""
+		Find a user by the entryUUID or entryDN stored in its externalIds.
+		:param external_id: str: entryUUID or entryDN
+		:return: str: ID of user or None if not found
+		"""
+		row = self.db.execute(
+			"SELECT id FROM users WHERE entry_uuid=? UNION SELECT id FROM users WHERE entry_dn=?",
+			(external_id, external_id)).fetchone()
+		return row[0] if row else None
+
+	def has_group(self, group_id):
+		"""
+		:param group_id: str: ID of group
+		:return: bool: if the group is in the mirror
+		"""
+		return self.db.execute("SELECT 1 FROM groups WHERE id=?", (group_id,)).fetchone() is not None
+
+	def get_member_ids(self, group_id):
+		"""
+		:param group_id: str: ID of group
+		:return: set: IDs of the members of the group
+		"""
+		return set(row[0] for row in self.db.execute("SELECT member_id FROM members WHERE group_id=?", (group_id,)))
+
+	def refresh(self, gapps_handler):
+		"""
+		Read all users, groups and group memberships from the Google
+		directory (with a minimal set of properties) and update the mirror.
+		Only rows whose etag changed are written, objects that don't exist
+		anymore are removed.
+		:param gapps_handler: GappsHandler object
+		:return: dict: number of changed and removed objects
+		"""
+		start = time.time()
+		stats = dict(users_changed=0, users_removed=0, groups_changed=0, groups_removed=0, members_changed=0)
+
+		etags = dict(self.db.execute("SELECT id, etag FROM users"))
+		with self.db:
+			for user in gapps_handler.iter_users(fields=USER_FIELDS, maxResults=500):
+				if etags.pop(user["id"], None) != user.get("etag"):
+					self._store_user(user)
+					stats["users_changed"] += 1
+			self.db.executemany("DELETE FROM users WHERE id=?", [(_id,) for _id in etags])
+			self.db.executemany("DELETE FROM members WHERE member_id=?", [(_id,) for _id in etags])
+			stats["users_removed"] = len(etags)
+
+		etags = dict(self.db.execute("SELECT id, etag FROM groups"))
+		for group in gapps_handler.iter_groups(fields=GROUP_FIELDS, maxResults=200):
+			etag = etags.pop(group["id"], None)
+			member_ids = set(m["id"] for m in gapps_handler.iter_members(group["id"], fields="ids", maxResults=200))
+			old_member_ids = self.get_member_ids(group["id"])
+			with self.db:
+				if etag != group.get("etag"):
+					self.db.execute(
+						"INSERT OR REPLACE INTO groups (id, etag, email) VALUES (?, ?, ?)",
+						(group["id"], group.get("etag"), group.get("email")))
+					stats["groups_changed"] += 1
+				if member_ids != old_member_ids:
+					self.db.executemany(
+						"DELETE FROM members WHERE group_id=? AND member_id=?",
+						[(group["id"], m) for m in old_member_ids - member_ids])
+					self.db.executemany(
+						"INSERT INTO members (group_id, member_id) VALUES (?, ?)",
+						[(group["id"], m) for m in member_ids - old_member_ids])
+					stats["members_changed"] += 1
+		with self.db:
+			self.db.executemany("DELETE FROM groups WHERE id=?", [(_id,) for _id in etags])
+			self.db.executemany("DELETE FROM members WHERE group_id=?", [(_id,) for _id in etags])
+			stats["groups_removed"] = len(etags)
+			self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('last_refresh', ?)", (str(start),))
+
+		logger.info("Refreshed directory mirror in %.1fs: %r", time.time() - start, stats)
+		return stats
@@ -0,0 +1,128 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+#
+# Univention Google Apps for Work - spread API calls over several service accounts
+#
+# Copyright 2016-2019 Univention GmbH
+#
+# http://www.univention.de/
+#
+# All rights reserved.
+#
+# The source code of this program is made available
+# under the terms of the GNU Affero General Public License version 3
+# (GNU AGPL V3) as published by the Free Software Foundation.
+#
+# Binary versions of this program provided by Univention to you as
+# well as other copyrighted, protected or trademarked materials like
+# Logos, graphics, fonts, specific documentations and configurations,
+# cryptographic keys etc. are subject to a license agreement between
+# you and Univention and not subject to the GNU AGPL V3.
+#
+# In the case you use this program under the terms of the GNU AGPL V3,
+# the program is provided in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License with the Debian GNU/Linux or Univention distribution in file
+# /usr/share/common-licenses/AGPL-3; if not, see
+# <http://www.gnu.org/licenses/>.
+
+
+import itertools
+import threading
+import time
+
+
+POOL_STRATEGIES = ("round-robin", "least-recent-error")
+QUOTA_ERROR_COOLDOWN = 60.0  # seconds a credential is avoided after a quota error
+
+# {credentials name: CredentialState}, shared by all pools in a process
+_states = dict()
+_states_lock = threading.Lock()
+_round_robin = itertools.count()
+
+
+class CredentialState(object):
+	"""
+	Health of a credential in this process.
+	"""
+	def __init__(self, name):
+		self.name = name
+		self.calls = 0
+		self.quota_errors = 0
+		self.last_quota_error = 0.0
+
+
+class PoolMember(object):
+	"""
+	A service account (or impersonated admin) in a ServicePool.
+	"""
+	def __init__(self, name, service, http, rate_limiters):
+		"""
+		:param name: str: name of credentials
+		:param service: service object built with the credentials
+		:param http: authorized httplib2.Http of the service object
+		:param rate_limiters: dict: name -> TokenBucket, see GappsHandler._rate_limit()
+		"""
+		self.name = name
+		self.service = service
+		self.http = http
+		self.rate_limiters = rate_limiters
+		with _states_lock:
+			self.state = _states.setdefault(name, CredentialState(name))
+
+	def __repr__(self):
+		return "PoolMember({!r})".format(self.name)
+
+
+class ServicePool(object):
+	"""
+	Selects the credentials to execute the next API call with.
+
+	"round-robin" uses all credentials in turn, "least-recent-error" prefers
+	the credentials that had a quota error longest ago (or never) and among
+	those the least used. With both strategies credentials are skipped for
+	cooldown seconds after a quota error, unless all had one.
+	"""
+	def __init__(self, members, strategy="round-robin", cooldown=QUOTA_ERROR_COOLDOWN):
+		"""
+		:param members: list of PoolMember objects, must not be empty
+		:param strategy: str: one of POOL_STRATEGIES
+		:param cooldown: float: seconds to avoid credentials after a quota error
+		"""
+		if strategy not in POOL_STRATEGIES:
+			raise ValueError("Unknown strategy {!r}.".format(strategy))
+		self.members = members
+		self.strategy = strategy
+		self.cooldown = cooldown
+
+	def select(self):
+		"""
+		:return: PoolMember: credentials to use for the next call
+		"""
+		healthy = [m for m in self.members if self.is_healthy(m)] or self.members
+		if self.strategy == "least-recent-error":
+			member = min(healthy, key=lambda m: (m.state.last_quota_error, m.state.calls))
+		else:
+			member = healthy[next(_round_robin) % len(healthy)]
+		member.state.calls += 1
+		return member
+
+	def is_healthy(self, member):
+		"""
+		:param member: PoolMember
+		:return: bool: if the member had no quota error in the last cooldown seconds
+		"""
+		return time.time() - member.state.last_quota_error >= self.cooldown
+
+	def report_quota_error(self, member):
+		"""
+		Record that a call with member's credentials failed because of a quota limit.
+		:param member: PoolMember
+		:return: None
+		"""
+		member.state.quota_errors += 1
+		member.state.last_quota_error = time.time()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+#
+# Univention Google Apps for Work - client side rate limiting
+#
+# Copyright 2016-2019 Univention GmbH
+#
+# http://www.univention.de/
+#
+# All rights reserved.
+#
+# The source code of this program is made available
+# under the terms of the GNU Affero General Public License version 3
+# (GNU AGPL V3) as published by the Free Software Foundation.
+#
+# Binary versions of this program provided by Univention to you as
+# well as other copyrighted, protected or trademarked materials like
+# Logos, graphics, fonts, specific documentations and configurations,
+# cryptographic keys etc. are subject to a license agreement between
+# you and Univention and not subject to the GNU AGPL V3.
+#
+# In the case you use this program under the terms of the GNU AGPL V3,
+# the program is provided in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License with the Debian GNU/Linux or Univention distribution in file
+# /usr/share/common-licenses/AGPL-3; if not, see
+# <http://www.gnu.org/licenses/>.
+
+import time
+import threading
+
+
+# {name: TokenBucket}, shared by all users of this module in a process
+_buckets = dict()
+_buckets_lock = threading.Lock()
+
+
+class TokenBucket(object):
+	"""
+	Token bucket rate limiter. Thread safe.
+
+	Tokens are added with a constant rate up to the capacity of the bucket.
+	Each call takes tokens from the bucket. If there are not enough tokens,
+	the caller sleeps until they have been added. The tokens are reserved
+	before sleeping, so callers are served in order and a request for more
+	tokens than the capacity (e.g. a batch request) just waits longer.
+	"""
+	def __init__(self, rate, capacity=None):
+		"""
+		:param rate: float: tokens added per second, 0 to disable rate limiting
+		:param capacity: float: maximum number of tokens in the bucket,
+		defaults to rate (one second worth of tokens)
+		"""
+		self.rate = float(rate)
+		self.capacity = float(capacity or rate)
+		self.tokens = self.capacity
+		self.last = time.time()
+		self._lock = threading.Lock()
+
+	def acquire(self, tokens=1):
+		"""
+		Take tokens from the bucket, sleeping if necessary.
+		:param tokens: int: number of tokens to take
+		:return: float: seconds slept
+		"""
+		if self.rate <= 0:
+			return 0.0
+		with self._lock:
+			now = time.time()
+			self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+			self.last = now
+			self.tokens -= tokens
+			wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+		if wait > 0:
+			time.sleep(wait)
+		return wait
+
+
+def get_token_bucket(name, rate, capacity=None):
+	"""
+	Get the process wide token bucket with the given name, create it if it
+	doesn't exist yet.
+	:param name: str: name of the bucket
+	:param rate: float: tokens added per second, used only when creating the bucket
+	:param capacity: float: maximum number of tokens, used only when creating the bucket
+	:return: TokenBucket
+	"""
+	with _buckets_lock:
+		try:
+			return _buckets[name]
+		except KeyError:
+			bucket = _buckets[name] = TokenBucket(rate, capacity)
+			return bucket
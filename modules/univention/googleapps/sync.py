@@ -0,0 +1,416 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+#
+# Univention Google Apps for Work - synchronization of listener events
+#
+# Copyright 2016-2019 Univention GmbH
+#
+# http://www.univention.de/
+#
+# All rights reserved.
+#
+# The source code of this program is made available
+# under the terms of the GNU Affero General Public License version 3
+# (GNU AGPL V3) as published by the Free Software Foundation.
+#
+# Binary versions of this program provided by Univention to you as
+# well as other copyrighted, protected or trademarked materials like
+# Logos, graphics, fonts, specific documentations and configurations,
+# cryptographic keys etc. are subject to a license agreement between
+# you and Univention and not subject to the GNU AGPL V3.
+#
+# In the case you use this program under the terms of the GNU AGPL V3,
+# the program is provided in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License with the Debian GNU/Linux or Univention distribution in file
+# /usr/share/common-licenses/AGPL-3; if not, see
+# <http://www.gnu.org/licenses/>.
+
+
+
+import re
+import socket
+import datetime
+
+import httplib2
+from apiclient.errors import HttpError
+
+from univention.googleapps.auth import AuthenticationErrorRetry, SSLError
+from univention.googleapps.circuitbreaker import OPEN
+from univention.googleapps.eventqueue import WAITING_ERROR, format_error
+from univention.googleapps.handler import CircuitOpenError, GappsHandler, ResourceNotFoundError
+from univention.googleapps.handler import RETRY_REASONS_403, RETRY_STATUS
+from univention.googleapps.ldapconnection import is_server_down
+from univention.googleapps.logging2udebug import get_logger
+
+
+# user is not allowed to set these:
+google_attributes_blacklisted = ["univentionGoogleAppsObjectID", "univentionGoogleAppsData", "kind", "id", "etag",
+	"isAdmin", "isDelegatedAdmin", "lastLoginTime", "creationTime", "deletionTime", "agreedToTerms", "password",
+	"hashFunction", "changePasswordAtNextLogin", "ipWhitelisted", "nonEditableAliases",
+	"customerId", "isMailboxSetup", "thumbnailPhotoEtag", "primaryEmail"]
+# used to create a correct user resource:
+# * check user supplied properties
+# * set the correct object type for each property
+google_user_property_types = dict(addresses=list, agreedToTerms=bool, aliases=list, changePasswordAtNextLogin=bool,
+	creationTime=datetime.datetime, customSchemas=dict, customerId=unicode, deletionTime=datetime.datetime,
+	emails=list, etag=unicode, externalIds=list, hashFunction=unicode, id=unicode, ims=list,
+	includeInGlobalAddressList=bool, ipWhitelisted=bool, isAdmin=bool, isDelegatedAdmin=bool,
+	isMailboxSetup=bool, kind=unicode, lastLoginTime=datetime.datetime, name=dict, nonEditableAliases=list,
+	notes=dict, orgUnitPath=unicode, organizations=list, password=unicode, phones=list, primaryEmail=unicode,
+	relations=list, suspended=bool, suspensionReason=unicode, thumbnailPhotoEtag=unicode, thumbnailPhotoUrl=unicode,
+	websites=list)
+# TODO: make a dict besides/instead of google_user_property_types that defines the types inside the dicts too
+# this will also fix the clash for 'name': it is a dict on the top level and exists as property of type str in organizations
+
+# required properties in nested structures in user resource:
+required_properties = dict(
+	emails=["address"],
+	externalIds=["value"],
+	ims=["im"],
+	name=["familyName", "givenName"],
+	notes=["value"],
+	organizations=["name"],
+	phones=["value"],
+	relations=["value"],
+	websites=["value"]
+)
+# Requirement for "name" in "organizations" isn't by google.
+# It simply doesn't make any sense without it and it would create strange
+# empty entries with the default UCRVs.
+
+# attributes the google-apps-group listener module listens on
+GROUP_LISTENER_ATTRIBUTES = ["cn", "description", "uniqueMember", "mailPrimaryAddress"]
+
+logger = get_logger("google-apps", "gafw")
+
+
+def get_user_listener_config(ucr):
+	"""
+	Build the configuration of the google-apps-user listener module from UCR.
+	:param ucr: ConfigRegistry object
+	:return: tuple (list: attributes to listen on, dict: attrs for GoogleAppsListener)
+	"""
+	# template of user resource, constructed from UCRVs:
+	g_user_resource_template = dict(primaryEmail="%mailPrimaryAddress")
+	# mapping from UCS LDAP attributes to properties in the template:
+	ldap2google = dict(mailPrimaryAddress=["primaryEmail"])
+
+	# blacklisted > never > anonymize > static > sync
+	ucr_never = ucr.get("google-apps/attributes/never", "")
+	attributes_never = [x.strip() for x in ucr_never.split(",") if x.strip()]
+
+	ucr_anon = ucr.get("google-apps/attributes/anonymize", "")
+	attributes_anonymize = [x.strip() for x in ucr_anon.split(",")
+		if x.strip() and x not in google_attributes_blacklisted and x not in attributes_never]
+
+	for k, v in ucr.items():
+		if k.startswith("google-apps/attributes/mapping/"):
+			m = re.match(r"^google-apps/attributes/mapping/(.*?)/.*$", k)
+			if not m:
+				m = re.match(r"^google-apps/attributes/mapping/(.*?)$", k)
+			google_attrib = m.groups()[0]
+
+			if google_attrib in google_attributes_blacklisted:
+				logger.warn("Ignoring blacklisted google directory user property %r.", google_attrib)
+				continue
+			if google_attrib not in google_user_property_types:
+				logger.warn("Ignoring unknown google directory user property %r.", google_attrib)
+				continue
+
+			v = v.strip()
+			if not v:
+				continue
+
+			vals = v.split(",")
+			if len(vals) > 1:
+				gprop = dict()
+				for prop in vals:
+					gk, _, action = prop.partition("=")
+					gprop[gk] = action
+			else:
+				gprop = v
+
+			if google_user_property_types[google_attrib] == list:
+				try:
+					g_user_resource_template[google_attrib].append(gprop)
+				except KeyError:
+					g_user_resource_template[google_attrib] = [gprop]
+			else:
+				g_user_resource_template[google_attrib] = gprop
+
+			for prop in v.split(","):
+				gk, _, action = prop.partition("=")
+				if not action:
+					# single value
+					action = gk
+				if action.startswith("%"):
+					ldap_attr = action[1:]
+					if ldap_attr not in attributes_never:
+						try:
+							ldap2google[ldap_attr].append(google_attrib)
+						except KeyError:
+							ldap2google[ldap_attr] = [google_attrib]
+				else:
+					# static -> ignore: will be set just once, when creating the user
+					pass
+		else:
+			pass
+
+	# just for log readability
+	attributes_anonymize.sort()
+	attributes_never.sort()
+
+	attrs = {"univentionGoogleAppsEnabled", "mailPrimaryAddress"}
+	attrs.update(ldap2google.keys())
+	attributes = sorted(list(attrs))
+
+	return attributes, dict(
+		anonymize=attributes_anonymize,
+		listener=list(attributes),
+		template=g_user_resource_template,
+		never=attributes_never,
+		google_attribs=ldap2google,
+		blacklisted=google_attributes_blacklisted,
+		google_types=google_user_property_types,
+		required_properties=required_properties
+	)
+
+
+def is_retryable(exc):
+	"""
+	Check if a failed synchronization may succeed later without any change:
+	Google or LDAP were unreachable or a quota was exceeded.
+	:param exc: Exception
+	:return: bool
+	"""
+	if isinstance(exc, (CircuitOpenError, AuthenticationErrorRetry, SSLError, socket.error, httplib2.HttpLib2Error)):
+		return True
+	if isinstance(exc, HttpError):
+		if exc.resp.status == 403:
+			return GappsHandler._get_error_reason(exc) in RETRY_REASONS_403
+		return exc.resp.status in RETRY_STATUS
+	return is_server_down(exc)
+
+
+def sync_or_defer(get_queue, module, dn, command, old, new, attributes, func, get_listener, *args):
+	"""
+	Run a synchronization in the listener (google-apps/queue disabled). If
+	it fails because Google or LDAP are unreachable (see is_retryable()),
+	or earlier changes of the object failed, store the event in the dead
+	letter store of the EventQueue instead of raising the exception, so the
+	listener can continue with the next change. The sync worker retries it
+	later. Other exceptions are raised.
+	:param get_queue: callable: get_queue(create) returns the EventQueue
+	object, or None if create is False and there is no event queue yet.
+	None to raise all exceptions (google-apps/queue/defer-failed disabled).
+	:param module: str: name of listener module
+	:param dn: str: DN of object
+	:param command: str: listener command
+	:param old: dict: listener old object
+	:param new: dict: listener new object
+	:param attributes: list: attributes to store with the event
+	:param func: callable: sync_user or sync_group
+	:param get_listener: callable: returns the GoogleAppsListener object to
+	pass to func (creating it may already contact Google)
+	:param args: further arguments for func
+	:return: None
+	"""
+	if get_queue is None:
+		func(get_listener(), *args)
+		return
+	entry_uuid = (new or old).get("entryUUID", [None])[0]
+	queue = get_queue(False)
+	next_retry = queue and queue.is_blocked(module, entry_uuid, dn)
+	if next_retry is not None:
+		logger.warn("Earlier changes of %r failed, storing this change to be retried with them.", dn)
+		event_id = queue.append(module, dn, command, old, new, attributes)
+		queue.move_to_dead_letters([event_id], WAITING_ERROR, next_retry)
+		return
+	started = False
+	try:
+		ol = get_listener()
+		if ol.gh.circuit_breaker.state == OPEN:
+			raise CircuitOpenError("The Google API is unreachable, not trying to synchronize.")
+		started = True
+		func(ol, *args)
+	except Exception as exc:
+		if not is_retryable(exc):
+			raise
+		if isinstance(exc, CircuitOpenError):
+			logger.warn("Synchronization of %r deferred, storing it to be retried later: %s", dn, exc)
+		else:
+			logger.exception("Synchronization of %r failed, storing it to be retried later: %s", dn, exc)
+		queue = get_queue(True)
+		event_id = queue.append(module, dn, command, old, new, attributes)
+		if started:
+			queue.set_attempted(event_id)
+		queue.move_to_dead_letters([event_id], format_error(exc))
+
+
+def sync_user(ol, dn, new, old, group_sync_enabled, update_groups=False):
+	"""
+	Apply a change of a user in LDAP to the google directory.
+	:param ol: GoogleAppsListener object
+	:param dn: str: DN of user
+	:param new: dict: listener new object
+	:param old: dict: listener old object
+	:param group_sync_enabled: bool: whether groups are synchronized (google-apps/groups/sync)
+	:param update_groups: bool: create/modify the groups of a new google user
+	even if the UCS user is new (group changes were processed before)
+	:return: None
+	"""
+	old_enabled = bool(int(old.get("univentionGoogleAppsEnabled", ["0"])[0]))  # "" when disabled, "1" when enabled
+	new_enabled = bool(int(new.get("univentionGoogleAppsEnabled", ["0"])[0]))
+
+	#
+	# NEW or REACTIVATED account
+	#
+	if new_enabled and not old_enabled:
+		logger.debug("new_enabled and not old_enabled -> NEW or REACTIVATED (%r)", dn)
+		new_user = None
+		if "univentionGoogleAppsObjectID" in new:
+			# the account was already created when this change was processed before
+			try:
+				new_user = ol.get_google_user(new)
+				logger.info("Google account of user %r exists already.", new["uid"][0])
+			except ResourceNotFoundError:
+				pass
+		if not new_user:
+			new_user = ol.create_google_user(new)
+		# save/update google objectId and object data in LDAP
+		ol.set_sync_state(dn, new_user["id"], new_user)
+		logger.info("Added google account of user %r. primaryEmail: %r id: %r", new["uid"][0],
+			new_user["primaryEmail"], new_user["id"])
+
+		if group_sync_enabled and (old or update_groups):
+			# Not a new UCS user, just a new Google user. The group listener
+			# will not be triggered, as no group changes have happend.
+			logger.info("Creating/Modifying users groups...")
+			for group_dn in ol.list_user_group_dns(dn):
+				with ol.group_lock(group_dn):
+					if ol.udm_group_has_google_users(group_dn):
+						google_group = ol.create_google_group_from_ldap(group_dn)
+						logger.info("Created/Modified group %r with ID %r.", google_group["name"], google_group["id"])
+		logger.debug("done (%s)", dn)
+		return
+
+	#
+	# DELETE account
+	#
+	if old and not new:
+		logger.debug("old and not new -> DELETE (%r)", dn)
+		try:
+			object_id = old["univentionGoogleAppsObjectID"][0]
+		except KeyError:
+			logger.warn('Trying to delete user without Google ObjectID, ignoring: %r', old['uid'][0])
+			return
+		ol.delete_google_user(object_id)
+		logger.info("Deleted google account of user %r.", old["uid"][0])
+		logger.debug("done (%s)", dn)
+		return
+
+	#
+	# DEACTIVATE account
+	#
+	if new and not new_enabled:
+		logger.debug("new and not new_enabled -> DEACTIVATE (%r)", dn)
+		try:
+			object_id = old["univentionGoogleAppsObjectID"][0]
+		except KeyError:
+			logger.warn('Trying to deactivate user without Google ObjectID, ignoring: %r', new['uid'][0])
+			return
+		ol.delete_google_user(object_id)
+		# update google objectId and object data in LDAP
+		# Cannot delete UniventionGoogleAppsData, because it would result in:
+		# ldapError: Inappropriate matching: modify/delete: univentionGoogleAppsData: no equality matching rule
+		# Explanation: http://gcolpart.evolix.net/blog21/delete-facsimiletelephonenumber-attribute/
+		ol.set_sync_state(dn, None, None)
+		username = old["uid"][0]
+		logger.info("Deleted google account of user %r.", username)
+
+		if group_sync_enabled:
+			logger.info("Looking for empty groups to delete...")
+			for group_dn in ol.list_user_group_dns(dn):
+				with ol.group_lock(group_dn):
+					group_id = ol.get_sync_state(group_dn)["object_id"]
+					if group_id:
+						ol.verify_group_members(group_dn, group_id, disappear=[object_id])
+			logger.debug("done (%s)", dn)
+		return
+
+	#
+	# MODIFY account
+	#
+	if old_enabled and new_enabled:
+		logger.debug("old_enabled and new_enabled -> MODIFY (%r)", dn)
+		ol.modify_google_user(old, new)
+		# update google object data in LDAP
+		google_user = ol.get_google_user(new)
+		ol.set_sync_state(dn, google_user["id"], google_user)
+		logger.info("Modified google account of user %r.", old["uid"][0])
+		return
+
+
+def sync_group(ol, dn, new, old):
+	"""
+	Apply a change of a group in LDAP to the google directory.
+	:param ol: GoogleAppsListener object
+	:param dn: str: DN of group
+	:param new: dict: listener new object
+	:param old: dict: listener old object
+	:return: None
+	"""
+	with ol.group_lock(dn):
+		_sync_group(ol, dn, new, old)
+
+
+def _sync_group(ol, dn, new, old):
+	#
+	# NEW group
+	#
+	if new and not old:
+		logger.debug("new and not old -> NEW (%s)", dn)
+		if ol.get_sync_state(dn)["object_id"]:
+			# the group was already created when this change was processed before
+			logger.info("Group %r exists already.", dn)
+		elif ol.udm_group_has_google_users(dn):
+			new_google_group = ol.create_google_group_from_ldap(dn)
+			logger.info("Created group %r with ID %r.", new_google_group["name"], new_google_group["id"])
+		logger.debug("done (%s)", dn)
+		return
+
+	#
+	# DELETE group
+	#
+	if old and not new:
+		logger.debug("old and not new -> DELETE (%s)", dn)
+		if "univentionGoogleAppsObjectID" in old:
+			ol.delete_google_group(old["univentionGoogleAppsObjectID"][0])
+			logger.info("Deleted group %r with ID %r.", old["cn"][0], old["univentionGoogleAppsObjectID"][0])
+		logger.debug("done (%s)", dn)
+		return
+
+	#
+	# MODIFY group
+	#
+	if old and new:
+		logger.debug("old and new -> MODIFY (%s)", dn)
+		if "univentionGoogleAppsObjectID" in old or ol.udm_group_has_google_users(dn):
+			ol.modify_google_group(old, new)
+			# save objectId in UDM object
+			group_id = ol.get_sync_state(new["entryDN"][0])["object_id"]
+			if not group_id:
+				# not (properly) synced, will be next time
+				# missing / unsynced groups are not a problem for users
+				logger.warn("Modified a group, but cannot find UniventionGoogleAppsObjectID (was probably deleted).")
+				group_id = None
+			else:
+				ol.udm_group_set_group_id(new["entryDN"][0], group_id)
+			logger.info("Modified group %r (%r).", old["cn"][0], group_id)
+		logger.debug("done (%s)", dn)
+		return
@@ -0,0 +1,218 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+#
+# Univention Google Apps for Work - access token cache shared by all processes
+#
+# Copyright 2016-2019 Univention GmbH
+#
+# http://www.univention.de/
+#
+# All rights reserved.
+#
+# The source code of this program is made available
+# under the terms of the GNU Affero General Public License version 3
+# (GNU AGPL V3) as published by the Free Software Foundation.
+#
+# Binary versions of this program provided by Univention to you as
+# well as other copyrighted, protected or trademarked materials like
+# Logos, graphics, fonts, specific documentations and configurations,
+# cryptographic keys etc. are subject to a license agreement between
+# you and Univention and not subject to the GNU AGPL V3.
+#
+# In the case you use this program under the terms of the GNU AGPL V3,
+# the program is provided in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License with the Debian GNU/Linux or Univention distribution in file
+# /usr/share/common-licenses/AGPL-3; if not, see
+# <http://www.gnu.org/licenses/>.
+
+
+import copy
+import datetime
+import fcntl
+import json
+import os
+import tempfile
+import threading
+import time
+
+import httplib2
+from oauth2client.client import Storage
+from oauth2client.file import Storage as FileStorage
+
+from univention.googleapps.localdb import set_file_owner
+from univention.googleapps.logging2udebug import get_logger
+
+
+REFRESH_MARGIN = 300  # seconds before expiry the token is refreshed in the background
+REFRESH_RETRY_DELAY = 60  # seconds
+
+# {"credentials": {name: credentials the background thread keeps fresh}, "thread": threading.Thread}
+_background = dict(credentials=dict())
+_background_lock = threading.Lock()
+
+logger = get_logger("google-apps", "gafw")
+
+
+class SharedTokenStorage(Storage):
+	"""
+	oauth2client storage for the access token of a service account, shared
+	by all processes on the host.
+
+	When credentials with this storage have to refresh their token, they
+	take the file lock and read the token file first. Only if no other
+	process stored a newer, unexpired token, a new one is requested from
+	Google and stored. Concurrent refreshes thereby result in a single
+	request.
+
+	Only the access token and its expiry are written to the token file. The
+	credentials file is written only to mark invalid credentials.
+	"""
+	def __init__(self, credentials, path, lock_path, credentials_path):
+		"""
+		:param credentials: oauth2client ServiceAccountCredentials object, used as template for locked_get()
+		:param path: str: path of token file
+		:param lock_path: str: path of lock file
+		:param credentials_path: str: path of credentials file
+		"""
+		super(SharedTokenStorage, self).__init__(lock=threading.Lock())
+		self._credentials = credentials
+		self._path = path
+		self._lock_path = lock_path
+		self._credentials_path = credentials_path
+		self._lock_fd = None
+
+	@staticmethod
+	def get_key(credentials):
+		"""
+		:param credentials: oauth2client ServiceAccountCredentials object
+		:return: str: identifies the account, impersonated user and scopes a token is valid for
+		"""
+		return "{} {} {}".format(
+			getattr(credentials, "service_account_email", None),
+			getattr(credentials, "_kwargs", {}).get("sub"),
+			getattr(credentials, "_scopes", None))
+
+	def acquire_lock(self):
+		super(SharedTokenStorage, self).acquire_lock()
+		try:
+			self._lock_fd = os.open(self._lock_path, os.O_RDONLY | os.O_CREAT, 0o644)
+			fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+		except (IOError, OSError) as exc:
+			logger.warn("SharedTokenStorage.acquire_lock() could not lock %r: %s", self._lock_path, exc)
+			if self._lock_fd is not None:
+				os.close(self._lock_fd)
+				self._lock_fd = None
+
+	def release_lock(self):
+		try:
+			if self._lock_fd is not None:
+				os.close(self._lock_fd)
+				self._lock_fd = None
+		finally:
+			super(SharedTokenStorage, self).release_lock()
+
+	def locked_get(self):
+		"""
+		:return: copy of the template credentials with the token from the
+		token file or None if the file has no token for them
+		"""
+		try:
+			with open(self._path, "rb") as fp:
+				data = json.load(fp)
+			if data["key"] != self.get_key(self._credentials):
+				return None
+			credentials = copy.copy(self._credentials)
+			credentials.access_token = data["access_token"]
+			credentials.token_expiry = datetime.datetime.utcfromtimestamp(data["token_expiry"])
+			return credentials
+		except (IOError, OSError, ValueError, KeyError, TypeError):
+			return None
+
+	def locked_put(self, credentials):
+		if credentials.invalid:
+			# let GappsAuth.is_initialized() know
+			FileStorage(self._credentials_path).put(credentials)
+			return
+		if not credentials.access_token or not credentials.token_expiry:
+			return
+		data = dict(
+			key=self.get_key(credentials),
+			access_token=credentials.access_token,
+			token_expiry=(credentials.token_expiry - datetime.datetime(1970, 1, 1)).total_seconds(),
+		)
+		try:
+			fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self._path), prefix=".token")
+			with os.fdopen(fd, "wb") as fp:
+				json.dump(data, fp)
+			set_file_owner(tmp_path)
+			os.rename(tmp_path, self._path)
+		except (IOError, OSError) as exc:
+			logger.warn("SharedTokenStorage.locked_put() could not write %r: %s", self._path, exc)
+
+	def locked_delete(self):
+		try:
+			os.remove(self._path)
+		except OSError:
+			pass
+
+
+def load_stored_token(credentials):
+	"""
+	Use the access token in the storage of credentials if it is not expired
+	yet, without requesting one from Google.
+	:param credentials: oauth2client credentials object with a SharedTokenStorage
+	:return: bool: whether credentials have an unexpired access token now
+	"""
+	stored = credentials.store.get()
+	if stored is None or not stored.access_token or stored.access_token_expired:
+		return False
+	credentials.access_token = stored.access_token
+	credentials.token_expiry = stored.token_expiry
+	return True
+
+
+def start_background_refresh(credentials, name="default"):
+	"""
+	Keep the access token of credentials fresh: a daemon thread refreshes it
+	REFRESH_MARGIN seconds before it expires (through the credentials'
+	storage, so a token refreshed by another process is used if there is
+	one). There is at most one such thread per process, calling this again
+	with the same name replaces the credentials it refreshes.
+	:param credentials: oauth2client credentials object
+	:param name: str: name of the credentials
+	:return: None
+	"""
+	with _background_lock:
+		_background["credentials"][name] = credentials
+		thread = _background.get("thread")
+		if thread is None or not thread.is_alive():
+			thread = threading.Thread(target=_refresh_loop, name="google-apps-token-refresh")
+			thread.daemon = True
+			thread.start()
+			_background["thread"] = thread
+
+
+def _refresh_loop():
+	while True:
+		sleep = REFRESH_RETRY_DELAY  # wake up regularly in case credentials are added or replaced
+		with _background_lock:
+			items = _background["credentials"].items()
+		for name, credentials in items:
+			if credentials.token_expiry is None:
+				remaining = 0
+			else:
+				remaining = (credentials.token_expiry - datetime.datetime.utcnow()).total_seconds()
+			if remaining > REFRESH_MARGIN:
+				sleep = min(sleep, remaining - REFRESH_MARGIN)
+				continue
+			try:
+				credentials.refresh(httplib2.Http())
+				logger.info("Refreshed access token of %r in background, expires %s UTC.", name, credentials.token_expiry)
+			except Exception as exc:
+				logger.warn("Could not refresh access token of %r in background: %s", name, exc)
+		time.sleep(sleep)
@@ -0,0 +1,234 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+#
+# Univention Google Apps for Work - deferred verification of group memberships
+#
+# Copyright 2016-2019 Univention GmbH
+#
+# http://www.univention.de/
+#
+# All rights reserved.
+#
+# The source code of this program is made available
+# under the terms of the GNU Affero General Public License version 3
+# (GNU AGPL V3) as published by the Free Software Foundation.
+#
+# Binary versions of this program provided by Univention to you as
+# well as other copyrighted, protected or trademarked materials like
+# Logos, graphics, fonts, specific documentations and configurations,
+# cryptographic keys etc. are subject to a license agreement between
+# you and Univention and not subject to the GNU AGPL V3.
+#
+# In the case you use this program under the terms of the GNU AGPL V3,
+# the program is provided in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License with the Debian GNU/Linux or Univention distribution in file
+# /usr/share/common-licenses/AGPL-3; if not, see
+# <http://www.gnu.org/licenses/>.
+
+
+import os
+import time
+
+from univention.googleapps.auth import VARDIR
+from univention.googleapps.handler import ResourceNotFoundError
+from univention.googleapps.localdb import open_database
+from univention.googleapps.logging2udebug import get_logger
+
+
+VERIFICATION_DB = os.path.join(VARDIR, "verification.sqlite")
+REPAIR_AFTER = 300  # seconds
+MAX_REPAIRS = 3
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS members (
+	group_id TEXT NOT NULL,
+	member_id TEXT NOT NULL,
+	present INTEGER NOT NULL,
+	since REAL NOT NULL,
+	repairs INTEGER NOT NULL DEFAULT 0,
+	PRIMARY KEY (group_id, member_id)
+);
+CREATE TABLE IF NOT EXISTS empty_groups (
+	group_id TEXT NOT NULL PRIMARY KEY,
+	group_dn TEXT NOT NULL
+);
+"""
+
+logger = get_logger("google-apps", "gafw")
+
+
+class MembershipVerificationQueue(object):
+	"""
+	Durable queue of the expected state of group memberships in the Google
+	directory and of groups that should be deleted if they are empty.
+	"""
+	def __init__(self, path=VERIFICATION_DB):
+		self.db = open_database(path, SCHEMA)
+
+	def add(self, group_id, group_dn, appear=(), disappear=(), delete_if_empty=False):
+		"""
+		Record the expected membership state of a group. A newer expectation
+		for a member replaces an older one.
+		:param group_id: str: ID of google group
+		:param group_dn: str: DN of group in LDAP
+		:param appear: list: IDs of users that should be members of the group
+		:param disappear: list: IDs of users that should not be members of the group
+		:param delete_if_empty: bool: whether to delete the group when it has no members
+		:return: None
+		"""
+		now = time.time()
+		rows = [(group_id, member_id, 1, now) for member_id in appear]
+		rows.extend((group_id, member_id, 0, now) for member_id in disappear)
+		with self.db:
+			self.db.executemany(
+				"INSERT OR REPLACE INTO members (group_id, member_id, present, since) VALUES (?, ?, ?, ?)", rows)
+			if delete_if_empty:
+				self.db.execute(
+					"INSERT OR REPLACE INTO empty_groups (group_id, group_dn) VALUES (?, ?)", (group_id, group_dn))
+
+	def get_groups(self):
+		"""
+		:return: list: IDs of groups with pending membership expectations
+		"""
+		return [row[0] for row in self.db.execute("SELECT DISTINCT group_id FROM members")]
+
+	def get_members(self, group_id):
+		"""
+		:param group_id: str: ID of google group
+		:return: list of tuples (member_id, present, since, repairs)
+		"""
+		return self.db.execute(
+			"SELECT member_id, present, since, repairs FROM members WHERE group_id=?", (group_id,)).fetchall()
+
+	def remove_members(self, group_id, member_ids=None):
+		"""
+		Remove expectations, because they were met or cannot be met anymore.
+		:param group_id: str: ID of google group
+		:param member_ids: list: IDs of users or None for all members of the group
+		:return: None
+		"""
+		with self.db:
+			if member_ids is None:
+				self.db.execute("DELETE FROM members WHERE group_id=?", (group_id,))
+			else:
+				self.db.executemany(
+					"DELETE FROM members WHERE group_id=? AND member_id=?", [(group_id, m) for m in member_ids])
+
+	def set_repaired(self, group_id, member_ids):
+		"""
+		Restart the waiting time of expectations after repairing them.
+		:param group_id: str: ID of google group
+		:param member_ids: list: IDs of users
+		:return: None
+		"""
+		now = time.time()
+		with self.db:
+			self.db.executemany(
+				"UPDATE members SET since=?, repairs=repairs+1 WHERE group_id=? AND member_id=?",
+				[(now, group_id, m) for m in member_ids])
+
+	def get_empty_group_checks(self):
+		"""
+		:return: list of tuples (group_id, group_dn) of groups to delete if empty,
+		that have no pending membership expectations
+		"""
+		return self.db.execute(
+			"SELECT group_id, group_dn FROM empty_groups WHERE group_id NOT IN (SELECT group_id FROM members)"
+		).fetchall()
+
+	def remove_empty_group_check(self, group_id):
+		with self.db:
+			self.db.execute("DELETE FROM empty_groups WHERE group_id=?", (group_id,))
+
+
+class MembershipVerifier(object):
+	"""
+	Confirms or repairs the membership expectations recorded in a
+	MembershipVerificationQueue, then deletes groups that became empty.
+	"""
+	def __init__(self, gapps_listener, queue=None, repair_after=REPAIR_AFTER, max_repairs=MAX_REPAIRS):
+		"""
+		:param gapps_listener: GoogleAppsListener object
+		:param queue: MembershipVerificationQueue object or None to use the default
+		:param repair_after: float: seconds to wait for Google to apply a change before repairing it
+		:param max_repairs: int: how often to repair a membership before giving up
+		"""
+		self.ol = gapps_listener
+		self.gh = gapps_listener.gh
+		self.queue = queue or MembershipVerificationQueue()
+		self.repair_after = repair_after
+		self.max_repairs = max_repairs
+
+	def run(self):
+		"""
+		Check all groups in the queue once.
+		:return: int: number of expectations still pending
+		"""
+		for group_id in self.queue.get_groups():
+			self.verify_group(group_id)
+		for group_id, group_dn in self.queue.get_empty_group_checks():
+			try:
+				# a listener or the sync worker may be adding members right now
+				with self.ol.group_lock(group_dn):
+					self.ol.delete_google_group_if_empty(group_dn, group_id)
+			except ResourceNotFoundError:
+				logger.info("Group %r (%r) does not exist (anymore).", group_id, group_dn)
+			self.queue.remove_empty_group_check(group_id)
+		return sum(len(self.queue.get_members(group_id)) for group_id in self.queue.get_groups())
+
+	def verify_group(self, group_id):
+		"""
+		Compare the expected with the actual members of a group (one listing)
+		and repair those members, whose changes are overdue.
+		:param group_id: str: ID of google group
+		:return: None
+		"""
+		try:
+			member_ids = set(m["id"] for m in self.gh.iter_members(group_id, fields="ids", maxResults=200))
+		except ResourceNotFoundError:
+			logger.info("Group %r does not exist (anymore), dropping its membership expectations.", group_id)
+			self.queue.remove_members(group_id)
+			return
+
+		now = time.time()
+		confirmed = []
+		to_add = []
+		to_remove = []
+		given_up = []
+		for member_id, present, since, repairs in self.queue.get_members(group_id):
+			if (member_id in member_ids) == bool(present):
+				confirmed.append(member_id)
+			elif now - since < self.repair_after:
+				continue
+			elif repairs >= self.max_repairs:
+				logger.error("Member %r did not %sappear in group %r after %d repairs, giving up.",
+					member_id, "" if present else "dis", group_id, repairs)
+				given_up.append(member_id)
+			elif present:
+				to_add.append(member_id)
+			else:
+				to_remove.append(member_id)
+		self.queue.remove_members(group_id, confirmed + given_up)
+		logger.debug("group_id=%r confirmed=%r to_add=%r to_remove=%r", group_id, confirmed, to_add, to_remove)
+
+		if to_add:
+			logger.warn("Repairing group %r: adding members %r.", group_id, to_add)
+			self._log_errors(group_id, self.gh.batch_add_members(group_id, to_add))
+		if to_remove:
+			logger.warn("Repairing group %r: removing members %r.", group_id, to_remove)
+			results = self.gh.batch_delete_members(group_id, to_remove)
+			# already gone
+			gone = [k for k, v in results.items() if isinstance(v, ResourceNotFoundError)]
+			self.queue.remove_members(group_id, gone)
+			self._log_errors(group_id, dict((k, v) for k, v in results.items() if k not in gone))
+		self.queue.set_repaired(group_id, to_add + to_remove)
+
+	@staticmethod
+	def _log_errors(group_id, results):
+		for member_id, result in results.items():
+			if isinstance(result, Exception):
+				logger.error("Repairing membership of %r in group %r failed: %s", member_id, group_id, result)
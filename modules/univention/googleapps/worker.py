@@ -0,0 +1,411 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+#
+# Univention Google Apps for Work - sync worker
+#
+# Copyright 2016-2019 Univention GmbH
+#
+# http://www.univention.de/
+#
+# All rights reserved.
+#
+# The source code of this program is made available
+# under the terms of the GNU Affero General Public License version 3
+# (GNU AGPL V3) as published by the Free Software Foundation.
+#
+# Binary versions of this program provided by Univention to you as
+# well as other copyrighted, protected or trademarked materials like
+# Logos, graphics, fonts, specific documentations and configurations,
+# cryptographic keys etc. are subject to a license agreement between
+# you and Univention and not subject to the GNU AGPL V3.
+#
+# In the case you use this program under the terms of the GNU AGPL V3,
+# the program is provided in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License with the Debian GNU/Linux or Univention distribution in file
+# /usr/share/common-licenses/AGPL-3; if not, see
+# <http://www.gnu.org/licenses/>.
+
+
+
+import Queue
+import threading
+import time
+import zlib
+
+from univention.googleapps.circuitbreaker import OPEN
+from univention.googleapps.eventqueue import EventQueue, WAITING_ERROR, format_error, get_object_key
+from univention.googleapps.handler import CircuitOpenError, get_directory_circuit_breaker
+from univention.googleapps.listener import GoogleAppsListener
+from univention.googleapps.logging2udebug import get_logger
+from univention.googleapps.sync import GROUP_LISTENER_ATTRIBUTES, get_user_listener_config, sync_group, sync_user
+
+
+USER_MODULE = "google-apps-user"
+GROUP_MODULE = "google-apps-group"
+POLL_INTERVAL = 1.0  # seconds between tries while events cannot be processed (Google API unreachable)
+MAX_RUNTIME = 3600.0  # seconds after which the worker exits even if events are left (cron restarts it)
+COALESCE_WINDOW = 500  # number of events read at once and coalesced per object
+WORKER_THREADS = 4  # see google-apps/queue/workers
+# result of events that were not started because the circuit breaker is open
+NOT_STARTED = CircuitOpenError("The Google API is unreachable, event not started.")
+
+logger = get_logger("google-apps", "gafw")
+
+
+class SyncWorker(object):
+	"""
+	Processes the events the listener modules stored in the EventQueue
+	(google-apps/queue). Events are removed only after they were processed
+	successfully. Processing is idempotent: a change that was (partially)
+	applied before is not applied twice.
+
+	Failed events are moved to the dead letter store and retried with
+	exponential backoff, together with all later events of the same object.
+	Events of other objects are not held up by them.
+
+	Events of different objects are processed in parallel by
+	google-apps/queue/workers threads. Each object (user entryUUID, group
+	DN) is always handled by the same thread, so the changes of an object
+	are applied in order. Users and groups are processed in the order of
+	their events: a group is synchronized only after the users it may
+	contain (and vice versa). All threads share the rate limits of the
+	process (google-apps/api/ratelimit/*), each uses its own HTTP and LDAP
+	connections.
+
+	While the Google API is unreachable (the circuit breaker of the process
+	is open, see google-apps/api/circuit-breaker/*), events stay in the
+	queue and the dead letter store without further attempts, and are
+	processed as soon as a probe succeeds.
+	"""
+	def __init__(self, queue=None, ucr=None, workers=None):
+		"""
+		:param queue: EventQueue object or None to use the default
+		:param ucr: ConfigRegistry object or None to load it
+		:param workers: int: number of threads or None to read google-apps/queue/workers
+		"""
+		if not ucr:
+			from univention.config_registry import ConfigRegistry
+			ucr = ConfigRegistry()
+			ucr.load()
+		self.queue = queue or EventQueue()
+		attributes, self.user_attrs = get_user_listener_config(ucr)
+		self.group_sync_enabled = ucr.is_true("google-apps/groups/sync", False)
+		if workers is None:
+			workers = int(ucr.get("google-apps/queue/workers", WORKER_THREADS))
+		self.workers = max(1, workers)
+		self.circuit_breaker = get_directory_circuit_breaker(ucr)
+		# GoogleAppsListener objects of each thread (they use the HTTP connection of the thread)
+		self._local = threading.local()
+		self._partitions = []
+
+	def run(self, max_runtime=MAX_RUNTIME):
+		"""
+		Process events until the queue is empty and no dead letter is due
+		for a retry, at most for max_runtime seconds. Cron starts the worker
+		again every minute.
+		:param max_runtime: float: seconds
+		:return: None
+		"""
+		started = time.time()
+		while True:
+			processed, failed = self.run_once()
+			if self.is_idle() or time.time() - started > max_runtime:
+				return
+			if not processed:
+				time.sleep(POLL_INTERVAL)
+
+	def is_idle(self):
+		"""
+		:return: bool: whether there are neither events in the queue nor dead letters due for a retry
+		"""
+		next_retry = self.queue.next_dead_letter_retry()
+		return self.queue.count() == 0 and (next_retry is None or next_retry > time.time())
+
+	def run_once(self, limit=COALESCE_WINDOW):
+		"""
+		Retry the dead letters that are due, then process the oldest events.
+		Multiple events of the same object are coalesced into one.
+		Consecutive events of the same listener module are processed in
+		parallel. Failed events and events of objects that have dead letters
+		are moved to the dead letter store.
+		:param limit: int: maximum number of events to read from the queue
+		:return: tuple (int: number of processed events, bool: whether an event failed)
+		"""
+		if self.circuit_breaker.state == OPEN:
+			return 0, False
+		processed, failed = self.retry_dead_letters()
+		if self.circuit_breaker.state == OPEN:
+			return processed, failed
+		events = self.queue.get_events(limit)
+		blocked = self.queue.get_blocked_keys()
+		if blocked:
+			waiting = dict()
+			for event in events:
+				key = get_object_key(event.module, event.entry_uuid, event.dn)
+				if key in blocked:
+					waiting.setdefault(key, []).append(event.id)
+			for key, event_ids in waiting.items():
+				logger.info("Events %r wait for earlier failed events of %r.", event_ids, key)
+				self.queue.move_to_dead_letters(event_ids, WAITING_ERROR, blocked[key])
+			waiting_ids = set(event_id for event_ids in waiting.values() for event_id in event_ids)
+			events = [event for event in events if event.id not in waiting_ids]
+		for run in self._split_runs(coalesce(events)):
+			self.queue.set_attempted(*[event_id for event, event_ids in run for event_id in event_ids])
+			deferred = False
+			not_started = []
+			for (event, event_ids), exc in self._execute(run):
+				if isinstance(exc, CircuitOpenError):
+					# leave it in the queue, an event that was not started does not count as an attempt
+					deferred = failed = True
+					if exc is NOT_STARTED:
+						not_started.extend(event_ids)
+				elif exc:
+					logger.error("Processing event %r (%s %r) failed, moving it to the dead letter store: %s",
+						event.id, event.module, event.dn, exc)
+					self.queue.move_to_dead_letters(event_ids, format_error(exc))
+					failed = True
+				else:
+					self.queue.remove(*event_ids)
+					processed += len(event_ids)
+			if deferred:
+				self.queue.unset_attempted(*not_started)
+				logger.warn("The Google API is unreachable, deferring the remaining events.")
+				break
+		return processed, failed
+
+	def retry_dead_letters(self):
+		"""
+		Retry the events in the dead letter store of all objects whose next
+		retry is due. On failure the next retry is scheduled with exponential
+		backoff.
+		:return: tuple (int: number of processed events, bool: whether an event failed)
+		"""
+		processed = 0
+		failed = False
+		dead_letters = self.queue.get_dead_letters(due=time.time())
+		for run in self._split_runs(coalesce([dead_letter.event for dead_letter in dead_letters])):
+			deferred = False
+			for (event, event_ids), exc in self._execute(run):
+				if isinstance(exc, CircuitOpenError):
+					# retry when the API is reachable again, without increasing the backoff
+					deferred = failed = True
+				elif exc:
+					next_retry = self.queue.set_dead_letters_failed(event_ids, format_error(exc))
+					logger.error("Retrying events %r (%s %r) failed, next retry at %s: %s", event_ids, event.module,
+						event.dn, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(next_retry)), exc)
+					failed = True
+				else:
+					logger.info("Retrying events %r (%s %r) succeeded.", event_ids, event.module, event.dn)
+					self.queue.remove_dead_letters(*event_ids)
+					processed += len(event_ids)
+			if deferred:
+				break
+		return processed, failed
+
+	def process(self, event, event_ids=None):
+		"""
+		Apply one event to the google directory and remove it from the queue.
+		:param event: eventqueue.Event
+		:param event_ids: list: IDs of all events coalesced into event or None
+		:return: None
+		"""
+		event_ids = event_ids or [event.id]
+		self.queue.set_attempted(*event_ids)
+		self.sync_event(event, event_ids)
+		self.queue.remove(*event_ids)
+
+	def sync_event(self, event, event_ids):
+		"""
+		Apply one (coalesced) event to the google directory. Thread safe.
+		:param event: eventqueue.Event
+		:param event_ids: list: IDs of all events coalesced into event
+		:return: None
+		"""
+		if event.module not in (USER_MODULE, GROUP_MODULE):
+			logger.error("Dropping event %r of unknown listener module %r.", event.id, event.module)
+			return
+		if len(event_ids) > 1 and event.old == event.new:
+			logger.debug("Events %r of %r cancel each other out.", event_ids, event.dn)
+			return
+		ol = self._get_listener(event.module)
+		logger.debug("Processing event %r: %s %s %r", event.id, event.module, event.command, event.dn)
+		new, old = self.update_object_ids(ol, event)
+		if event.module == USER_MODULE:
+			# a user that could not be created before, has not been added to its groups
+			sync_user(ol, event.dn, new, old, self.group_sync_enabled, update_groups=event.attempts > 0)
+		else:
+			sync_group(ol, event.dn, new, old)
+
+	def _get_listener(self, module):
+		"""
+		Get the GoogleAppsListener object of the current thread for a
+		listener module. Run as root: ldap_cred is empty -> admin connection.
+		:param module: str: USER_MODULE or GROUP_MODULE
+		:return: GoogleAppsListener
+		"""
+		if not hasattr(self._local, "listeners"):
+			self._local.listeners = {
+				USER_MODULE: GoogleAppsListener(None, self.user_attrs, {}),
+				GROUP_MODULE: GoogleAppsListener(None, dict(listener=list(GROUP_LISTENER_ATTRIBUTES)), {}),
+			}
+		return self._local.listeners[module]
+
+	def _execute(self, run):
+		"""
+		Run sync_event() for independent events, in parallel if there are
+		multiple threads. Events are partitioned by partition_key().
+		:param run: list of tuples (eventqueue.Event, list: event IDs)
+		:return: list of tuples ((eventqueue.Event, list: event IDs), Exception or None)
+		"""
+		results = []
+		if self.workers == 1 or len(run) == 1:
+			for item in run:
+				results.append((item, self._sync_item(item)))
+			return results
+		self._start_threads()
+		for item in run:
+			self._partitions[partition_key(item[0]) % self.workers].put((item, results))
+		for partition in self._partitions:
+			partition.join()
+		return results
+
+	def _sync_item(self, item):
+		if self.circuit_breaker.state == OPEN:
+			return NOT_STARTED
+		try:
+			self.sync_event(*item)
+		except CircuitOpenError as exc:
+			logger.debug("Processing event %r deferred: %s", item[0].id, exc)
+			return exc
+		except Exception as exc:
+			logger.exception("Processing event %r failed.", item[0].id)
+			return exc
+		return None
+
+	def _start_threads(self):
+		if self._partitions:
+			return
+		for num in range(self.workers):
+			partition = Queue.Queue()
+			thread = threading.Thread(target=self._thread_loop, args=(partition,), name="sync-worker-{}".format(num))
+			thread.daemon = True
+			thread.start()
+			self._partitions.append(partition)
+
+	def _thread_loop(self, partition):
+		while True:
+			item, results = partition.get()
+			try:
+				results.append((item, self._sync_item(item)))
+			finally:
+				partition.task_done()
+
+	@staticmethod
+	def _split_runs(items):
+		"""
+		Split events into runs of consecutive events of the same listener module.
+		:param items: list of tuples (eventqueue.Event, list: event IDs)
+		:return: list of lists of tuples (eventqueue.Event, list: event IDs)
+		"""
+		runs = []
+		for item in items:
+			if runs and runs[-1][0][0].module == item[0].module:
+				runs[-1].append(item)
+			else:
+				runs.append([item])
+		return runs
+
+	@staticmethod
+	def update_object_ids(ol, event):
+		"""
+		The stored objects show the state at the time of the event. Object IDs
+		written by the sync since then (or by an earlier attempt to process
+		this event) are taken from LDAP, or for users from the google
+		directory, when the objects must have had one.
+		:param ol: GoogleAppsListener object
+		:param event: eventqueue.Event
+		:return: tuple (dict: new, dict: old)
+		"""
+		new, old = event.new, event.old
+		object_id = None
+		if new:
+			state = ol.get_sync_state(event.dn)
+			if state["exists"]:
+				object_id = state["object_id"]
+				if object_id:
+					new["univentionGoogleAppsObjectID"] = [object_id]
+				else:
+					new.pop("univentionGoogleAppsObjectID", None)
+		if event.module == USER_MODULE and event.entry_uuid and not object_id:
+			was_enabled = old.get("univentionGoogleAppsEnabled", ["0"])[0] == "1"
+			is_enabled = new.get("univentionGoogleAppsEnabled", ["0"])[0] == "1"
+			if (was_enabled and "univentionGoogleAppsObjectID" not in old) or (is_enabled and event.attempts > 0):
+				object_id = ol.gh.find_user_id(event.entry_uuid)
+				if object_id and is_enabled:
+					new["univentionGoogleAppsObjectID"] = [object_id]
+		if old and object_id and "univentionGoogleAppsObjectID" not in old:
+			old["univentionGoogleAppsObjectID"] = [object_id]
+		return new, old
+
+
+def coalesce(events):
+	"""
+	Fold the events of each object (entryUUID) into one event with the old
+	object of the first and the new object of the last event: create and
+	modify become a create with the final state, modify and delete become a
+	delete, create and delete cancel each other out and multiple changes of
+	uniqueMember become one membership diff. If one of the events was
+	attempted before, a create and delete become a delete of the last old
+	object: the create may have reached google already.
+
+	The position of a coalesced event keeps the dependencies between users
+	and groups: a user is synchronized at the position of its first event (so
+	it exists when groups add it), a group at the position of its last event
+	(after all users it may contain).
+
+	:param events: list of eventqueue.Event, ordered
+	:return: list of tuples (eventqueue.Event, list: IDs of coalesced events)
+	"""
+	by_object = dict()
+	for event in events:
+		by_object.setdefault((event.module, event.entry_uuid or event.dn), []).append(event)
+	result = []
+	for event in events:
+		object_events = by_object[(event.module, event.entry_uuid or event.dn)]
+		position = object_events[0] if event.module == USER_MODULE else object_events[-1]
+		if event is not position:
+			continue
+		first, last = object_events[0], object_events[-1]
+		attempts = max(e.attempts for e in object_events)
+		old = first.old
+		if not first.old and not last.new and attempts > 0:
+			# the google object is found by update_object_ids()
+			old = last.old
+		coalesced = last._replace(
+			id=first.id,
+			old=old,
+			created=first.created,
+			attempts=attempts)
+		if len(object_events) > 1:
+			logger.debug("Coalesced events %r of %r.", [e.id for e in object_events], last.dn)
+		result.append((coalesced, [e.id for e in object_events]))
+	return result
+
+
+def partition_key(event):
+	"""
+	Get the number of the partition an event belongs to: events of the same
+	user (entryUUID) or group (DN) always get the same number.
+	:param event: eventqueue.Event
+	:return: int
+	"""
+	if event.module == GROUP_MODULE:
+		key = event.dn.lower()
+	else:
+		key = event.entry_uuid or event.dn.lower()
+	return zlib.crc32(key) & 0xffffffff
@@ -246,6 +246,30 @@ define([
 							_('Via the Univention Config Registry variables <i>google-apps/attributes/mapping/.*</i> can be configured which LDAP attributes (e.g. given name, surname, etc.) of a user account are sychronized.') + ' ' +
 							_('You may add or remove attributes by using the %s.', [tools.linkToModule({module: 'ucr'})])
 						])
+					}, {
+						type: Text,
+						name: 'infos-additional',
+						content: this.formatParagraphs([
+							_('To synchronize many users faster, the API calls can be spread over several service accounts. Create another service account key as described before and upload it here. Its client ID has to be authorized for the same API scopes.')
+						])
+					}, {
+						type: Uploader,
+						name: 'upload-additional',
+						buttonLabel: _('Upload additional service account key'),
+						command: 'googleapps/upload',
+						dynamicOptions: lang.hitch(this, function() {
+							return {
+								email: this.getWidget('upload-service-account-key', 'email').get('value'),
+								domain: this.getWidget('upload-service-account-key', 'domain').get('value'),
+								additional: true
+							};
+						}),
+						onUploaded: lang.hitch(this, function(result) {
+							if (typeof result == 'string') {
+								return;
+							}
+							dialog.alert(_('The additional service account key has been uploaded. Please authorize the client ID %(client_id)s for the scopes %(scope)s.', result.result), _('Additional service account key'));
+						})
 					}]
 				}, {
 					name: 'success3',
@@ -41,7 +41,7 @@ from univention.management.console.error import UMC_Error, UnprocessableEntity
 from univention.management.console.config import ucr
 
 from univention.management.console.modules.decorators import sanitize, simple_response, file_upload, allow_get_request
-from univention.management.console.modules.sanitizers import StringSanitizer, DictSanitizer, EmailSanitizer, ValidationError, MultiValidationError
+from univention.management.console.modules.sanitizers import StringSanitizer, DictSanitizer, EmailSanitizer, BooleanSanitizer, ValidationError, MultiValidationError
 
 from univention.googleapps.auth import GappsAuth, SCOPE, GoogleAppError, AuthenticationError, AuthenticationErrorRetry, SSLError
 from univention.googleapps.listener import GoogleAppsListener
@@ -102,16 +102,19 @@ class Instance(Base):
 	@sanitize_body(DictSanitizer(dict(
 		email=EmailSanitizer(required=True),
 		domain=StringSanitizer(required=True),
+		additional=BooleanSanitizer(default=False),
 	), required=True))
 	def upload(self, request):
-		GappsAuth.uninitialize()
+		additional = request.body.get('additional', False)
+		if not additional:
+			GappsAuth.uninitialize()
 		with open(request.options[0]['tmpfile']) as fd:
 			try:
 				data = json.load(fd)
 			except ValueError:
 				raise UMC_Error(_('The uploaded file is not a JSON credentials file.'))
 			try:
-				GappsAuth.store_credentials(data, request.body['email'], domain=request.body['domain'])
+				GappsAuth.store_credentials(data, request.body['email'], additional=additional, domain=request.body['domain'])
 			except GoogleAppError as exc:
 				raise UMC_Error(str(exc))
 		self.finished(request.id, {
@@ -126,7 +129,7 @@ class Instance(Base):
 			raise UMC_Error(_('The configuration of Google Apps for Work is not yet complete.'))
 		try:
 			ol = GoogleAppsListener(None, {}, {})
-			ol.gh.list_users(projection="basic")
+			next(ol.gh.iter_users(fields="ids", maxResults=1), None)
 			try:
 				subprocess.call(["service", "univention-directory-listener", "restart"])
 			except (EnvironmentError,):